@@ -0,0 +1,258 @@
+'''
+asyncio front end for InfinoteEditor (Python 3 only).
+
+AsyncEditor puts the ["i", params], ["d", params] and ["u", params] entries
+submitted to it in an ordered inbox. A single consumer takes them out in
+batches and executes each batch on an executor thread, so translating requests
+never blocks the event loop:
+
+    editor = AsyncEditor()
+    result = await editor.submit(['i', (1, '', 0, 'abc')])
+    executed = await result
+
+The inbox is bounded: once it holds maxInbox entries, submit() waits for room,
+so producers cannot run ahead of the editor.
+Every executed request, translated to the state it was applied at, is
+published to the subscribers of the editor:
+
+    subscription = editor.subscribe()
+    async for translated in subscription:
+        ...
+
+The module does not use the async/await syntax itself, so it can be imported
+by code that still has to be parsed by older interpreters.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import asyncio
+from collections import deque
+
+from infinote import InfinoteEditor
+
+
+class Subscription(object):
+    '''Instantiates a new subscription.
+    @class An asynchronous iterator over the requests executed by an
+    AsyncEditor.
+    @param {Number} [maxsize] Number of requests that may be waiting for the
+    subscriber. A subscriber that falls further behind is closed, with
+    overflowed set, instead of slowing down the editor. 0 means no limit.
+    '''
+    def __init__(self, maxsize = 0):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.waiter = None
+        self.closed = False
+        self.overflowed = False
+
+
+    def publish(self, translated):
+        if self.closed:
+            return
+        if self.maxsize and len(self.items) >= self.maxsize:
+            self.overflowed = True
+            self.close()
+            return
+        self.items.append(translated)
+        self.wake()
+
+
+    def close(self):
+        '''Ends the iteration once the queued requests have been consumed.'''
+        self.closed = True
+        self.wake()
+
+
+    def wake(self):
+        waiter = self.waiter
+        if waiter == None or waiter.done():
+            return
+        self.waiter = None
+        if self.items:
+            waiter.set_result(self.items.popleft())
+        elif self.closed:
+            waiter.set_exception(StopAsyncIteration())
+
+
+    def __aiter__(self):
+        return self
+
+
+    def __anext__(self):
+        result = asyncio.get_event_loop().create_future()
+        self.waiter = result
+        self.wake()
+        return result
+
+
+class AsyncEditor(object):
+    '''Instantiates a new asynchronous editor. Must be called with the event
+    loop running, or with loop given.
+    @class Executes editor entries in submission order without blocking the
+    event loop.
+    @param {InfinoteEditor} [editor] The editor to execute entries with.
+    @param [loop] The event loop. Defaults to the running loop.
+    @param [executor] The executor translations run on. Defaults to the
+    default executor of the loop.
+    @param {Number} [maxInbox] Maximum number of entries in the inbox.
+    @param {Number} [batchSize] Maximum number of entries executed per
+    executor call.
+    '''
+    def __init__(self, editor = None, loop = None, executor = None, maxInbox = 1024, batchSize = 64):
+        if editor == None:
+            editor = InfinoteEditor()
+        if loop == None:
+            loop = asyncio.get_event_loop()
+        self.editor = editor
+        self.loop = loop
+        self.executor = executor
+        self.batchSize = batchSize
+        self.inbox = asyncio.Queue(maxInbox)
+        #Items waiting for room in the inbox, in submission order, with the
+        #futures that tell their producers they have been queued.
+        self.waiting = deque()
+        self.subscriptions = []
+        self.closing = None
+        self.pump()
+
+
+    def submit(self, entry):
+        '''Queues an ["i", params], ["d", params] or ["u", params] entry.
+        @returns A future that is done once the entry is in the inbox, which
+        takes until there is room if the inbox is full. Its result is a future
+        that receives the requests executed because of the entry, translated
+        to the state they were applied at.
+        '''
+        return self.enqueue((self.executeEntry, entry))
+
+
+    def call(self, func, *args):
+        '''Queues a call of func with the InfinoteEditor and args, e.g.
+        editor.call(InfinoteEditor.get_state). The call is executed in order
+        with the submitted entries, on the executor.
+        @returns A future that is done once the call is in the inbox. Its
+        result is a future that receives the return value of func.
+        '''
+        return self.enqueue((lambda editor: func(editor, *args), None))
+
+
+    def enqueue(self, item):
+        if self.closing != None:
+            raise Exception('AsyncEditor is closed')
+        result = self.loop.create_future()
+        queued = self.loop.create_future()
+        self.waiting.append((item + (result,), queued))
+        self.admit()
+        return queued
+
+
+    def admit(self):
+        #Moves waiting items into the inbox while it has room.
+        while self.waiting and not self.inbox.full():
+            item, queued = self.waiting.popleft()
+            self.inbox.put_nowait(item)
+            if not queued.done():
+                queued.set_result(item[2])
+
+
+    def subscribe(self, maxsize = 0):
+        '''Returns an asynchronous iterator over the requests executed from now
+        on, translated to the state they were applied at.
+        @param {Number} [maxsize] See Subscription.
+        @type Subscription
+        '''
+        subscription = Subscription(maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+
+    def pump(self):
+        asyncio.ensure_future(self.inbox.get()).add_done_callback(self.received)
+
+
+    def received(self, get):
+        if get.cancelled():
+            return
+        items = [get.result()]
+        while len(items) < self.batchSize and not self.inbox.empty() and items[-1][0] != None:
+            items.append(self.inbox.get_nowait())
+        self.admit()
+        if items[-1][0] == None:
+            #close() was called; everything before it is executed first.
+            done = items.pop()[2]
+        else:
+            done = None
+        job = self.loop.run_in_executor(self.executor, self.executeItems, items)
+        job.add_done_callback(lambda job: self.executed(items, job, done))
+
+
+    def executeEntry(self, editor, entry):
+        return editor.apply_batch([entry])
+
+
+    def executeItems(self, items):
+        #Runs on the executor. Only one batch is executed at a time, so the
+        #editor is never used by two threads at once.
+        executed = []
+        results = []
+        state = self.editor._state
+        state.onexecute = executed.append
+        try:
+            for func, entry, result in items:
+                try:
+                    if entry == None:
+                        value = func(self.editor)
+                    else:
+                        value = func(self.editor, entry)
+                    results.append((value, None))
+                except Exception as error:
+                    results.append((None, error))
+        finally:
+            del state.onexecute
+        return (results, executed)
+
+
+    def executed(self, items, job, done):
+        if job.exception() != None:
+            results = [(None, job.exception())] * len(items)
+            executed = []
+        else:
+            results, executed = job.result()
+        for (func, entry, result), (value, error) in zip(items, results):
+            if result.done():
+                continue
+            if error != None:
+                result.set_exception(error)
+            else:
+                result.set_result(value)
+        subscriptions = []
+        for subscription in self.subscriptions:
+            for translated in executed:
+                subscription.publish(translated)
+            if not subscription.closed:
+                subscriptions.append(subscription)
+        self.subscriptions = subscriptions
+        if done != None:
+            for subscription in self.subscriptions:
+                subscription.close()
+            self.subscriptions = []
+            done.set_result(None)
+            return
+        self.pump()
+
+
+    def qsize(self):
+        '''Returns the number of entries waiting in the inbox.'''
+        return self.inbox.qsize()
+
+
+    def close(self):
+        '''Stops accepting entries. Entries submitted before are executed, then
+        all subscriptions end.
+        @returns A future that is done once the inbox has been drained.
+        '''
+        if self.closing == None:
+            self.closing = self.loop.create_future()
+            self.waiting.append(((None, None, self.closing), self.loop.create_future()))
+            self.admit()
+        return self.closing
@@ -0,0 +1,78 @@
+'''
+Tests for the asyncio front end. AsyncEditor needs Python 3, so unlike
+tests.py these run with a Python 3 interpreter:
+
+    python3 aio_tests.py
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import asyncio
+import threading
+
+from aio import AsyncEditor
+from infinote import InfinoteEditor
+
+
+def consume(loop, subscription):
+    #Collects the requests of a closed subscription.
+    received = []
+    while True:
+        try:
+            received.append(loop.run_until_complete(subscription.__anext__()))
+        except StopAsyncIteration:
+            return received
+
+
+def test_order(loop):
+    run = loop.run_until_complete
+    editor = AsyncEditor(loop = loop)
+    subscription = editor.subscribe()
+    results = [run(editor.submit(['i', (1, '1:%s' % index if index else '', index, text)])) for index, text in enumerate('abc')]
+    assert [len(run(result)) for result in results] == [1, 1, 1]
+    assert run(run(editor.call(InfinoteEditor.get_state))) == ('1:3', 'abc')
+    run(editor.close())
+    received = [translated.operation.text.toString() for translated in consume(loop, subscription)]
+    print(' Order: %s' % received) #this should output ['a', 'b', 'c']
+    assert received == ['a', 'b', 'c']
+
+
+def test_close(loop):
+    #close() drains the inbox before its future is done.
+    run = loop.run_until_complete
+    editor = AsyncEditor(loop = loop)
+    results = [run(editor.submit(['i', (2, '2:%s' % index if index else '', 0, 'x')])) for index in range(5)]
+    run(editor.close())
+    assert all(result.done() for result in results)
+    assert editor.editor.get_state() == ('2:5', 'xxxxx')
+    try:
+        editor.submit(['i', (2, '2:5', 0, 'x')])
+        assert False
+    except Exception:
+        pass
+
+
+def test_backpressure(loop):
+    #A full inbox keeps producers waiting until the editor catches up.
+    run = loop.run_until_complete
+    gate = threading.Event()
+    editor = AsyncEditor(loop = loop, maxInbox = 2, batchSize = 1)
+    run(editor.call(lambda editor: gate.wait()))
+    run(asyncio.sleep(0.05))
+    run(editor.submit(['i', (1, '', 0, 'a')]))
+    run(editor.submit(['i', (1, '1:1', 1, 'b')]))
+    blocked = editor.submit(['i', (1, '1:2', 2, 'c')])
+    run(asyncio.sleep(0.05))
+    print(' Backpressure: %s queued, blocked %s' % (editor.qsize(), not blocked.done())) #this should output 2 queued, blocked True
+    assert not blocked.done() and editor.qsize() == 2
+    gate.set()
+    run(run(blocked))
+    assert editor.editor.get_state() == ('1:3', 'abc')
+    run(editor.close())
+
+
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+test_order(loop)
+test_close(loop)
+test_backpressure(loop)
+loop.close()
@@ -0,0 +1,357 @@
+'''
+Benchmarks for the py-infinote engine.
+
+Every workload is generated from a fixed random seed, so runs are
+reproducible. For each workload the throughput, the latency percentiles of the
+individual operations and the peak memory allocated while it runs are
+reported. Results can be saved as a JSON baseline and compared against a
+later run:
+
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+
+--scale shrinks or grows all workloads, --only selects workloads by name.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import os
+import sys
+import json
+import random
+import platform
+import argparse
+import subprocess
+from timeit import default_timer as clock
+
+from infinote import *
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SEED = 1
+
+
+class Benchmark(object):
+    '''Instantiates a new benchmark.
+    @class Times the operations of one workload.
+    @param {String} name
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.seconds = 0.0
+
+
+    def measure(self, operation, *args):
+        '''Calls operation with args and records how long it took.
+        @returns The return value of operation.
+        '''
+        start = clock()
+        result = operation(*args)
+        elapsed = clock() - start
+        self.latencies.append(elapsed)
+        self.seconds += elapsed
+        return result
+
+
+    def percentile(self, latencies, fraction):
+        index = min(int(fraction * len(latencies)), len(latencies) - 1)
+        return latencies[index]
+
+
+    def result(self, peakMemory):
+        '''Summarizes the recorded operations. Latencies are in microseconds.
+        @type dict
+        '''
+        latencies = sorted(self.latencies)
+        if not latencies:
+            latencies = [0.0]
+        result = {'ops': len(self.latencies), 'seconds': self.seconds, 'opsPerSec': 0.0,
+                  'peakMemory': peakMemory}
+        if self.seconds > 0:
+            result['opsPerSec'] = len(self.latencies) / self.seconds
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            result[name] = self.percentile(latencies, fraction) * 1e6
+        return result
+
+
+def insert(user, vector, position, text):
+    return DoRequest(user, vector, Insert(position, Buffer([Segment(user, text)])))
+
+
+def benchVector(bench, scale, rng):
+    vectors = []
+    for index in range(int(2000 * scale)):
+        vectors.append(Vector(dict([(user, rng.randint(0, 1000)) for user in range(1, 9)])))
+    strings = [vector.toString() for vector in vectors]
+    for index in range(len(vectors) - 1):
+        a = vectors[index]
+        b = vectors[index + 1]
+        bench.measure(a.incr, 3, 1)
+        bench.measure(a.add, b)
+        bench.measure(a.causallyBefore, b)
+        bench.measure(Vector.leastCommonSuccessor, a, b)
+        bench.measure(Vector, strings[index])
+
+
+def benchBuffer(bench, scale, rng, bufferClass):
+    buffer = bufferClass([Segment(1, 'x' * int(100000 * scale))])
+    for index in range(int(5000 * scale)):
+        length = buffer.getLength()
+        position = rng.randint(0, length)
+        if rng.random() < 0.6 or length < 10:
+            bench.measure(buffer.splice, position, 0, Buffer([Segment(rng.randint(1, 8), 'abc')]))
+        else:
+            bench.measure(buffer.splice, min(position, length - 5), 5)
+        position = rng.randint(0, buffer.getLength())
+        bench.measure(buffer.slice, position, position + 80)
+
+
+def benchTyping(bench, scale, rng):
+    #One user typing a long text with occasional backspaces.
+    state = State()
+    position = 0
+    for index in range(int(5000 * scale)):
+        if position > 0 and rng.random() < 0.1:
+            position -= 1
+            bench.measure(state.execute, DoRequest(1, state.vector, Delete(position, 1)))
+        else:
+            bench.measure(state.execute, insert(1, state.vector, position, 'a'))
+            position += 1
+
+
+def benchConcurrent(bench, scale, rng, users = 8, lag = 4):
+    #users type at their own positions, each seeing the others lag requests late.
+    state = State()
+    history = [state.vector]
+    #The latest state each user has seen, as an index into history.
+    seen = {}
+    for index in range(int(2000 * scale)):
+        user = rng.randint(1, users)
+        seen[user] = max(seen.get(user, 0), len(history) - 1 - rng.randint(0, lag))
+        vector = history[seen[user]]
+        #The request has to include all earlier requests of its own user.
+        vector = vector.incr(user, state.vector.get(user) - vector.get(user))
+        #Every request inserts two characters, so this is the length of the
+        #document the user sees.
+        position = rng.randint(0, 2 * sum([op for other, op in vector.items()]))
+        bench.measure(state.execute, insert(user, vector, position, 'ab'))
+        history.append(state.vector)
+
+
+def benchHotspot(bench, scale, rng, users = 8):
+    #Every user inserts at the same position without seeing the others.
+    state = State()
+    base = state.vector
+    for index in range(int(200 * scale)):
+        for user in range(1, users + 1):
+            vector = base.incr(user, state.vector.get(user) - base.get(user))
+            bench.measure(state.execute, insert(user, vector, 0, 'x'))
+        base = state.vector
+
+
+def benchPaste(bench, scale, rng):
+    #A large document is pasted and then edited.
+    state = State(bufferClass = TreeBuffer)
+    text = ''.join([rng.choice('abcdefgh \n') for index in range(int(1000000 * scale))])
+    bench.measure(state.execute, insert(1, state.vector, 0, text))
+    for index in range(int(2000 * scale)):
+        position = rng.randint(0, state.buffer.getLength() - 10)
+        if rng.random() < 0.7:
+            bench.measure(state.execute, insert(2, state.vector, position, 'new'))
+        else:
+            bench.measure(state.execute, DoRequest(2, state.vector, Delete(position, 3)))
+
+
+def benchTranslate(bench, scale, rng, cacheSize = 4096):
+    #Requests issued at an old state are translated to the current one.
+    state = State(cacheSize = cacheSize)
+    history = [state.vector]
+    for index in range(int(400 * scale)):
+        user = 1 + index % 4
+        state.execute(insert(user, state.vector, rng.randint(0, state.buffer.getLength()), 'ab'))
+        history.append(state.vector)
+    for index in range(int(100 * scale)):
+        vector = rng.choice(history)
+        request = insert(5, vector, rng.randint(0, 2 * sum([op for user, op in vector.items()])), 'x')
+        bench.measure(state.translate, request, state.vector)
+
+
+def benchSequence(bench, scale, rng):
+    #A reconnecting client's requests are transformed against the run of
+    #requests the server executed while it was away.
+    buffer = Buffer([Segment(1, 'x' * 5000)])
+    operations = []
+    for index in range(int(500 * scale)):
+        position = rng.randint(0, buffer.getLength() - 5)
+        if rng.random() < 0.6:
+            operation = Insert(position, Buffer([Segment(2, 'abc')]))
+        else:
+            operation = Delete(position, buffer.slice(position, position + 5))
+        operation.apply(buffer)
+        operations.append(operation)
+    sequence = bench.measure(TransformSequence, operations)
+    for index in range(int(200 * scale)):
+        position = rng.randint(0, 4800)
+        if index % 2:
+            bench.measure(sequence.transform, Insert(position, Buffer([Segment(3, 'q')])))
+        else:
+            bench.measure(sequence.transform, Delete(position, 200))
+
+
+def benchUndo(bench, scale, rng):
+    #Two users edit alternately, then the first user undoes everything.
+    state = State()
+    count = int(500 * scale)
+    for index in range(count):
+        for user in (1, 2):
+            state.execute(insert(user, state.vector, rng.randint(0, state.buffer.getLength()), 'ab'))
+    for index in range(count):
+        bench.measure(state.execute, UndoRequest(1, state.vector))
+
+
+WORKLOADS = [
+    ('vector', benchVector),
+    ('buffer.splice+slice', lambda bench, scale, rng: benchBuffer(bench, scale, rng, Buffer)),
+    ('treebuffer.splice+slice', lambda bench, scale, rng: benchBuffer(bench, scale, rng, TreeBuffer)),
+    ('execute.typing', benchTyping),
+    ('execute.concurrent', benchConcurrent),
+    ('execute.hotspot', benchHotspot),
+    ('execute.paste', benchPaste),
+    ('translate.cached', benchTranslate),
+    ('translate.uncached', lambda bench, scale, rng: benchTranslate(bench, scale, rng, 0)),
+    ('transform.sequence', benchSequence),
+    ('undo.storm', benchUndo),
+]
+
+
+def peakRss():
+    if resource == None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+
+def runWorkload(name, workload, scale = 1.0, memory = True):
+    '''Runs one workload. Tracing allocations slows Python down considerably,
+    so peak memory is measured in a second run of the same workload.
+    @param {Boolean} [memory] Whether to measure peak memory.
+    @returns The benchmark result, see Benchmark.result. peakMemory is the
+    peak number of bytes allocated during the run, or the growth of the peak
+    resident set size where tracemalloc is not available.
+    @type dict
+    '''
+    bench = Benchmark(name)
+    before = peakRss()
+    workload(bench, scale, random.Random(SEED))
+    peakMemory = peakRss() - before
+    if memory and tracemalloc != None:
+        tracemalloc.start()
+        try:
+            workload(Benchmark(name), scale, random.Random(SEED))
+            peakMemory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return bench.result(peakMemory)
+
+
+def run(scale = 1.0, only = None, out = None, memory = True):
+    '''Runs the workloads whose names contain one of the strings in only.
+    @returns The results by workload name, and information about the run.
+    @type dict
+    '''
+    results = {}
+    for name, workload in WORKLOADS:
+        if only and not [pattern for pattern in only if pattern in name]:
+            continue
+        results[name] = runWorkload(name, workload, scale, memory)
+        if out != None:
+            out.write(formatResult(name, results[name]) + '\n')
+            out.flush()
+    return {'info': runInfo(scale), 'results': results}
+
+
+def runInfo(scale):
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'scale': scale}
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd = os.path.dirname(os.path.abspath(__file__)),
+                                         stderr = open(os.devnull, 'w'))
+        info['commit'] = commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def formatResult(name, result):
+    return '%-26s %8d ops %12.0f ops/s  p50 %8.1fus  p90 %8.1fus  p99 %8.1fus  peak %8.1f KiB' % (
+        name, result['ops'], result['opsPerSec'], result['p50'], result['p90'], result['p99'],
+        result['peakMemory'] / 1024.0)
+
+
+def compare(baseline, current, threshold = 0.1):
+    '''Compares the throughput of two runs.
+    @param {dict} baseline
+    @param {dict} current
+    @param {Number} [threshold] Relative slowdown reported as a regression.
+    @returns (name, baseline ops/s, current ops/s, change, regressed) tuples
+    for the workloads in both runs.
+    @type Array
+    '''
+    rows = []
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['opsPerSec']
+        after = current['results'][name]['opsPerSec']
+        change = 0.0
+        if before > 0:
+            change = after / before - 1
+        rows.append((name, before, after, change, change < -threshold))
+    return rows
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks the py-infinote engine.')
+    parser.add_argument('--scale', type = float, default = 1.0, help = 'workload size factor')
+    parser.add_argument('--only', action = 'append', help = 'run workloads containing this name')
+    parser.add_argument('--no-memory', dest = 'memory', action = 'store_false',
+                        help = 'skip the peak memory measurement')
+    parser.add_argument('--save', help = 'write the results to this JSON file')
+    parser.add_argument('--compare', help = 'compare with the results in this JSON file')
+    parser.add_argument('--threshold', type = float, default = 0.1,
+                        help = 'relative slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+    current = run(args.scale, args.only, sys.stdout, args.memory)
+    if args.save:
+        handle = open(args.save, 'w')
+        try:
+            json.dump(current, handle, indent = 2, sort_keys = True)
+        finally:
+            handle.close()
+    if args.compare:
+        handle = open(args.compare)
+        try:
+            baseline = json.load(handle)
+        finally:
+            handle.close()
+        regressions = 0
+        for name, before, after, change, regressed in compare(baseline, current, args.threshold):
+            sys.stdout.write('%-26s %12.0f -> %12.0f ops/s %+7.1f%%%s\n' % (
+                name, before, after, change * 100, regressed and '  REGRESSION' or ''))
+            regressions += regressed
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
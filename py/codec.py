@@ -0,0 +1,356 @@
+'''
+Binary wire codec for py-infinote requests.
+
+Requests are sent in frames. A frame holds any number of requests:
+
+    length     varint    size of the rest of the frame
+    version    uint8
+    count      varint    number of requests
+    requests
+
+All integers are unsigned LEB128 varints. A request starts with a tag byte
+(0 = DoRequest, 1 = UndoRequest, 2 = RedoRequest), followed by the user and the
+vector. A vector is stored as the number of components, followed by the
+(user, op) pair of each non-zero component. DoRequests are followed by their
+operation:
+
+    NoOp       0
+    Insert     1  position, buffer
+    Delete     2  position, 0 and a length, or 1 and the removed buffer,
+                  followed by the number of recon segments and the offset and
+                  buffer of each
+    Split      3  first operation, second operation
+    MultiDelete 4 number of parts, followed by each part as a Delete
+                  operation without its tag
+
+A buffer is the number of segments, followed by the user and the text of each.
+Texts are stored as their UTF-8 encoded size, followed by the encoded text.
+
+Decoding reads straight from a memoryview of the frame, so only the texts are
+copied out of it.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import sys
+import struct
+import codecs
+
+from infinote import *
+
+VERSION = 1
+BYTE = struct.Struct('<B')
+#The deepest nesting of Split operations that is encoded or decoded, so that
+#hostile input cannot exhaust the Python stack.
+MAX_DEPTH = 256
+
+DO, UNDO, REDO = 0, 1, 2
+NOOP, INSERT, DELETE, SPLIT, MULTIDELETE = 0, 1, 2, 3, 4
+
+if sys.version_info[0] >= 3:
+    text_type = str
+    xrange = range
+else:
+    text_type = unicode
+
+
+class CodecError(Exception):
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+def writeVarint(out, value):
+    if value < 0:
+        raise CodecError('Cannot encode negative number %s' % value)
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def readVarint(view, offset):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = BYTE.unpack_from(view, offset)[0]
+        except struct.error:
+            raise CodecError('Frame is truncated')
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (result, offset)
+        shift += 7
+        if shift > 63:
+            raise CodecError('Varint is too long')
+
+
+def readCount(view, offset):
+    '''Reads the number of items that follow. Every item takes at least one
+    byte, so a count larger than the rest of the data is rejected before
+    anything is allocated for it.
+    '''
+    count, offset = readVarint(view, offset)
+    if count > len(view) - offset:
+        raise CodecError('Count %s exceeds the data' % count)
+    return (count, offset)
+
+
+def writeText(out, text):
+    if isinstance(text, text_type):
+        text = text.encode('utf-8')
+    writeVarint(out, len(text))
+    out.extend(text)
+
+
+def readText(view, offset):
+    size, offset = readVarint(view, offset)
+    end = offset + size
+    if end > len(view):
+        raise CodecError('Frame is truncated')
+    return (codecs.utf_8_decode(view[offset:end], 'strict', True)[0], end)
+
+
+def writeVector(out, vector):
+    items = vector.items()
+    writeVarint(out, len(items))
+    for user, op in items:
+        writeVarint(out, user)
+        writeVarint(out, op)
+
+
+def readVector(view, offset):
+    count, offset = readCount(view, offset)
+    values = {}
+    for index in xrange(count):
+        user, offset = readVarint(view, offset)
+        op, offset = readVarint(view, offset)
+        if op != 0:
+            values[user] = op
+    #The components are already numbers, so the vector does not have to be
+    #parsed or copied again.
+    return (Vector._fromValues(values), offset)
+
+
+def writeBuffer(out, buffer):
+    segments = buffer.segments
+    writeVarint(out, len(segments))
+    for segment in segments:
+        writeVarint(out, segment.user)
+        writeText(out, segment.text)
+
+
+def readBuffer(view, offset):
+    count, offset = readCount(view, offset)
+    segments = []
+    for index in xrange(count):
+        user, offset = readVarint(view, offset)
+        text, offset = readText(view, offset)
+        segments.append(Segment(user, text))
+    return (Buffer(segments), offset)
+
+
+def writeDelete(out, operation):
+    writeVarint(out, operation.position)
+    if operation.isReversible():
+        out.append(1)
+        writeBuffer(out, operation.what)
+    else:
+        out.append(0)
+        writeVarint(out, operation.what)
+    writeVarint(out, len(operation.recon.segments))
+    for segment in operation.recon.segments:
+        writeVarint(out, segment.offset)
+        writeBuffer(out, segment.buffer)
+
+
+def readDelete(view, offset):
+    position, offset = readVarint(view, offset)
+    reversible, offset = readVarint(view, offset)
+    if reversible:
+        what, offset = readBuffer(view, offset)
+    else:
+        what, offset = readVarint(view, offset)
+    count, offset = readCount(view, offset)
+    recon = Recon()
+    for index in xrange(count):
+        reconOffset, offset = readVarint(view, offset)
+        buffer, offset = readBuffer(view, offset)
+        recon.segments.append(ReconSegment(reconOffset, buffer))
+    return (Delete(position, what, recon), offset)
+
+
+def writeOperation(out, operation, depth = 0):
+    if isinstance(operation, Insert):
+        out.append(INSERT)
+        writeVarint(out, operation.position)
+        writeBuffer(out, operation.text)
+    elif isinstance(operation, Delete):
+        out.append(DELETE)
+        writeDelete(out, operation)
+    elif isinstance(operation, MultiDelete):
+        out.append(MULTIDELETE)
+        writeVarint(out, len(operation.parts))
+        for part in operation.parts:
+            writeDelete(out, part)
+    elif isinstance(operation, Split):
+        if depth >= MAX_DEPTH:
+            raise CodecError('Operation is nested too deeply')
+        out.append(SPLIT)
+        writeOperation(out, operation.first, depth + 1)
+        writeOperation(out, operation.second, depth + 1)
+    elif isinstance(operation, NoOp):
+        out.append(NOOP)
+    else:
+        raise CodecError('Cannot encode operation %r' % operation)
+
+
+def readOperation(view, offset, depth = 0):
+    tag, offset = readVarint(view, offset)
+    if tag == INSERT:
+        position, offset = readVarint(view, offset)
+        text, offset = readBuffer(view, offset)
+        return (Insert(position, text), offset)
+    if tag == DELETE:
+        return readDelete(view, offset)
+    if tag == MULTIDELETE:
+        count, offset = readCount(view, offset)
+        parts = []
+        for index in xrange(count):
+            part, offset = readDelete(view, offset)
+            parts.append(part)
+        return (MultiDelete(parts), offset)
+    if tag == SPLIT:
+        if depth >= MAX_DEPTH:
+            raise CodecError('Operation is nested too deeply')
+        first, offset = readOperation(view, offset, depth + 1)
+        second, offset = readOperation(view, offset, depth + 1)
+        return (Split(first, second), offset)
+    if tag == NOOP:
+        return (NoOp(), offset)
+    raise CodecError('Unknown operation tag %s' % tag)
+
+
+def writeRequest(out, request):
+    if isinstance(request, DoRequest):
+        out.append(DO)
+    elif isinstance(request, UndoRequest):
+        out.append(UNDO)
+    elif isinstance(request, RedoRequest):
+        out.append(REDO)
+    else:
+        raise CodecError('Cannot encode request %r' % request)
+    writeVarint(out, request.user)
+    writeVector(out, request.vector)
+    if isinstance(request, DoRequest):
+        writeOperation(out, request.operation)
+
+
+def readRequest(view, offset):
+    tag, offset = readVarint(view, offset)
+    user, offset = readVarint(view, offset)
+    vector, offset = readVector(view, offset)
+    if tag == DO:
+        operation, offset = readOperation(view, offset)
+        return (DoRequest(user, vector, operation), offset)
+    if tag == UNDO:
+        return (UndoRequest(user, vector), offset)
+    if tag == REDO:
+        return (RedoRequest(user, vector), offset)
+    raise CodecError('Unknown request tag %s' % tag)
+
+
+def encode(requests):
+    '''Encodes requests into a single frame.
+    @param {Array} requests
+    @type bytes
+    '''
+    requests = list(requests)
+    body = bytearray([VERSION])
+    writeVarint(body, len(requests))
+    for request in requests:
+        writeRequest(body, request)
+    out = bytearray()
+    writeVarint(out, len(body))
+    out.extend(body)
+    return bytes(out)
+
+
+def iterDecode(data):
+    '''Decodes the requests in a frame one by one.
+    @param data The frame, as bytes, a bytearray or a memoryview.
+    '''
+    view = memoryview(data)
+    size, offset = readVarint(view, 0)
+    end = offset + size
+    if end != len(view):
+        raise CodecError('Frame size does not match the data')
+    version, offset = readVarint(view, offset)
+    if version != VERSION:
+        raise CodecError('Unsupported codec version %s' % version)
+    count, offset = readCount(view, offset)
+    for index in xrange(count):
+        request, offset = readRequest(view, offset)
+        yield request
+    if offset != end:
+        raise CodecError('Unexpected data after the last request')
+
+
+def decode(data):
+    '''Decodes all requests in a frame.
+    @param data The frame, as bytes, a bytearray or a memoryview.
+    @type Array
+    '''
+    return list(iterDecode(data))
+
+
+class FrameReader(object):
+    '''Instantiates a new frame reader.
+    @class Reassembles frames from a byte stream, such as a socket, that
+    delivers them in arbitrary chunks.
+    @param {Number} [maxFrameSize] The size in bytes above which a frame is
+    rejected instead of being buffered.
+    '''
+    def __init__(self, maxFrameSize = 1 << 24):
+        self.data = bytearray()
+        self.maxFrameSize = maxFrameSize
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def feed(self, chunk):
+        '''Adds received data and decodes the requests of every frame that is
+        now complete. Incomplete frames are kept until more data arrives.
+        @param chunk
+        @type Array
+        '''
+        self.data.extend(chunk)
+        end = 0
+        frames = []
+        while end < len(self.data):
+            try:
+                size, offset = readVarint(self.data, end)
+            except CodecError:
+                #The length itself has not been received completely.
+                if len(self.data) - end > 10:
+                    raise
+                break
+            if size > self.maxFrameSize:
+                raise CodecError('Frame of %s bytes exceeds the maximum of %s' % (size, self.maxFrameSize))
+            if offset + size > len(self.data):
+                break
+            frames.append((end, offset + size))
+            end = offset + size
+        if not frames:
+            return []
+        #Decode from a copy, so the stream buffer can be resized while the
+        #requests are in use.
+        complete = bytes(self.data[:end])
+        del self.data[:end]
+        requests = []
+        for start, stop in frames:
+            requests.extend(iterDecode(memoryview(complete)[start:stop]))
+        return requests
@@ -0,0 +1,179 @@
+'''
+Broadcasting executed requests to the clients of a py-infinote document.
+
+Every client needs an executed request translated to the state it is known to
+be at. Clients that are at the same state need the same translation, so
+Fanout keeps the clients in groups by vector and translates each request
+once per group. Since all clients in a group receive the same requests, they
+stay together, and the work per broadcast grows with the number of distinct
+client vectors rather than the number of clients.
+
+A client is at the vector of the requests it has been sent, plus its own
+requests once the server has executed them. The requests it issued itself are
+not sent back to it.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+from infinote import *
+
+
+class ClientGroup(object):
+    '''@class Clients at the same vector, together with the translated
+    requests they have not been sent yet.
+    @param {Vector} vector
+    '''
+    def __init__(self, vector):
+        self.vector = vector
+        self.clients = set()
+        self.pending = []
+
+
+class Fanout(object):
+    '''Instantiates a new fan-out stage.
+    @class Executes requests on a state and collects, per group of clients,
+    the executed requests translated to the vector of that group.
+    @param {State} state
+    '''
+    def __init__(self, state):
+        self.state = state
+        self.groups = []
+        #Group and user by client id.
+        self.clients = {}
+        self.users = {}
+        self.broadcasts = 0
+        self.translations = 0
+
+
+    def __len__(self):
+        return len(self.clients)
+
+
+    def join(self, clientId, user, vector = None):
+        '''Adds a client. The client is expected to have the document at the
+        given vector, by default the current state.
+        @param clientId
+        @param {Number} user The user the client edits as.
+        @param {Vector} [vector]
+        '''
+        if clientId in self.clients:
+            self.leave(clientId)
+        if vector == None:
+            vector = self.state.vector
+        group = None
+        for candidate in self.groups:
+            if not candidate.pending and candidate.vector == vector:
+                group = candidate
+                break
+        if group == None:
+            group = ClientGroup(vector)
+            self.groups.append(group)
+        group.clients.add(clientId)
+        self.clients[clientId] = group
+        self.users[clientId] = user
+
+
+    def leave(self, clientId):
+        '''Removes a client, dropping the requests it has not been sent.'''
+        group = self.clients.pop(clientId)
+        del self.users[clientId]
+        group.clients.discard(clientId)
+        if not group.clients:
+            self.groups.remove(group)
+
+
+    def vectorOf(self, clientId):
+        '''Returns the vector a client is known to be at.
+        @type Vector
+        '''
+        return self.clients[clientId].vector
+
+
+    def execute(self, request):
+        '''Executes a request on the state and publishes it, together with any
+        queued requests it made executable.
+        @param {Request} request
+        @returns The number of executed requests.
+        '''
+        count = 0
+        translated = self.state.execute(request)
+        while translated != None:
+            #State.execute appends the executed request to the log.
+            self.publish(self.state.log[-1], translated)
+            count += 1
+            translated = self.state.execute()
+        return count
+
+
+    def publish(self, request, translated = None):
+        '''Adds an executed request to the pending requests of every group,
+        translated to the vector of the group.
+        @param {Request} request The request as stored in the log of the state.
+        @param {Request} [translated] The request translated to the state it
+        was executed at, if known.
+        '''
+        self.broadcasts += 1
+        user = request.user
+        #The number of requests by user once this one is included.
+        count = request.vector.get(user) + 1
+        known = {}
+        if translated != None:
+            known[translated.vector] = translated
+        groups = []
+        for group in self.groups:
+            issuers = [clientId for clientId in group.clients if self.users[clientId] == user]
+            if issuers:
+                #The issuing clients already have the request.
+                if len(issuers) == len(group.clients):
+                    receivers = None
+                else:
+                    receivers = ClientGroup(group.vector)
+                    receivers.pending = list(group.pending)
+                    receivers.clients = group.clients.difference(issuers)
+                    group.clients.difference_update(receivers.clients)
+                    for clientId in receivers.clients:
+                        self.clients[clientId] = receivers
+                group.vector = group.vector.incr(user, count - group.vector.get(user))
+                groups.append(group)
+                if receivers == None:
+                    continue
+                group = receivers
+            result = known.get(group.vector)
+            if result == None:
+                result = known[group.vector] = self.state.translate(request, group.vector)
+                self.translations += 1
+            group.pending.append(result)
+            group.vector = group.vector.incr(user, count - group.vector.get(user))
+            groups.append(group)
+        self.groups = groups
+
+
+    def flush(self):
+        '''Returns the pending updates and merges groups that have arrived at
+        the same vector. Every update can be encoded once and sent to all
+        clients of its group.
+        @returns A list of (client ids, translated requests) tuples.
+        @type Array
+        '''
+        updates = []
+        merged = {}
+        for group in self.groups:
+            if group.pending:
+                updates.append((frozenset(group.clients), group.pending))
+                group.pending = []
+            target = merged.get(group.vector)
+            if target == None:
+                merged[group.vector] = group
+                continue
+            target.clients.update(group.clients)
+            for clientId in group.clients:
+                self.clients[clientId] = target
+        self.groups = list(merged.values())
+        return updates
+
+
+    def getStats(self):
+        '''Returns the number of clients, groups, broadcasts and translations.
+        @type dict
+        '''
+        return {'clients': len(self.clients), 'groups': len(self.groups),
+                'broadcasts': self.broadcasts, 'translations': self.translations}
@@ -0,0 +1,581 @@
+'''
+Randomized convergence testing of the py-infinote engine.
+
+A Simulation runs a number of sites that edit one document concurrently. Every
+site has its own State. Sites insert, delete, undo and redo at random, and
+send every request they issue to the other sites through the wire codec,
+either through a server or directly. Requests are delivered after random
+delays and in random order. Once everything has been delivered, all sites
+must hold the same text with the same segment attribution.
+
+Every site also runs a reference replica: a ReferenceState, a separate and
+naive implementation of State after JInfinote that shares only the operations
+with it. Each request a site executes has to be translated exactly like its
+reference translates it. An exception raised while a site or its reference
+executes a request is reported as an ExecutionError.
+
+Two sites always converge. With three or more, sites can end up with
+different texts when concurrent inserts meet at text that has been deleted
+in the meantime: the transformation functions inherited from JInfinote do not
+satisfy the second transformation property (TP2), so the result depends on the
+order in which the requests were executed. The reference replicas diverge in
+exactly the same way. Pass converge = False (--differential) to only check the
+translations against the reference in that case. Once the texts differ, a
+later request can also refer to text that a site does not have, and fail with
+an ExecutionError even with --differential. This is a known limitation of the
+engine, not of the simulator; such failures are reported like any other, with
+the shrunk script and its transcript.
+
+A simulation is driven by a script of actions. Actions pick positions and
+lengths as fractions of the document, so any part of a script is still a valid
+script. This is what lets a failing script be shrunk:
+
+    python fuzz.py --seeds 200
+    python fuzz.py --seed 17 --sites 4 --length 400
+
+A failure is reported with the shrunk script, the requests each site issued
+and the order in which they were delivered. With --bench, the throughput of the
+sites is reported as well.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import sys
+import random
+import argparse
+from timeit import default_timer as clock
+
+import codec
+from infinote import *
+
+INSERT = 'insert'
+DELETE = 'delete'
+UNDO = 'undo'
+REDO = 'redo'
+DELIVER = 'deliver'
+
+#Every site sends its requests to the first site, the server, which executes
+#them and forwards them to all other sites. Requests arrive in the order they
+#were sent on each connection.
+STAR = 'star'
+#Every site sends its requests to every other site directly, and requests
+#arrive in any order.
+MESH = 'mesh'
+
+#Action kinds with their relative frequency when generating scripts.
+KINDS = [(INSERT, 40), (DELETE, 20), (UNDO, 10), (REDO, 5), (DELIVER, 45)]
+TEXT = 'abcdefghij'
+
+
+class ConvergenceError(Exception):
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+class ExecutionError(Exception):
+    '''Raised when a site, or its reference, fails to execute a request. Errors
+    is the exception raised by the engine.'''
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+class ReferenceState(object):
+    '''Instantiates a new reference state.
+    @class A separate, deliberately naive implementation of the algorithm of
+    State, written after JInfinote, that the State of every site is checked
+    against. The log is a plain list that is scanned for every lookup, undo
+    and redo requests find the request they revert by counting back through
+    the log of their user, queued requests are retried in arrival order and
+    translations are evaluated recursively and kept forever. Only the
+    operations, requests, Vector and Buffer are shared with State. The number
+    of translations grows exponentially with the history.
+    '''
+    def __init__(self):
+        self.buffer = Buffer()
+        self.vector = Vector()
+        self.request_queue = []
+        self.log = []
+        self.cache = {}
+
+
+    def translate(self, request, targetVector):
+        '''Translates a request to the given state vector.
+        @param {Request} request The request to translate
+        @param {Vector} targetVector The target state vector
+        '''
+        if isinstance(request, DoRequest) and request.vector.equals(targetVector):
+            return request.copy()
+        key = (request, targetVector)
+        if key not in self.cache:
+            self.cache[key] = self.translateUncached(request, targetVector)
+        return self.cache[key]
+
+
+    def translateUncached(self, request, targetVector):
+        if not isinstance(request, DoRequest):
+            #Mirror the associated request late, if its state is reachable.
+            assocReq = self.associatedRequest(request)
+            own = assocReq.vector.get(request.user)
+            mirrorAt = targetVector.incr(request.user, own - targetVector.get(request.user))
+            if self.reachable(mirrorAt):
+                translated = self.translate(assocReq, mirrorAt)
+                return translated.mirror(targetVector.get(request.user) - own)
+        for user, op in self.vector.items():
+            if user == request.user or targetVector.get(user) <= request.vector.get(user):
+                continue
+            lastRequest = self.requestByUser(user, targetVector.get(user) - 1)
+            if not isinstance(lastRequest, DoRequest):
+                #Fold over the undo/redo pair that lastRequest closes.
+                foldBy = targetVector.get(user) - self.associatedRequest(lastRequest).vector.get(user)
+                foldAt = targetVector.incr(user, -foldBy)
+                if self.reachable(foldAt) and request.vector.causallyBefore(foldAt):
+                    return self.translate(request, foldAt).fold(user, foldBy)
+            transformAt = targetVector.incr(user, -1)
+            if self.reachable(transformAt):
+                lastRequest = self.requestByUser(user, transformAt.get(user))
+                r1 = self.translate(request, transformAt)
+                r2 = self.translate(lastRequest, transformAt)
+                return r1.transform(r2, self.concurrencyId(request, lastRequest, r1, r2))
+        raise Exception('Could not find a translation path')
+
+
+    def concurrencyId(self, request, lastRequest, r1, r2):
+        #Decides which of two requests translated to the same state is
+        #transformed when their inserts are at the same position.
+        if not r1.operation.requiresCID:
+            return None
+        cid = r1.operation.cid(r2.operation)
+        if not cid:
+            lcs = Vector.leastCommonSuccessor(request.vector, lastRequest.vector)
+            if self.reachable(lcs):
+                r1t = self.translate(request, lcs)
+                r2t = self.translate(lastRequest, lcs)
+                cidt = r1t.operation.cid(r2t.operation)
+                if cidt == r1t.operation:
+                    cid = r1.operation
+                elif cidt == r2t.operation:
+                    cid = r2.operation
+        if not cid:
+            if r1.user < r2.user:
+                return r1
+            if r1.user > r2.user:
+                return r2
+        if cid == r1.operation:
+            return r1
+        if cid == r2.operation:
+            return r2
+
+
+    def associatedRequest(self, request):
+        '''Finds the request an undo or redo request reverts by counting back
+        through the requests of its user: an undo reverts the last edit or redo
+        that is not reverted yet, a redo the last undo, unless there is a newer
+        edit.
+        @param {Request} request
+        @type Request
+        '''
+        own = request.vector.get(request.user)
+        sequence = 1
+        for logged in reversed(self.log):
+            if logged.user != request.user or logged.vector.get(request.user) >= own:
+                continue
+            if isinstance(logged, type(request)):
+                sequence += 1
+            elif isinstance(request, RedoRequest) and isinstance(logged, DoRequest):
+                return None
+            else:
+                sequence -= 1
+            if sequence == 0:
+                return logged
+
+
+    def requestByUser(self, user, getIndex):
+        for request in self.log:
+            if request.user == user:
+                if getIndex == 0:
+                    return request
+                getIndex -= 1
+
+
+    def reachable(self, vector):
+        for user, op in self.vector.items():
+            n = vector.get(user)
+            while n > 0:
+                request = self.requestByUser(user, n - 1)
+                if request == None:
+                    return False
+                if isinstance(request, DoRequest):
+                    if not request.vector.causallyBefore(vector):
+                        return False
+                    break
+                n = self.associatedRequest(request).vector.get(user)
+        return True
+
+
+    def canExecute(self, request):
+        if not request.vector.causallyBefore(self.vector):
+            return False
+        return isinstance(request, DoRequest) or self.associatedRequest(request) != None
+
+
+    def execute(self, request = None):
+        '''Executes a request, or the first executable one in the queue, and
+        queues a request that cannot be executed yet.
+        @returns The executed request, translated to the current state.
+        '''
+        if request == None:
+            for request in self.request_queue:
+                if self.canExecute(request):
+                    self.request_queue.remove(request)
+                    break
+            else:
+                return None
+        if not self.canExecute(request):
+            self.request_queue.append(request)
+            return None
+        request = request.copy()
+        if not isinstance(request, DoRequest):
+            assocReq = self.associatedRequest(request)
+            own = request.vector.get(request.user)
+            request.vector = assocReq.vector.incr(request.user, own - assocReq.vector.get(request.user))
+        translated = self.translate(request, self.vector)
+        if isinstance(request, DoRequest):
+            request = request.makeReversible(translated, self)
+        self.log.append(request)
+        translated.execute(self)
+        return translated
+
+
+class Site(object):
+    '''@class A replica of the document in a Simulation.
+    @param {Number} user The user editing at this site.
+    @param {State} state
+    @param {State} [reference]
+    '''
+    def __init__(self, user, state, reference = None):
+        self.user = user
+        self.state = state
+        self.reference = reference
+        #Encoded requests by other sites that have not been delivered yet.
+        self.inbox = []
+
+
+def attribution(buffer):
+    '''Returns the (user, text) pairs of a buffer, with adjacent segments by the
+    same user combined.
+    @type Array
+    '''
+    result = []
+    for segment in buffer.segments:
+        if not segment.text:
+            continue
+        if result and result[-1][0] == segment.user:
+            result[-1] = (segment.user, result[-1][1] + segment.text)
+        else:
+            result.append((segment.user, segment.text))
+    return result
+
+
+def generate(rng, sites = 3, length = 100):
+    '''Generates a random script.
+    @param {Random} rng
+    @param {Number} [sites]
+    @param {Number} [length] The number of actions.
+    @returns (kind, site, a, b) tuples, where a and b are in [0, 1).
+    @type Array
+    '''
+    total = sum([weight for kind, weight in KINDS])
+    script = []
+    for index in range(length):
+        pick = rng.random() * total
+        for kind, weight in KINDS:
+            pick -= weight
+            if pick < 0:
+                break
+        script.append((kind, rng.randrange(sites), rng.random(), rng.random()))
+    return script
+
+
+class Simulation(object):
+    '''Instantiates a new simulation.
+    @class Runs scripts against a number of sites and checks that they
+    converge.
+    @param {Number} [sites] The number of sites. Site i edits as user i + 1.
+    @param {Boolean} [reference] Whether every site checks its translations
+    against a ReferenceState.
+    @param {function} [factory] Creates the State of a site. Defaults to State.
+    @param {String} [topology] STAR or MESH.
+    @param {Boolean} [converge] Whether the sites have to end up with the same
+    text. Otherwise only their state vectors are compared, and every site
+    with its reference.
+    '''
+    def __init__(self, sites = 3, reference = True, factory = None, topology = STAR, converge = True):
+        if factory == None:
+            factory = State
+        self.topology = topology
+        self.converge = converge
+        self.sites = []
+        for index in range(sites):
+            site = Site(index + 1, factory())
+            if reference:
+                site.reference = ReferenceState()
+            self.sites.append(site)
+        #(site index, action) for every request issued and delivered, in order.
+        self.transcript = []
+        self.executed = 0
+        self.seconds = 0.0
+
+
+    def run(self, script):
+        '''Runs a script, delivers all requests that are still underway and
+        checks that the sites have converged.
+        @param {Array} script
+        @returns The simulation.
+        @raises ConvergenceError
+        '''
+        for kind, index, a, b in script:
+            site = self.sites[index % len(self.sites)]
+            if kind == DELIVER:
+                if site.inbox:
+                    self.deliver(site, a)
+            else:
+                self.issue(site, kind, a, b)
+        #Deliver everything still underway. In a star, the server may
+        #forward requests to sites that have already been drained.
+        while [site for site in self.sites if site.inbox]:
+            for site in self.sites:
+                while site.inbox:
+                    self.deliver(site, 0)
+        self.check()
+        return self
+
+
+    def issue(self, site, kind, a, b):
+        #Creates a request at a site, executes it there and sends it to the others.
+        state = site.state
+        length = state.buffer.getLength()
+        if kind == INSERT:
+            text = TEXT[int(a * len(TEXT))] * (1 + int(b * 3))
+            operation = Insert(int(b * (length + 1)), Buffer([Segment(site.user, text)]))
+            request = DoRequest(site.user, state.vector, operation)
+        elif kind == DELETE:
+            if length == 0:
+                return
+            position = int(a * length)
+            request = DoRequest(site.user, state.vector, Delete(position, 1 + int(b * min(3, length - position))))
+        else:
+            if kind == UNDO:
+                request = UndoRequest(site.user, state.vector)
+            else:
+                request = RedoRequest(site.user, state.vector)
+            if state.associatedRequest(request) == None:
+                #There is nothing to undo or redo.
+                return
+        self.transcript.append((self.sites.index(site), request.toString()))
+        data = codec.encode([request])
+        self.receive(site, data)
+        self.send(site, data)
+
+
+    def send(self, sender, data, exclude = None):
+        #Sends a request to the sites sender is connected to.
+        for site in self.sites:
+            if site is sender or site is exclude:
+                continue
+            if self.topology == STAR and sender is not self.sites[0] and site is not self.sites[0]:
+                continue
+            site.inbox.append((sender, data))
+
+
+    def deliver(self, site, pick):
+        #Delivers one of the requests underway to a site, chosen by pick in
+        #[0, 1). In a star, every connection delivers in order.
+        if self.topology == MESH:
+            index = int(pick * len(site.inbox))
+        else:
+            senders = []
+            for sender, data in site.inbox:
+                if sender not in senders:
+                    senders.append(sender)
+            sender = senders[int(pick * len(senders))]
+            index = [entry[0] for entry in site.inbox].index(sender)
+        sender, data = site.inbox.pop(index)
+        self.transcript.append((self.sites.index(site), 'deliver %s' % codec.decode(data)[0].toString()))
+        self.receive(site, data)
+        if self.topology == STAR and site is self.sites[0]:
+            #The server forwards the request to the other clients.
+            self.send(site, data, sender)
+
+
+    def receive(self, site, data):
+        #Executes a request at a site, together with the queued requests it
+        #makes executable, and compares the translations with the reference.
+        start = clock()
+        translations = self.executeAll(site, site.state, codec.decode(data)[0])
+        self.seconds += clock() - start
+        self.executed += len(translations)
+        if site.reference == None:
+            return
+        expected = self.executeAll(site, site.reference, codec.decode(data)[0])
+        translations = [translated.toString() for translated in translations]
+        expected = [translated.toString() for translated in expected]
+        if translations != expected:
+            raise ConvergenceError('Site %s translated %s, the reference %s'
+                                   % (site.user, translations, expected))
+
+
+    def executeAll(self, site, state, request):
+        translations = []
+        try:
+            translated = state.execute(request)
+            while translated != None:
+                translations.append(translated)
+                translated = state.execute()
+        except Exception as error:
+            name = 'Site %s' % site.user
+            if state is site.reference:
+                name = 'The reference of site %s' % site.user
+            raise ExecutionError('%s failed while executing %s: %s: %s'
+                                 % (name, request.toString(), type(error).__name__, error), error)
+        return translations
+
+
+    def check(self):
+        '''Checks that all sites, and their references, are at the same state
+        vector with nothing left in their queues, and hold the same text with
+        the same attribution.
+        @raises ConvergenceError
+        '''
+        first = self.sites[0].state
+        for site in self.sites:
+            states = [site.state]
+            if site.reference != None:
+                states.append(site.reference)
+            for state in states:
+                if len(state.request_queue):
+                    raise ConvergenceError('Site %s has %d requests left in its queue'
+                                           % (site.user, len(state.request_queue)))
+                if state.vector != first.vector:
+                    raise ConvergenceError('Site %s is at %s, site 1 at %s'
+                                           % (site.user, state.vector, first.vector))
+            result = attribution(site.state.buffer)
+            if site.reference != None and attribution(site.reference.buffer) != result:
+                raise ConvergenceError('Site %s has %r, its reference %r'
+                                       % (site.user, result, attribution(site.reference.buffer)))
+            if self.converge and result != attribution(first.buffer):
+                raise ConvergenceError('Site %s has %r, site 1 %r'
+                                       % (site.user, result, attribution(first.buffer)))
+
+
+    def getStats(self):
+        '''Returns the number of executed requests and the time the sites, not
+        counting their references, spent executing them.
+        @type dict
+        '''
+        result = {'executed': self.executed, 'seconds': self.seconds, 'opsPerSec': 0.0}
+        if self.seconds > 0:
+            result['opsPerSec'] = self.executed / self.seconds
+        return result
+
+
+def failure(script, **options):
+    '''Runs a script in a new simulation, created with the given options.
+    @returns The exception the script fails with, or None.
+    '''
+    try:
+        Simulation(**options).run(script)
+    except Exception as error:
+        return error
+    return None
+
+
+def shrink(script, **options):
+    '''Removes as many actions from a failing script as possible while it
+    still fails with the same type of exception, first in large chunks and
+    then one by one.
+    @param {Array} script
+    @param options The options of the Simulation.
+    @returns The shrunk script.
+    @type Array
+    '''
+    expected = type(failure(script, **options))
+    while True:
+        length = len(script)
+        chunk = length // 2
+        while chunk >= 1:
+            index = 0
+            while index < len(script):
+                candidate = script[:index] + script[index + chunk:]
+                if type(failure(candidate, **options)) == expected:
+                    script = candidate
+                else:
+                    index += chunk
+            chunk //= 2
+        #Removing an action can make others removable, so repeat until
+        #nothing changes.
+        if len(script) == length:
+            return script
+
+
+def report(script, out = sys.stdout, **options):
+    '''Writes a failing script, the error it fails with and its transcript.'''
+    simulation = Simulation(**options)
+    try:
+        simulation.run(script)
+        error = None
+    except Exception as exception:
+        error = exception
+    out.write('script = %r\n' % (script,))
+    out.write('error: %s: %s\n' % (type(error).__name__, error))
+    for index, line in simulation.transcript:
+        out.write('  site %d: %s\n' % (index + 1, line))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Checks that py-infinote sites converge.')
+    parser.add_argument('--seed', type = int, help = 'run only this seed')
+    parser.add_argument('--seeds', type = int, default = 100, help = 'number of seeds to run')
+    parser.add_argument('--sites', type = int, default = 2)
+    parser.add_argument('--length', type = int, default = 100, help = 'actions per script')
+    parser.add_argument('--topology', choices = (STAR, MESH), default = STAR)
+    parser.add_argument('--tree', action = 'store_true', help = 'use TreeBuffer documents')
+    parser.add_argument('--no-reference', dest = 'reference', action = 'store_false',
+                        help = 'only check convergence, not the translations')
+    parser.add_argument('--differential', dest = 'converge', action = 'store_false',
+                        help = 'only check the translations, not that the texts converge')
+    parser.add_argument('--bench', action = 'store_true', help = 'report the throughput')
+    args = parser.parse_args(argv)
+    options = {'sites': args.sites, 'reference': args.reference, 'topology': args.topology,
+               'converge': args.converge}
+    if args.tree:
+        options['factory'] = lambda: State(bufferClass = TreeBuffer)
+    if args.seed != None:
+        seeds = [args.seed]
+    else:
+        seeds = range(args.seeds)
+    executed = 0
+    seconds = 0.0
+    for seed in seeds:
+        script = generate(random.Random(seed), args.sites, args.length)
+        simulation = Simulation(**options)
+        try:
+            simulation.run(script)
+        except Exception:
+            sys.stdout.write('seed %d failed, shrinking %d actions\n' % (seed, len(script)))
+            report(shrink(script, **options), **options)
+            return 1
+        stats = simulation.getStats()
+        executed += stats['executed']
+        seconds += stats['seconds']
+    sys.stdout.write('%d seeds converged\n' % len(seeds))
+    if args.bench and seconds > 0:
+        sys.stdout.write('%d requests executed in %.3fs, %.0f requests/s\n'
+                         % (executed, seconds, executed / seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,67 +46,407 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
+import os
 import sys
 import re
+import time
+import heapq
+from bisect import bisect_left, bisect_right
+import random
+from collections import OrderedDict
+from timeit import default_timer as clock
+
+from journal import MemoryJournal
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 class InfinoteEditor(object):
     
-    def __init__(self):
-        self.log = []
+    def __init__(self, coalesce_window = None, journal = None):
+        #The log is an append-only journal, see journal.py. Pass a
+        #FileJournal to keep it on disk.
+        if journal == None:
+            journal = MemoryJournal()
+        self.log = journal
         self._state = State()
+        #Up to coalesce_window consecutive inserts (or deletes) by the same
+        #user at adjacent positions are merged into a single request.
+        self.coalesce_window = coalesce_window
+        #The run of coalesced edits that has not been executed yet, as
+        #[kind, request, count], with the vector of the request as the client
+        #sent it.
+        self._pending = None
+        #The runs that coalescing has merged, per user, as (end, start, saved)
+        #tuples in the order of the client: a run covers the edits after start
+        #up to end, and saved is the number of requests saved up to and
+        #including it. Clients count every edit, while the state counts a run
+        #as one request, so vectors are mapped between the two numberings,
+        #see _to_server and _to_client.
+        self._coalesced = {}
+        self._replaying = False
+        #The kind and params of requests that a batch has left in the request
+        #queue of the state, by request.
+        self._queued = {}
+
+    def _build_request(self, kind, params, vectors = None):
+        #vectors caches parsed vector strings during a batch
+        if vectors != None:
+            vector = vectors.get(params[1])
+            if vector == None:
+                vector = vectors[params[1]] = Vector(params[1])
+        else:
+            vector = Vector(params[1])
+        if kind == 'i':
+            #user, text
+            segment = Segment(params[0], params[3])
+            buffer = Buffer([segment])
+            #position, buffer
+            operation = Insert(params[2], buffer)
+        else:
+            #position, length
+            operation = Delete(params[2], params[3])
+        #user, vector, operation
+        return DoRequest(params[0], vector, operation)
+
+
+    def _to_server(self, vector):
+        #Maps a vector from the numbering of the clients, which count every
+        #edit, to that of the state, in which a coalesced run counts once.
+        for user, runs in self._coalesced.items():
+            count = vector.get(user)
+            index = bisect_right(runs, (count, float('inf')))
+            if index < len(runs) and runs[index][1] < count:
+                #Clients learn of runs only as a whole, through get_state and
+                #get_changes.
+                raise Exception('Vector %s has seen only part of a coalesced run of user %s' % (vector.toString(), user))
+            if index:
+                vector = vector.incr(user, -runs[index - 1][2])
+        return vector
+
+
+    def _to_client(self, vector):
+        #Maps a vector of the state to the numbering of the clients.
+        for user, runs in self._coalesced.items():
+            ends = [end - saved for end, start, saved in runs]
+            index = bisect_right(ends, vector.get(user))
+            if index:
+                vector = vector.incr(user, runs[index - 1][2])
+        return vector
+
+
+    def _add_run(self, user, own, count):
+        #Records a run of count edits of a user that the state has executed as
+        #one request, with own requests of the user before it.
+        runs = self._coalesced.setdefault(user, [])
+        saved = 0
+        if runs:
+            saved = runs[-1][2]
+        start = own + saved
+        runs.append((start + count, start, saved + count - 1))
+
+
+    def _record(self, kind, request, params, count = 1):
+        #Appends an executed request to the journal. The vector is stored in
+        #the numbering of the state, so the journal replays without mapping,
+        #and a coalesced run also stores the number of edits it merged.
+        if self._replaying:
+            return
+        params = tuple(params)
+        if kind != 'u' and self._coalesced:
+            params = (params[0], request.vector.toString()) + params[2:4]
+        if count > 1:
+            params += (count,)
+        self.log.append([kind, params])
+
+
+    def _join(self, kind, first, second):
+        #Returns the operation that does first and then second, or None if
+        #second does not directly continue first.
+        if kind == 'i':
+            if second.position != first.position + first.getLength():
+                return None
+            text = first.text.copy()
+            text.splice(text.getLength(), 0, second.text)
+            return Insert(first.position, text)
+        if second.position == first.position:
+            #Forward deletion
+            return first.merge(second)
+        if second.position + second.getLength() == first.position:
+            #Backspace
+            return second.merge(first)
+        return None
+
+
+    def _merge(self, kind, request):
+        #Returns the operation of the pending run extended by request, or None
+        #if request does not directly continue it.
+        pending_kind, pending, count = self._pending
+        if kind != pending_kind or request.user != pending.user:
+            return None
+        #The client must not have seen any other request in between.
+        if not request.vector.equals(pending.vector.incr(request.user, count)):
+            return None
+        return self._join(kind, pending.operation, request.operation)
+
+
+    def _coalesce(self, kind, request):
+        #Adds a request built from client params to the pending run, executing
+        #the pending run first if request does not continue it. Returns False
+        #if coalescing is off.
+        if not self.coalesce_window or self.coalesce_window < 2 or self._replaying:
+            return False
+        if self._pending != None:
+            operation = self._merge(kind, request)
+            if operation != None:
+                pending = self._pending
+                pending[1] = DoRequest(request.user, pending[1].vector, operation)
+                pending[2] += 1
+                if pending[2] >= self.coalesce_window:
+                    self.flush()
+                return True
+            self.flush()
+        self._pending = [kind, request, 1]
+        return True
 
-    def try_insert(self, params):
-        #user, text
-        segment = Segment(params[0], params[3])
-        buffer = Buffer([segment])
-        #position, buffer
-        operation = Insert(params[2], buffer)
-        #user, vector
-        request = DoRequest(params[0], Vector(params[1]), operation)
+
+    def flush(self):
+        '''Executes the pending run of coalesced edits, if any. The run is
+        logged as a single entry and, like any other request, counts as one
+        request in the state. Undoing it therefore reverts the whole run
+        rather than its last edit.
+        '''
+        if self._pending == None:
+            return
+        kind, request, count = self._pending
+        self._pending = None
+        self._execute(kind, request, self._params(kind, request), count)
+
+
+    def _params(self, kind, request):
+        #The params of an insert or delete request, as try_insert and
+        #try_delete take them.
+        operation = request.operation
+        if kind == 'i':
+            return (request.user, request.vector.toString(), operation.position, operation.text.toString())
+        return (request.user, request.vector.toString(), operation.position, operation.getLength())
+
+
+    def _execute(self, kind, request, params, count = 1):
+        #Executes a request built from client params, or from a journal entry
+        #while replaying, and journals it. count is the number of edits the
+        #request has merged.
+        if not self._replaying:
+            request = DoRequest(request.user, self._to_server(request.vector), request.operation)
         if self._state.canExecute(request):
             executedRequest = self._state.execute(request)
-            self.log.append(["i",tuple(params)])
+            if count > 1:
+                self._add_run(request.user, request.vector.get(request.user), count)
+            self._record(kind, request, params, count)
+            self._drain()
+
+
+    def try_insert(self, params):
+        request = self._build_request('i', params)
+        if not self._coalesce('i', request):
+            self._execute('i', request, params, self._count(params))
         
 
     def try_delete(self, params):
-        operation = Delete(params[2], params[3])
-        #user, vector, operation
-        request = DoRequest(params[0], Vector(params[1]), operation)
-        if self._state.canExecute(request):
-            executedRequest = self._state.execute(request) 
-            self.log.append(["d",tuple(params)])
+        request = self._build_request('d', params)
+        if not self._coalesce('d', request):
+            self._execute('d', request, params, self._count(params))
+
+
+    def _count(self, params):
+        #The number of edits a journal entry has merged.
+        if len(params) > 4:
+            return params[4]
+        return 1
         
         
     def try_undo(self, params):
+        self.flush()
         request = UndoRequest(params[0], self._state.vector)
         if self._state.canExecute(request):
             executedRequest = self._state.execute(request)
-            self.log.append(["u",tuple(params)])  
+            self._record('u', request, params)
+            self._drain()
         
             
+    def apply_batch(self, log_entries):
+        '''Applies a burst of ["i", params], ["d", params] and ["u", params]
+        entries in one go. Runs of inserts and deletes are executed through
+        State.executeBatch, so their vectors are parsed once and they share
+        one translation context. Undo entries are applied in order, against
+        the state that precedes them. Inserts and deletes that cannot be
+        executed yet stay queued, and are executed and journaled as soon as a
+        later batch or edit supplies the requests they depend on.
+        @returns The executed requests, translated to the state they were applied at.
+        '''
+        self.flush()
+        executed = []
+        vectors = {}
+        run = []
+        for entry in list(log_entries) + [None]:
+            if entry != None and entry[0] in ('i', 'd'):
+                request = self._build_request(entry[0], entry[1], vectors)
+                run.append((DoRequest(request.user, self._to_server(request.vector), request.operation), entry))
+                continue
+            if run:
+                self._queued.update(run)
+                for request, translated in self._state.iterBatch([request for request, _entry in run]):
+                    kind, params = self._queued.pop(request)
+                    self._record(kind, request, params)
+                    executed.append(translated)
+                run = []
+            if entry != None and entry[0] == 'u':
+                request = UndoRequest(entry[1][0], self._state.vector)
+                if self._state.canExecute(request):
+                    executed.append(self._state.execute(request))
+                    self._record('u', request, entry[1])
+        return executed + self._drain()
+
+
+    def _drain(self):
+        #Executes and journals the requests left queued by earlier batches
+        #that have become executable.
+        executed = []
+        while self._queued:
+            request = self._state.request_queue.pop(self._state)
+            if request == None:
+                break
+            executed.append(self._state.execute(request))
+            kind, params = self._queued.pop(request)
+            self._record(kind, request, params)
+        return executed
+
+
+    def _replay(self, entries):
+        #Entries are replayed as recorded, i.e. without coalescing them again
+        #and without appending them to the journal a second time.
+        self._replaying = True
+        try:
+            for log in entries:
+                if log[0] == 'i': 
+                    self.try_insert(log[1])
+                elif log[0] =='d':
+                    self.try_delete(log[1])
+                elif log[0] == 'u':
+                    self.try_undo(log[1])
+        finally:
+            self._replaying = False
+
+
     def sync(self):
-        for log in self.log:
-            if log[0] == 'i': 
-                self.try_insert(log[1])
-            elif log[0] =='d':
-                self.try_delete(log[1])
-            elif log[0] == 'u':
-                self.try_undo(log[1])
+        self._replay(self.log)
+
+
+    def save_snapshot(self, path):
+        '''Writes a snapshot of the document to path. The snapshot records the
+        length of the journal, so recover() only has to replay the entries
+        appended after it.
+        @param {String} path
+        '''
+        import snapshot
+        self.flush()
+        self.log.sync()
+        coalesced = [[user, runs] for user, runs in self._coalesced.items()]
+        info = {'journal': len(self.log), 'coalesced': coalesced}
+        snapshot.save(self._state, path, info)
+
+
+    def recover(self, snapshot_path = None):
+        '''Rebuilds the document from the latest snapshot and the journal
+        entries appended after it. Without a snapshot the whole journal is
+        replayed.
+        @param {String} [snapshot_path]
+        @returns The number of journal entries replayed.
+        '''
+        import snapshot
+        self._pending = None
+        self._queued = {}
+        start = 0
+        if snapshot_path != None and os.path.exists(snapshot_path):
+            state, info = snapshot.read(snapshot_path)
+            self._state = state
+            self._coalesced = dict([(user, [tuple(run) for run in runs]) for user, runs in info['coalesced']])
+            start = info['journal']
+            #Requests that a batch left queued are in the snapshot but not yet
+            #in the journal, which they join once they execute.
+            for request in state.request_queue:
+                if isinstance(request.operation, Insert):
+                    self._queued[request] = ('i', self._params('i', request))
+                else:
+                    self._queued[request] = ('d', self._params('d', request))
+        else:
+            self._state = State()
+            self._coalesced = {}
+        if start > len(self.log):
+            raise Exception('Snapshot is ahead of the journal')
+        self._replay(self.log.read(start))
+        self._drain()
+        return len(self.log) - start
                 
                 
     def get_state(self):
-        return (self._state.vector.toString(), self._state.buffer.toString()) 
+        self.flush()
+        return (self._to_client(self._state.vector).toString(), self._state.buffer.toString()) 
         
     
+    def get_changes(self, since):
+        '''Returns the edits that bring a copy of the document at an earlier
+        state up to date, for clients that sync incrementally instead of
+        fetching the whole text again.
+        @param {String} since A state vector returned by get_state.
+        @returns The current state vector and a list of ['i', position, text]
+        and ['d', position, length] edits, to be applied in order.
+        '''
+        self.flush()
+        edits = []
+        for request in self._state.changesSince(self._to_server(Vector(since))):
+            self._edits(request.operation, edits)
+        return (self._to_client(self._state.vector).toString(), edits)
+
+
+    def _edits(self, operation, edits):
+        #Flattens an operation into simple edits that apply one after another.
+        if isinstance(operation, Insert):
+            if operation.getLength():
+                edits.append(['i', operation.position, operation.text.toString()])
+        elif isinstance(operation, Delete):
+            if operation.getLength():
+                edits.append(['d', operation.position, operation.getLength()])
+        elif isinstance(operation, MultiDelete):
+            for part in operation.sequential():
+                self._edits(part, edits)
+        elif isinstance(operation, Split):
+            self._edits(operation.first, edits)
+            self._edits(operation.second.transform(operation.first, operation.second), edits)
+
+
+    def get_attribution(self):
+        '''Returns who wrote which part of the document, for analytics and
+        blame views.
+        @returns The current state vector, a dict of character counts by
+        user, and a list of [offset, length, user] runs in document order.
+        '''
+        self.flush()
+        buffer = self._state.buffer
+        runs = [list(run) for run in buffer.getAttribution()]
+        return (self._to_client(self._state.vector).toString(), buffer.getAuthors(), runs)
+
+
     def get_log(self, limit = None):
+        #Journals read their tail without loading the entries before it.
+        self.flush()
         if limit != None:
-            if len(self.log) >=limit:
-                return (limit, self.log[-limit:])
-            else:
-                return (limit, self.log)
+            return (limit, self.log.tail(limit))
         else:
-            return (limit, self.log)
+            return (limit, self.log[:])
                 
                 
 class BufferSpliceError(Exception):
@@ -135,7 +475,7 @@ class NoOp(object):
         pass 
     
 
-    def transform(self, other):
+    def transform(self, other, cid = None):
         '''Transforms this NoOp operation against another operation. This returns a
         new NoOp operation.
         @type Operations.NoOp
@@ -190,6 +530,10 @@ class Insert(object):
         @returns The operation that is to be transformed.
         @type Operations.Insert
         '''
+        if not isinstance(other, (Insert, Delete)):
+            #As in JInfinote, there is no CID against a Split or a NoOp; the
+            #caller falls back to comparing user IDs.
+            return None
         if self.position < other.position:
             return other
         if self.position > other.position:
@@ -221,12 +565,22 @@ class Insert(object):
             else:
                 transformFirst = self.transform(other.first, other.first)
             #The second part of the split operation is transformed against its first part.
-            newSecond = other.second.transform(other.first)   
+            newSecond = other.second.transform(other.first, other.second)   
             if cid == self:                
                 transformSecond = transformFirst.transform(newSecond, transformFirst)
             else:
                 transformSecond = transformFirst.transform(newSecond, newSecond)   
             return transformSecond            
+        if isinstance(other, MultiDelete):
+            #Find the last part that starts before this insert.
+            index = bisect_left(other.positions, self.position) - 1
+            if index < 0:
+                return Insert(self.position, self.text)
+            part = other.parts[index]
+            offset = other.offsets[index]
+            if self.position >= part.position + part.getLength():
+                return Insert(self.position - offset - part.getLength(), self.text)
+            return Insert(part.position - offset, self.text)
            
         pos1 = self.position
         str1 = self.text
@@ -347,19 +701,23 @@ class Delete(object):
             '''
             recon1 = Recon()
             recon2 = Recon()
-        
-            for index in self.recon.segments:
-                if self.recon.segments[index].offset < at:
-                    recon1.segments.push(self.recon.segments[index])
+            #Every recon segment is relative to the text that was left before
+            #it was lost, so the split point is followed back through the
+            #segments, most recent first.
+            cut = at
+            for segment in reversed(self.recon.segments):
+                if segment.offset < cut:
+                    recon1.segments.insert(0, segment)
+                    cut += segment.buffer.getLength()
                 else:
-                    recon2.segments.push(ReconSegment(self.recon.segments[index].offset - at, self.recon.segments[index].buffer))  
+                    recon2.segments.insert(0, ReconSegment(segment.offset - cut, segment.buffer))
         return Split(Delete(self.position, at, recon1), Delete(self.position + at, self.what - at, recon2))
         
 
     @classmethod
     def getAffectedString(self, operation, buffer):
-        '''Returns the range of text in a buffer that this Delete or Split-Delete operation removes.
-        @param operation A Split-Delete or Delete operation
+        '''Returns the range of text in a buffer that this Delete, Split-Delete or MultiDelete operation removes.
+        @param operation A Split-Delete, MultiDelete or Delete operation
         @param {Buffer} buffer
         @type Buffer
         '''
@@ -369,6 +727,11 @@ class Delete(object):
             part2 = Delete.getAffectedString(operation.second, buffer)
             part2.splice(0, 0, part1)
             return part2
+        elif isinstance(operation, MultiDelete):
+            result = Buffer()
+            for part in operation.parts:
+                result.splice(result.getLength(), 0, Delete.getAffectedString(part, buffer))
+            return result
         elif isinstance(operation,Delete):
             '''In the process of determining the affected string, we also
             have to take into account the data that has been "transformed away"
@@ -424,12 +787,18 @@ class Delete(object):
             else:
                 transformFirst = self.transform(other.first, other.first)        
             #The second part of the split operation is transformed against its first part.
-            newSecond = other.second.transform(other.first) 
+            newSecond = other.second.transform(other.first, other.second) 
             if cid == self:
                 transformSecond = transformFirst.transform(newSecond,transformFirst)
             else:
                 transformSecond = transformFirst.transform(newSecond,newSecond)
             return transformSecond
+        if isinstance(other, MultiDelete):
+            #The parts are transformed against one after another.
+            result = Delete(self.position, self.what, self.recon)
+            for part in other.sequential():
+                result = result.transform(part)
+            return result
     
         pos1 = self.position
         len1 = self.getLength()
@@ -445,7 +814,7 @@ class Delete(object):
             if pos2 > pos1 and pos2 < pos1 + len1:
                 result = self.split(pos2 - pos1)
                 result.second.position += len2
-                return result
+                return MultiDelete([result.first, result.second])
             
     
         elif isinstance(other,Delete): 
@@ -544,7 +913,10 @@ class Split(object):
         @param {Buffer} buffer The buffer to which this operation is to be applied.
         '''
         self.first.apply(buffer)
-        transformedSecond = self.second.transform(self.first)
+        #The second component always lies behind the first one, e.g. when a
+        #Split of two Deletes is mirrored into two Inserts at the same
+        #position, so it is the one shifted in case of a conflict.
+        transformedSecond = self.second.transform(self.first, self.second)
         transformedSecond.apply(buffer)
 
 
@@ -560,12 +932,14 @@ class Split(object):
         '''
         if cid == self or cid == other:
             if cid == self:    
-                return Split(self.first.transform(other, self.first), self.second.transform(other, self.second))
+                result = Split(self.first.transform(other, self.first), self.second.transform(other, self.second))
             else:
-                return Split(self.first.transform(other, other), self.second.transform(other, other))
+                result = Split(self.first.transform(other, other), self.second.transform(other, other))
         else:
             #OPERATIONS SHOULD NOT GO THROUGH THIS
-            return Split(self.first.transform(other),self.second.transform(other))
+            result = Split(self.first.transform(other),self.second.transform(other))
+        #Splits of Delete operations are replaced by a flat MultiDelete.
+        return MultiDelete.normalize(result)
 
 
     def mirror(self):   
@@ -573,10 +947,171 @@ class Split(object):
         component against the first one, then mirroring both components individually.
         @type Operations.Split
         '''
-        newSecond = self.second.transform(self.first)
+        newSecond = self.second.transform(self.first, self.second)
         return Split(self.first.mirror(), newSecond.mirror())
 
 
+class MultiDelete(object):
+    '''Instantiates a new MultiDelete operation object.
+    @class An operation that removes several ranges of characters at once. It
+    takes the place of Split trees of Delete operations: the parts are kept in
+    a flat list in text order, do not overlap and are all relative to the
+    buffer before any of them is applied, so applying, transforming or
+    mirroring them never transforms one part against another.
+    @param {Array} parts The Delete operations, sorted by position.
+    '''
+    requiresCID = False
+
+    def __init__(self, parts):
+        self.parts = parts
+        #The positions of the parts, and the number of characters that the
+        #parts before each part remove.
+        self.positions = []
+        self.offsets = []
+        offset = 0
+        for part in parts:
+            self.positions.append(part.position)
+            self.offsets.append(offset)
+            offset += part.getLength()
+        self.length = offset
+
+
+    @classmethod
+    def fromParts(self, parts):
+        '''Creates the operation that removes the given parts. Parts that are
+        MultiDelete operations themselves are flattened, and parts that
+        neither remove text nor carry recon data are left out.
+        @param {Array} parts Delete or MultiDelete operations, sorted by
+        position.
+        @returns A Delete operation if only one part is left, otherwise a
+        MultiDelete operation.
+        '''
+        flat = []
+        for part in parts:
+            if isinstance(part, MultiDelete):
+                flat.extend(part.parts)
+            elif part.getLength() or part.recon.segments:
+                flat.append(part)
+        if not flat:
+            return parts[0]
+        if len(flat) == 1:
+            return flat[0]
+        return MultiDelete(flat)
+
+
+    @classmethod
+    def normalize(self, operation):
+        '''Turns a Split tree of Delete operations into a MultiDelete
+        operation. Other operations, and Splits of Deletes that overlap, are
+        returned unchanged.
+        @type Operation
+        '''
+        parts = []
+        stack = [operation]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, Split):
+                #Both components are relative to the same buffer.
+                stack.append(current.second)
+                stack.append(current.first)
+            elif isinstance(current, MultiDelete):
+                parts.extend(current.parts)
+            elif isinstance(current, Delete):
+                parts.append(current)
+            else:
+                return operation
+        for index in range(len(parts) - 1):
+            if parts[index].position + parts[index].getLength() > parts[index + 1].position:
+                return operation
+        return MultiDelete.fromParts(parts)
+
+
+    def __repr__(self):
+        return self.toString()
+
+
+    def toString(self):
+        return 'MultiDelete(%s)' % ', '.join([part.toString() for part in self.parts])
+
+
+    def toHTML(self):
+        return 'MultiDelete(%s)' % ', '.join([part.toHTML() for part in self.parts])
+
+
+    def isReversible(self):
+        '''Determines whether all parts of this operation are reversible.
+        @type Boolean
+        '''
+        for part in self.parts:
+            if not part.isReversible():
+                return False
+        return True
+
+
+    def getLength(self):
+        '''Returns the number of characters that this operation removes.
+        @type Number
+        '''
+        return self.length
+
+
+    def apply(self, buffer):
+        '''Applies this MultiDelete operation to a buffer. The parts are
+        removed from last to first, so the positions of the others stay valid.
+        @param {Buffer} buffer
+        '''
+        for part in reversed(self.parts):
+            part.apply(buffer)
+
+
+    def cid(self, other):
+        pass
+
+
+    def sequential(self):
+        '''Returns the parts as Delete operations that are applied one after
+        another, each one relative to the buffer the parts before it leave.
+        @type Array
+        '''
+        return [Delete(part.position - offset, part.what, part.recon)
+                for part, offset in zip(self.parts, self.offsets)]
+
+
+    def transform(self, other, cid = None):
+        '''Transforms this MultiDelete operation against another operation by
+        transforming every part against it.
+        @param {Operation} other
+        @param {Operation} [cid]
+        @type Operation
+        '''
+        parts = []
+        for part in self.parts:
+            if cid == self:
+                parts.append(part.transform(other, part))
+            else:
+                parts.append(part.transform(other, cid))
+        return MultiDelete.fromParts(parts)
+
+
+    def mirror(self):
+        '''Mirrors this MultiDelete operation. Returns a Split tree of Insert
+        operations that inserts the text of every part, or None if this
+        operation is not reversible.
+        @type Operations.Split
+        '''
+        if not self.isReversible():
+            return None
+        result = None
+        for part, offset in reversed(list(zip(self.parts, self.offsets))):
+            insert = Insert(part.position - offset, part.what)
+            if result == None:
+                result = insert
+            else:
+                #Each insert lies behind the one before it, as in Split.apply.
+                result = Split(insert, result)
+        return result
+
+
 class Recon(object):
     '''Creates a new Recon object.
     @class The Recon class is a helper class which collects the parts of a
@@ -587,7 +1122,7 @@ class Recon(object):
     '''
     def __init__(self, recon = None):
         if(recon != None):            
-            self.segments = recon.segments.slice(0)
+            self.segments = list(recon.segments)
         else:
             self.segments = []
 
@@ -608,15 +1143,17 @@ class Recon(object):
         '''
         newRecon = Recon(self)
         if isinstance(buffer,Buffer):            
-            newRecon.segments.push(ReconSegment(offset, buffer))
+            newRecon.segments.append(ReconSegment(offset, buffer))
         return newRecon
 
 
     def restore(self, buffer):
-        '''Restores the recon data in the given buffer.
+        '''Restores the recon data in the given buffer. The segments are
+        restored most recent first, since each one is relative to the text
+        that was left when it was lost.
         @param {Buffer} buffer
         '''
-        for segment in self.segments:    
+        for segment in reversed(self.segments):
             buffer.splice(segment.offset, 0, segment.buffer)
 
 
@@ -637,6 +1174,237 @@ class ReconSegment(object):
         return '(%s,%s)' % (self.offset, self.buffer)
 
 
+class TransformSequence(object):
+    '''Instantiates a new transform sequence.
+    @class A run of operations, each defined on the state that the one before
+    it leads to, for transforming other operations against all of them at
+    once. The run is kept as a flat list of (kind, position, length, what,
+    index) entries, Splits and MultiDeletes being flattened into their parts. An
+    operation is transformed against the run in one pass over the entries
+    that only does arithmetic on positions and lengths; operation objects are
+    created at the end. The result has the same effect as transforming the
+    operation against every operation of the run in turn.
+    @param {Array} operations Operations, or DoRequests whose operations are
+    used.
+    '''
+    def __init__(self, operations):
+        self.entries = []
+        self.users = []
+        for index, operation in enumerate(operations):
+            if isinstance(operation, DoRequest):
+                self.users.append(operation.user)
+                operation = operation.operation
+            else:
+                self.users.append(None)
+            self.compile(operation, index)
+
+
+    def __len__(self):
+        return len(self.users)
+
+
+    def compile(self, operation, index):
+        #Adds the entries of an operation. Operations that change nothing
+        #are left out.
+        if isinstance(operation, Split):
+            #The second component is transformed against the first one, as
+            #in Split.apply.
+            self.compile(operation.first, index)
+            self.compile(operation.second.transform(operation.first, operation.second), index)
+        elif isinstance(operation, MultiDelete):
+            for part in operation.sequential():
+                self.compile(part, index)
+        elif isinstance(operation, (Insert, Delete)):
+            length = operation.getLength()
+            if length:
+                if isinstance(operation, Insert):
+                    self.entries.append((Insert, operation.position, length, operation.text, index))
+                else:
+                    self.entries.append((Delete, operation.position, length, operation.what, index))
+
+
+    def transform(self, operation, behind = None):
+        '''Transforms an operation against all operations of the run.
+        @param operation An operation or DoRequest defined on the state before
+        the first operation of the run. A DoRequest can only be transformed
+        against a run of DoRequests; its vector is advanced past them.
+        @param {Array} [behind] One Boolean per operation of the run: whether
+        an Insert is the CID against that operation, i.e. goes behind text
+        inserted at the same position. For a DoRequest this defaults to
+        comparing user IDs as the Infinote protocol does, otherwise to False.
+        @returns The transformed operation or DoRequest.
+        '''
+        if isinstance(operation, DoRequest):
+            if None in self.users:
+                raise Exception('Requests can only be transformed against requests')
+            if behind == None:
+                behind = [operation.user < user for user in self.users]
+            counts = {}
+            for user in self.users:
+                counts[user] = counts.get(user, 0) + 1
+            return DoRequest(operation.user, operation.vector.add(Vector(counts)),
+                             self.transform(operation.operation, behind))
+        if isinstance(operation, Insert):
+            return self.transformInsert(operation, behind)
+        if isinstance(operation, Delete):
+            return self.transformDelete(operation)
+        if isinstance(operation, MultiDelete):
+            return MultiDelete.fromParts([self.transformDelete(part) for part in operation.parts])
+        if isinstance(operation, Split):
+            #The components of a Split are transformed independently.
+            return MultiDelete.normalize(Split(self.transform(operation.first, behind),
+                                               self.transform(operation.second, behind)))
+        return NoOp()
+
+
+    def transformInsert(self, operation, behind):
+        position = operation.position
+        for kind, start, length, what, index in self.entries:
+            if kind == Insert:
+                if position > start or (position == start and behind != None and behind[index]):
+                    position += length
+            elif position >= start + length:
+                position -= length
+            elif position > start:
+                position = start
+        return Insert(position, operation.text)
+
+
+    def transformDelete(self, operation):
+        '''Transforms a Delete operation. The text it deletes is tracked as
+        runs of (length, position, left, source) in text order. Runs that are
+        left to delete have the document position of their first character
+        and the offset of that character in operation.what as source. Runs
+        that have been deleted by the run of operations have the position of
+        the gap they left and a (buffer, offset) source for their text, or
+        None if it is not known.
+        @type Operation
+        '''
+        runs = [(operation.getLength(), operation.position, True, 0)]
+        #Text that has been transformed away before is restored most recent
+        #first, as in Recon.restore.
+        for segment in reversed(operation.recon.segments):
+            runs = self.insertLost(runs, segment.offset, segment.buffer)
+        for kind, start, length, what, index in self.entries:
+            end = start + length
+            result = []
+            for run in runs:
+                size, position, left, source = run
+                #Lost runs take no room in the document.
+                width = left and size or 0
+                if kind == Insert:
+                    if start >= position + width:
+                        result.append(run)
+                    elif start <= position:
+                        result.append((size, position + length, left, source))
+                    else:
+                        #The insert splits this run in two.
+                        cut = start - position
+                        result.append((cut, position, True, source))
+                        result.append((size - cut, end, True, source + cut))
+                elif position + width <= start:
+                    result.append(run)
+                elif position >= end:
+                    result.append((size, position - length, left, source))
+                elif not width:
+                    result.append((size, start, left, source))
+                else:
+                    #The delete removes part of this run.
+                    cutBegin = max(start, position)
+                    cutEnd = min(end, position + size)
+                    if cutBegin > position:
+                        result.append((cutBegin - position, position, True, source))
+                    lost = None
+                    if isinstance(what, Buffer):
+                        lost = (what, cutBegin - start)
+                    result.append((cutEnd - cutBegin, start, False, lost))
+                    if cutEnd < position + size:
+                        result.append((position + size - cutEnd, start, True, source + cutEnd - position))
+            runs = result
+        return self.materialize(operation, runs)
+
+
+    def insertLost(self, runs, offset, buffer):
+        #Inserts a run of lost text at an offset into the known text of runs.
+        result = []
+        length = buffer.getLength()
+        for index, run in enumerate(runs):
+            size, position, left, source = run
+            if left or source != None:
+                if offset == 0:
+                    result.append((length, position, False, (buffer, 0)))
+                    result.extend(runs[index:])
+                    return result
+                if offset < size:
+                    if left:
+                        result.append((offset, position, True, source))
+                        result.append((length, position + offset, False, (buffer, 0)))
+                        result.append((size - offset, position + offset, True, source + offset))
+                    else:
+                        result.append((offset, position, False, source))
+                        result.append((length, position, False, (buffer, 0)))
+                        result.append((size - offset, position, False, (source[0], source[1] + offset)))
+                    result.extend(runs[index + 1:])
+                    return result
+                offset -= size
+            result.append(run)
+        size, position, left, source = runs[-1]
+        if left:
+            position += size
+        result.append((length, position, False, (buffer, 0)))
+        return result
+
+
+    def materialize(self, operation, runs):
+        #Creates one Delete operation, or one part of a MultiDelete, per
+        #stretch of runs that are left to delete and adjacent in the document. Lost runs become recon segments
+        #of the stretch before them, or the one after them at the start.
+        stretches = []
+        stretch = None
+        lost = []
+        offset = 0
+        for size, position, left, source in runs:
+            if not left:
+                if source != None:
+                    lost.append((offset, size, source))
+                    offset += size
+                continue
+            if stretch != None:
+                stretch[3].extend(lost)
+                if stretch[0] + stretch[1] == position:
+                    stretch[1] += size
+                    stretch[2].append((source, size))
+                    lost = []
+                    offset += size
+                    continue
+            if lost and stretch == None:
+                start = lost[0][0]
+            else:
+                lost = []
+                start = offset
+            stretch = [position, size, [(source, size)], lost, start]
+            stretches.append(stretch)
+            lost = []
+            offset += size
+        if stretch == None:
+            stretch = [runs[0][1], 0, [], [], 0]
+            stretches.append(stretch)
+        stretch[3].extend(lost)
+        parts = []
+        for position, size, pieces, lost, start in stretches:
+            if operation.isReversible():
+                what = Buffer()
+                for source, length in pieces:
+                    what.splice(what.getLength(), 0, operation.what.slice(source, source + length))
+            else:
+                what = size
+            recon = Recon()
+            for offset, length, (buffer, source) in reversed(lost):
+                recon.segments.append(ReconSegment(offset - start, buffer.slice(source, source + length)))
+            parts.append(Delete(position, what, recon))
+        return MultiDelete.fromParts(parts)
+
+
 class DoRequest(object):
     '''Initializes a new DoRequest object.
     @class Represents a request made by an user at a certain time.
@@ -759,31 +1527,6 @@ class UndoRequest(object):
     def copy(self):
         return UndoRequest(self.user, self.vector)
 
-    def associatedRequest(self, log):
-        '''Finds the corresponding DoRequest to this UndoRequest.
-        @param {Array} log The log to search
-        @type DoRequest
-        '''
-        sequence = 1
-        try:
-            index = log.index(self)       
-        except ValueError:
-            index = -1
-        if index == -1: 
-            index = len(log) - 1
-        for i in range(index,0,-1):
-            # === => ==
-            if log[i] == self or log[i].user != self.user:
-                continue
-            if log[i].vector.get(self.user) > self.vector.get(self.user):
-                continue        
-            if isinstance(log[i], UndoRequest):
-                sequence += 1
-            else:
-                sequence -= 1      
-            if sequence == 0:
-                return log[i]
-
 
 class RedoRequest(object):
     '''Instantiates a new redo request.
@@ -793,7 +1536,6 @@ class RedoRequest(object):
     '''
     def __init__(self, user, vector):
         self.user = user
-        Operations.set_user(user)
         self.vector = vector    
         
         
@@ -809,63 +1551,96 @@ class RedoRequest(object):
 
     def copy(self):
         return RedoRequest(self.user, self.vector)
-        
-    def associatedRequest(self, log):
-        '''Finds the corresponding UndoRequest to this RedoRequest.
-        @param {Array} log The log to search
-        @type UndoRequest
-        '''
-        sequence = 1
-        index = log.index(self)        
-        if(index == -1): index = log.length - 1
-    
-        while index >= 0:
-            # === => ==
-            if log[index] == self or log[index].user != self.user: continue
-            if log[index].vector.get(self.user) > self.vector.get(self.user): continue       
-            if isinstance(log[index], RedoRequest): sequence += 1
-            else: sequence -= 1            
-            if(sequence == 0):
-                return log[index]
-     
+
 
 class Vector(object):
-    '''@class Stores state vectors.
+    '''@class Stores state vectors. Vectors are immutable: all operations that
+    change a component return a new Vector, so instances can be shared freely
+    and used as dictionary keys.
     @param [value] Pre-initialize the vector with existing values. This can be
     a Vector object, a generic Object with numeric properties, or a string of the form "1:2;3:4;5:6".
     '''
+    __slots__ = ('_values', '_items', '_string', '_hash')
     vector_time = re.compile(r'^(?P<id>\d+):(?P<op>\d+)$') 
     
     def __init__(self, value = None):
-        self.users = []
-        
-        if type(value).__name__ == 'Vector':
-            found = False
-            for index, _user in enumerate(value.users):
-                if _user['id'] > 0:
-                    if index in self.users:
-                        self.users[index] = {'id':_user['id'],'op':_user['op']}
-                    else: self.users.append({'id':_user['id'],'op':_user['op']})
-
-        elif isinstance(value, str):
-            pairs = value.split(';')
+        values = {}
+        if isinstance(value, Vector):
+            #Vectors are immutable, so the component mapping can be shared.
+            values = value._values
+        elif isinstance(value, dict):
+            for uid, op in value.items():
+                if int(op) != 0:
+                    values[int(uid)] = int(op)
+        elif isinstance(value, string_types):
             if value != '':
-                for pair in pairs:
+                for pair in value.split(';'):
                     match = self.vector_time.match(pair)
                     if match != None:
-                        found = False
-                        user_op = match.groupdict()
-                        for index, _user in enumerate(self.users):
-                            if _user['id'] == user_op['id']:
-                                found = True
-                                self.users[index]['op'] = user_op['op']
-                        if not found:
-                            self.users.append({'id':int(user_op['id']),'op':int(user_op['op'])})
+                        op = int(match.group('op'))
+                        if op != 0:
+                            values[int(match.group('id'))] = op
+        self._values = values
+        self._items = None
+        self._string = None
+        self._hash = None
+
+
+    @classmethod
+    def _fromValues(self, values):
+        '''Creates a vector from a component mapping without copying it. The
+        mapping must not contain zero components and must not be modified
+        afterwards.
+        '''
+        result = Vector.__new__(Vector)
+        result._values = values
+        result._items = None
+        result._string = None
+        result._hash = None
+        return result
 
                             
-      
     def __repr__(self):
         return self.toString()
+
+
+    def __hash__(self):
+        if self._hash == None:
+            self._hash = hash(self.items())
+        return self._hash
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return self._values == other._values
+
+
+    def __ne__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return self._values != other._values
+
+
+    def __getstate__(self):
+        return self._values
+
+
+    def __setstate__(self, values):
+        self._values = values
+        self._items = None
+        self._string = None
+        self._hash = None
+
+
+    def items(self):
+        '''Returns the non-zero components of this vector as a tuple of
+        (user, op) pairs, ordered by user.
+        @type tuple
+        '''
+        if self._items == None:
+            self._items = tuple(sorted(self._values.items()))
+        return self._items
         
 
     def eachUser(self, callback):
@@ -876,8 +1651,8 @@ class Vector(object):
         @type Boolean
         @returns True if the callback function has never returned false; returns False otherwise.
         '''       
-        for index, _user in enumerate(self.users):
-            if callback(int(_user['id']), int(_user['op']), index) == False:
+        for index, (uid, op) in enumerate(self.items()):
+            if callback(uid, op, index) == False:
                 return False   
         return True
 
@@ -886,44 +1661,39 @@ class Vector(object):
         '''Returns this vector as a string of the form "1:2;3:4;5:6"
         @type String
         '''
-        components = []
-        def Func(uid, op, index):
-            if(op > 0):                
-                components.append("%s:%s" % (uid,op))    
-        self.eachUser(Func)
-        components.sort()   
-        return ';'.join(components)
+        if self._string == None:
+            components = ["%s:%s" % (uid, op) for uid, op in self._values.items() if op > 0]
+            components.sort()   
+            self._string = ';'.join(components)
+        return self._string
 
-    def toHTML():
+    def toHTML(self):
         return self.toString()        
         
     def add(self, other):
         '''Returns the sum of two vectors.
         @param {Vector} other
         '''
-        result = Vector(self)
-        def Func(uid, op, index):
-            result.users[index]= {'id':uid,'op':result.get(uid) + op}
-        other.eachUser(Func)
-        return result
+        values = dict(self._values)
+        for uid, op in other._values.items():
+            op += values.get(uid, 0)
+            if op != 0:
+                values[uid] = op
+            else:
+                del values[uid]
+        return Vector._fromValues(values)
 
     def copy(self): 
-        '''Returns a copy of this vector.'''
-        return Vector(self)
+        '''Returns a copy of this vector. Since vectors are immutable, this is
+        the vector itself.'''
+        return self
 
 
     def get(self, user):
         '''Returns a specific component of this vector, or 0 if it is not defined.
         @param {Number} user Index of the component to be returned
         '''
-        # != None
-        found = False
-        for index, _user in enumerate(self.users):
-             if _user['id'] == user and _user['op'] != None:
-                found = True
-                return _user['op']
-        if not found:
-            return 0
+        return self._values.get(user, 0)
 
     def causallyBefore(self, other):
         '''Calculates whether this vector is smaller than or equal to another vector.
@@ -932,9 +1702,11 @@ class Vector(object):
         @param {Vector} other The vector to compare to
         @type Boolean
         '''
-        def Func(uid, op, index):
-            return op <= other.get(uid)
-        return self.eachUser(Func)
+        otherValues = other._values
+        for uid, op in self._values.items():
+            if op > otherValues.get(uid, 0):
+                return False
+        return True
 
 
     def equals(self, other):
@@ -944,14 +1716,7 @@ class Vector(object):
         @param {Vector} other The vector to compare to
         @type Boolean
         '''
-        def Func1(uid, op, index):
-            return other.get(uid) == op        
-        eq1 = self.eachUser(Func1)    
-        #this = self
-        def Func2(uid, op, index):
-            return self.get(uid) == op
-        eq2 = other.eachUser(Func2)
-        return eq1 and eq2
+        return self._values == other._values
 
 
     def incr(self, user, by = None):
@@ -961,17 +1726,15 @@ class Vector(object):
         @param {Number} [by] Amount by which to increase the component (default 1)
         @type Vector
         '''
-        result = Vector(self)    
         if by == None:
             by = 1
-        found = False
-        for index, _user in enumerate(result.users):
-            if _user['id'] == user: 
-                found = True
-                result.users[index]['op'] = result.get(user) + by
-        if not found:
-            result.users.append({'id':user,'op':result.get(user) + by})            
-        return result
+        values = dict(self._values)
+        op = values.get(user, 0) + by
+        if op != 0:
+            values[user] = op
+        else:
+            values.pop(user, None)
+        return Vector._fromValues(values)
         
 
     @classmethod
@@ -981,17 +1744,249 @@ class Vector(object):
         @param {Vector} v2
         @type Vector
         '''
-        result = v1.copy()  
-        def Func(uid, op, index):
-            val1 = v1.get(uid)
-            val2 = v2.get(uid)
-            if val1 < val2:
-                result.users[index] = {'id':uid,'op': val2}
-            #else:
-                #result[u] = val1
-                #pass
-        v2.eachUser(Func)    
-        return result
+        values = dict(v1._values)
+        for uid, op in v2._values.items():
+            if op > values.get(uid, 0):
+                values[uid] = op
+        return Vector._fromValues(values)
+
+
+    @classmethod
+    def leastCommonPredecessor(self, v1, v2):
+        '''Calculates the least common predecessor of two vectors, i.e. the
+        component-wise minimum.
+        @param {Vector} v1
+        @param {Vector} v2
+        @type Vector
+        '''
+        values = {}
+        for uid, op in v1._values.items():
+            op = min(op, v2._values.get(uid, 0))
+            if op != 0:
+                values[uid] = op
+        return Vector._fromValues(values)
+
+
+class TranslationCache(object):
+    '''Instantiates a new translation cache.
+    @class Memoizes translated requests by request identity and target vector.
+    Entries are evicted in least-recently-used order once more than maxSize
+    translations are stored. Entries whose target vector lies before the state
+    that all users have acknowledged are dropped first, since requests issued
+    from now on will never be translated to those states again.
+    @param {Number} [maxSize] Maximum number of cached translations. None
+    disables eviction.
+    '''
+    def __init__(self, maxSize = 4096):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.minimal = Vector()
+        self.swept = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def key(self, request, vector):
+        '''Returns the cache key for translating a request to a vector. Requests
+        are compared by identity, vectors by value.
+        @param {Request} request
+        @param {Vector} vector
+        '''
+        return (request, vector)
+
+
+    def get(self, request, vector):
+        '''Returns the cached translation of a request, or None if there is none.
+        @param {Request} request
+        @param {Vector} vector
+        '''
+        key = self.key(request, vector)
+        entry = self.entries.pop(key, None)
+        if entry == None:
+            self.misses += 1
+            return None
+        #Re-insert the entry to mark it as most recently used.
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+
+    def put(self, request, vector, translated):
+        '''Stores the translation of a request to the given vector.
+        @param {Request} request
+        @param {Vector} vector
+        @param {Request} translated
+        '''
+        self.entries[self.key(request, vector)] = (vector, translated)
+        if self.maxSize != None and len(self.entries) > self.maxSize:
+            if not self.swept:
+                self.sweep()
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(False)
+                self.evictions += 1
+
+
+    def invalidate(self, minimal):
+        '''Records the state that all users have acknowledged. Translations to
+        states before it are dropped the next time the cache fills up.
+        @param {Vector} minimal
+        '''
+        if not minimal.equals(self.minimal):
+            self.minimal = minimal
+            self.swept = False
+
+
+    def sweep(self):
+        '''Drops all translations whose target vector is not a successor of the
+        acknowledged state.
+        '''
+        for key, entry in list(self.entries.items()):
+            if not self.minimal.causallyBefore(entry[0]):
+                del self.entries[key]
+                self.invalidations += 1
+        self.swept = True
+
+
+    def discard(self, requests):
+        '''Drops all translations of the given requests.
+        @param {set} requests
+        '''
+        for key in list(self.entries.keys()):
+            if key[0] in requests:
+                del self.entries[key]
+                self.invalidations += 1
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+    def getStats(self):
+        '''Returns the hit, miss, eviction and invalidation counters.
+        @type dict
+        '''
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+class RequestQueue(object):
+    '''Instantiates an empty request queue.
+    @class Holds requests that cannot be executed yet. Every request is indexed
+    by the first component of the state vector it is still waiting for, so an
+    advancing state vector only wakes the requests that waited for the changed
+    component, instead of every queued request being checked again. Requests
+    that have become ready are handed out in the order they were queued.
+    '''
+    def __init__(self):
+        #Queued requests by sequence number, with the time they were queued.
+        self.entries = {}
+        #Sequence numbers of waiting requests by (user, op) component.
+        self.waiting = {}
+        #Heap of sequence numbers of requests whose vector has been reached.
+        self.ready = []
+        self.sequence = 0
+        self.clock = time.time
+        self.queued = 0
+        self.dequeued = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __iter__(self):
+        '''Iterates over the queued requests in the order they were queued.'''
+        for sequence in sorted(self.entries):
+            yield self.entries[sequence][0]
+
+
+    def index(self, sequence, vector):
+        #Files a request under the first component of vector it is waiting for.
+        request = self.entries[sequence][0]
+        for user, op in request.vector.items():
+            if op > vector.get(user):
+                #The state vector grows one request at a time, so the request
+                #has to be looked at again once this component reaches op.
+                self.waiting.setdefault((user, op), []).append(sequence)
+                return
+        heapq.heappush(self.ready, sequence)
+
+
+    def push(self, request, vector):
+        '''Adds a request to the queue.
+        @param {Request} request
+        @param {Vector} vector The current state vector.
+        '''
+        sequence = self.sequence
+        self.sequence += 1
+        self.entries[sequence] = (request, self.clock())
+        self.queued += 1
+        self.maxDepth = max(self.maxDepth, len(self.entries))
+        self.index(sequence, vector)
+
+
+    def advance(self, user, vector):
+        '''Wakes the requests waiting for the given component of the state
+        vector, after a request by user has been executed.
+        @param {Number} user
+        @param {Vector} vector The new state vector.
+        '''
+        sequences = self.waiting.pop((user, vector.get(user)), None)
+        if sequences != None:
+            for sequence in sequences:
+                self.index(sequence, vector)
+
+
+    def pop(self, state):
+        '''Removes and returns the first ready request that can be executed in
+        the given state, or None if there is none. Undo and redo requests that
+        have nothing to revert yet are put back until their user's next request.
+        @param {State} state
+        @type Request
+        '''
+        parked = []
+        request = None
+        while self.ready:
+            sequence = heapq.heappop(self.ready)
+            candidate, queued = self.entries[sequence]
+            if state.canExecute(candidate):
+                del self.entries[sequence]
+                wait = self.clock() - queued
+                self.dequeued += 1
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+                request = candidate
+                break
+            parked.append(sequence)
+        for sequence in parked:
+            user = self.entries[sequence][0].user
+            self.waiting.setdefault((user, state.vector.get(user) + 1), []).append(sequence)
+        return request
+
+
+    def getStats(self):
+        '''Returns the queue depth and wait time metrics. Wait times are in
+        seconds and cover the requests that have left the queue.
+        @type dict
+        '''
+        meanWait = 0.0
+        if self.dequeued:
+            meanWait = self.totalWait / self.dequeued
+        oldest = 0.0
+        if self.entries:
+            oldest = self.clock() - min([queued for request, queued in self.entries.values()])
+        return {'depth': len(self.entries), 'ready': len(self.ready), 'maxDepth': self.maxDepth,
+                'queued': self.queued, 'dequeued': self.dequeued, 'meanWait': meanWait,
+                'maxWait': self.maxWait, 'oldestWait': oldest}
 
 
 class State(object):
@@ -1000,103 +1995,196 @@ class State(object):
     its state vector, content and history of executed requests.
     @param {Buffer} [buffer] Pre-initialize the buffer
     @param {Vector} [vector] Set the initial state vector
+    @param {Number} [cacheSize] Maximum number of cached translations. None
+    keeps every translation, 0 disables the translation cache.
+    @param {Class} [bufferClass] The Buffer implementation used for the
+    document, e.g. TreeBuffer for large documents. Defaults to Buffer.
+    @param {Number} [undoDepth] The number of most recent requests per user
+    that collectGarbage keeps undoable. None keeps the whole history.
+    @param {Metrics} [metrics] Receives counters and timings of the engine,
+    see metrics.py. Instrumentation is disabled when omitted.
     '''
-    def __init__(self, buffer = None, vector = None):
+    def __init__(self, buffer = None, vector = None, cacheSize = 4096, bufferClass = None, undoDepth = None, metrics = None):
+        if bufferClass == None:
+            bufferClass = Buffer
+        self.buffer = bufferClass()
         if isinstance(buffer, Buffer):
-            self.buffer = buffer.copy()
-        else:
-            self.buffer = Buffer() 
+            self.buffer.splice(0, 0, buffer)
         self.vector = Vector(vector)
-        self.request_queue = []
+        self.request_queue = RequestQueue()
         self.log = []
-        self.cache = {}
+        #Requests in the log, indexed by user and request number.
+        self.userLog = {}
+        #The number of requests per user that have been removed from the log.
+        self.base = Vector()
+        #Per user, the requests an undo (or redo) would revert next, most
+        #recent last, and the undo/redo requests in the log mapped to the
+        #request they revert. See associatedRequest.
+        self.undoStack = {}
+        self.redoStack = {}
+        self.pairs = {}
+        self.undoDepth = undoDepth
+        self.acknowledged = {}
+        if cacheSize == 0:
+            self.cache = None
+        else:
+            self.cache = TranslationCache(cacheSize)
+        self.metrics = None
+        if metrics != None:
+            self.setMetrics(metrics)
+
+
+    def setMetrics(self, metrics):
+        '''Enables instrumentation of this state and its buffer, or disables it
+        if metrics is None.
+        @param {Metrics} metrics
+        '''
+        self.metrics = metrics
+        if metrics != None:
+            self.buffer.metrics = metrics
+        elif 'metrics' in self.buffer.__dict__:
+            del self.buffer.metrics
         
         
     def translate(self, request, targetVector, noCache = False):
-        '''Translates a request to the given state vector.
+        '''Translates a request to the given state vector. The translation
+        steps of translationSteps are evaluated iteratively with an explicit
+        stack, so long translation paths cannot exhaust the Python stack.
+        Intermediate translations are memoized in the translation cache, or
+        for the duration of this call if the cache is disabled.
         @param {Request} request The request to translate
         @param {Vector} targetVector The target state vector
         @param {Boolean} [nocache] Set to true to bypass the translation cache.
         '''
+        metrics = self.metrics
+        if metrics == None:
+            return self.evaluate(request, targetVector, noCache)
+        metrics.incr('translate.calls')
+        start = clock()
+        translated = self.evaluate(request, targetVector, noCache)
+        metrics.timing('translate', clock() - start)
+        return translated
+
+
+    def evaluate(self, request, targetVector, noCache):
+        #The iterative evaluation of translate.
+        cache = self.cache
+        if cache == None:
+            cache = TranslationCache(None)
+        translated = self.lookup(request, targetVector, noCache, cache)
+        if translated != None:
+            return translated
+        stack = [(request, targetVector, noCache, self.translationSteps(request, targetVector))]
+        depth = 1
+        translated = None
+        while True:
+            request, targetVector, noCache, steps = stack[-1]
+            step = steps.send(translated)
+            if step[0] == 'return':
+                translated = step[1]
+                stack.pop()
+                if not noCache:
+                    cache.put(request, targetVector, translated)
+                if not stack:
+                    if self.metrics != None:
+                        self.metrics.observe('translate.depth', depth)
+                    return translated
+            else:
+                translated = self.lookup(step[1], step[2], False, cache)
+                if translated == None:
+                    stack.append((step[1], step[2], False, self.translationSteps(step[1], step[2])))
+                    if len(stack) > depth:
+                        depth = len(stack)
+
+
+    def lookup(self, request, targetVector, noCache, cache):
+        '''Returns the translation of a request that is available without any
+        translation steps, or None.
+        '''
         if isinstance(request, DoRequest) and request.vector.equals(targetVector):
             #If the request vector is not an undo/redo request and is already at the desired state, 
             #simply return the original request since there is nothing to do.
             return request.copy()
         #Before we attempt to translate the request, we check whether it is cached already.
-        #[DoRequest(3, , Insert(3, bc)), 2:1]
-        #DoRequest(3, , Insert(3, bc)),2:1
-        cache_key = str([request, targetVector])
-        if self.cache != None and not noCache:     
-            if not cache_key in self.cache:
-                self.cache[cache_key] = self.translate(request, targetVector, True)        
-            #FIXME: translated requests are not cleared from the cache, so this might fill up considerably.
-            return self.cache[cache_key]
+        if cache != None and not noCache:
+            translated = cache.get(request, targetVector)
+            if self.metrics != None:
+                if translated != None:
+                    self.metrics.incr('translate.cache.hit')
+                else:
+                    self.metrics.incr('translate.cache.miss')
+            return translated
+
+
+    def translationSteps(self, request, targetVector):
+        '''Generates the steps needed to translate a request to the given state
+        vector. Each translation this depends on is yielded as a
+        ('translate', request, vector) tuple, and its result has to be sent
+        back into the generator. The final result is yielded as ('return', request).
+        @param {Request} request The request to translate
+        @param {Vector} targetVector The target state vector
+        '''
         if isinstance(request, UndoRequest) or isinstance(request, RedoRequest):
             '''If we're dealing with an undo or redo request, we first try to see
             whether a late mirror is possible. For this, we retrieve the
             associated request to this undo/redo and see whether it can be
             translated and then mirrored to the desired state.
             '''
-            assocReq = request.associatedRequest(self.log)        
+            assocReq = self.associatedRequest(request)
             '''The state we're trying to mirror at corresponds to the target
             vector, except the component of the issuing user is changed to
             match the one from the associated request.
             '''
-            mirrorAt = targetVector.copy()
-            #usermod mirrorAt[request.user]
-            #mirrorAt.users[str(request.user)] = assocReq.vector.get(request.user)     
-            #users
-            found = False
-            for index, _user in enumerate(mirrorAt.users):
-                if _user['id'] == request.user:
-                    found = True
-                    mirrorAt.users[index]['op'] = assocReq.vector.get(request.user)   
-            if not found:
-                mirrorAt.users.append({'id':_user['id'],'op': assocReq.vector.get(request.user)})
-            
-
-                
+            mirrorAt = targetVector.incr(request.user, assocReq.vector.get(request.user) - targetVector.get(request.user))
             if self.reachable(mirrorAt):
-                translated = self.translate(assocReq, mirrorAt)
+                if self.metrics != None:
+                    self.metrics.incr('translate.mirror')
+                translated = (yield ('translate', assocReq, mirrorAt))
                 mirrorBy = targetVector.get(request.user) - mirrorAt.get(request.user)
                 mirrored = translated.mirror(mirrorBy)
-                return mirrored    
+                yield ('return', mirrored)
+                return
             #If mirrorAt is not reachable, we need to mirror earlier and then
             #perform a translation afterwards, which is attempted next.
             
-        for index, _user in enumerate(self.vector.users):
+        for user, op in self.vector.items():
             #We now iterate through all users to see how we can translate the request to the desired state. 
             #The request's issuing user is left out since it is not possible to transform or fold a request along its own user
-            if _user['id'] == request.user:
+            if user == request.user:
                 continue
             #We can only transform against requests that have been issued
             #between the translated request's vector and the target vector.
             #PROBLABLY HERE
-            if targetVector.get(_user['id']) <= request.vector.get(_user['id']): 
+            if targetVector.get(user) <= request.vector.get(user): 
                 continue 
             #Fetch the last request by this user that contributed to the current state vector.
-            lastRequest = self.requestByUser(_user['id'], targetVector.get(_user['id']) - 1) 
+            lastRequest = self.requestByUser(user, targetVector.get(user) - 1) 
             if isinstance(lastRequest, UndoRequest) or isinstance(lastRequest, RedoRequest):
                 #When the last request was an undo/redo request, we can try to
                 #"fold" over it. By just skipping the do/undo or undo/redo pair,
                 #we pretend that nothing has changed and increase the state vector.             
-                foldBy = targetVector.get(_user['id']) - lastRequest.associatedRequest(self.log).vector.get(_user['id'])            
-                if(targetVector.get(_user['id']) >= foldBy):
-                    foldAt = targetVector.incr(_user['id'], -foldBy)                
+                foldBy = targetVector.get(user) - self.associatedRequest(lastRequest).vector.get(user)
+                if(targetVector.get(user) >= foldBy):
+                    foldAt = targetVector.incr(user, -foldBy)                
                     #We need to make sure that the state we're trying to fold at is reachable and that the request 
                     #we're translating was issued before it.                
                     if self.reachable(foldAt) and request.vector.causallyBefore(foldAt):
-                        translated = self.translate(request, foldAt)
-                        folded = translated.fold(_user['id'], foldBy)                    
-                        return folded
+                        if self.metrics != None:
+                            self.metrics.incr('translate.fold')
+                        translated = (yield ('translate', request, foldAt))
+                        folded = translated.fold(user, foldBy)                    
+                        yield ('return', folded)
+                        return
             #If folding and mirroring is not possible, we can transform this
             #request against other users' requests that have contributed to
             #the current state vector. 
-            transformAt = targetVector.incr(_user['id'], -1)
-            if transformAt.get(_user['id']) >= 0 and self.reachable(transformAt):
-                lastRequest = self.requestByUser(_user['id'], transformAt.get(_user['id']))    
-                r1 = self.translate(request, transformAt)
-                r2 = self.translate(lastRequest, transformAt)  
+            transformAt = targetVector.incr(user, -1)
+            if transformAt.get(user) >= 0 and self.reachable(transformAt):
+                if self.metrics != None:
+                    self.metrics.incr('translate.transform')
+                lastRequest = self.requestByUser(user, transformAt.get(user))    
+                r1 = (yield ('translate', request, transformAt))
+                r2 = (yield ('translate', lastRequest, transformAt))  
                 cid_req = None
                 if r1.operation.requiresCID:
                     #For the Insert operation, we need to check whether it is
@@ -1111,9 +2199,11 @@ class State(object):
                         #The first try is to transform both requests to a
                         #common successor before the transformation vector.
                         lcs = Vector.leastCommonSuccessor(request.vector, lastRequest.vector)                    
+                        if self.metrics != None:
+                            self.metrics.incr('translate.lcs')
                         if self.reachable(lcs):
-                            r1t = self.translate(request, lcs)
-                            r2t = self.translate(lastRequest, lcs)
+                            r1t = (yield ('translate', request, lcs))
+                            r2t = (yield ('translate', lastRequest, lcs))
                             #We try to determine the CID at this vector, which
                             #hopefully yields a result.
                             cidt = r1t.operation.cid(r2t.operation)                        
@@ -1127,6 +2217,8 @@ class State(object):
                             #requests to decide which request is to be
                             #transformed. This behavior is specified in the
                             #Infinote protocol.        
+                            if self.metrics != None:
+                                self.metrics.incr('translate.userid')
                             if r1.user < r2.user:
                                 cid = r1.operation
                             if r1.user > r2.user:
@@ -1135,15 +2227,69 @@ class State(object):
                         cid_req = r1
                     if cid == r2.operation:
                         cid_req = r2    
-                return r1.transform(r2, cid_req)
+                yield ('return', r1.transform(r2, cid_req))
+                return
         raise Exception('Could not find a translation path')
 
 
+    def acknowledge(self, user, vector):
+        '''Records the state vector that a user has acknowledged, i.e. the state
+        up to which that user has received and executed all requests. Users
+        acknowledge implicitly whenever one of their requests is executed.
+        @param {Number} user
+        @param {Vector} vector
+        '''
+        self.acknowledged[user] = vector
+        if self.cache != None:
+            self.cache.invalidate(self.minimalVector())
+
+
+    def leave(self, user):
+        '''Stops tracking the acknowledged state of a user that has disconnected.
+        @param {Number} user
+        '''
+        if user in self.acknowledged:
+            del self.acknowledged[user]
+            if self.cache != None:
+                self.cache.invalidate(self.minimalVector())
+
+
+    def minimalVector(self):
+        '''Returns the least state vector that all connected users have
+        acknowledged.
+        @type Vector
+        '''
+        result = None
+        for vector in self.acknowledged.values():
+            if result == None:
+                result = vector
+            else:
+                result = Vector.leastCommonPredecessor(result, vector)
+        if result == None:
+            return Vector()
+        return result
+
+
+    def getQueueStats(self):
+        '''Returns the depth and wait time metrics of the request queue.
+        @type dict
+        '''
+        return self.request_queue.getStats()
+
+
+    def getCacheStats(self):
+        '''Returns the translation cache counters, or None if caching is disabled.
+        @type dict
+        '''
+        if self.cache != None:
+            return self.cache.getStats()
+
+
     def queue(self, request):
         '''Adds a request to the request queue.
         @param {Request} request The request to be queued.
         '''
-        self.request_queue.append(request)
+        self.request_queue.push(request, self.vector)
         
 
     def canExecute(self, request = None): 
@@ -1152,10 +2298,13 @@ class State(object):
         '''
         if request == None: 
             return False
+        if not request.vector.causallyBefore(self.vector):
+            return False
         if isinstance(request, UndoRequest) or isinstance(request, RedoRequest):
-            return request.associatedRequest(self.log) != None
-        else:
-            return request.vector.causallyBefore(self.vector)
+            #Undo and redo requests also wait for their user's earlier
+            #requests, or the undo stack would give the wrong request.
+            return self.associatedRequest(request) != None
+        return True
             
 
     def execute(self, request = None):   
@@ -1167,42 +2316,35 @@ class State(object):
         '''
         if request == None:
             #Pick an executable request from the queue.
-            #for (index = 0 ++ loop)
-            for index, value in enumerate(self.request_queue):
-                request = self.request_queue[index]
-                if self.canExecute(request):
-                    self.request_queue.splice(index, 1)
-                    break
+            request = self.request_queue.pop(self)
         if not self.canExecute(request):
             #Not executable yet - put it (back) in the queue.
             if request != None:
                 self.queue(request)        
             return
         
+        if isinstance(request, DoRequest) and not self.base.causallyBefore(request.vector):
+            raise Exception('Request was issued before the collected part of the history')
+        self.acknowledge(request.user, request.vector)
+        assocReq = self.associatedRequest(request)
         request = request.copy()
         if isinstance(request, UndoRequest) or isinstance(request, RedoRequest):
             #For undo and redo requests, we change their vector to the vector
             #of the original request, but leave the issuing user's component untouched.
-            assocReq = request.associatedRequest(self.log)
-            newVector = Vector(assocReq.vector)
-            #newVector[request.user]
-            found = False
-            for index, _user in enumerate(newVector.users):
-                if _user['id'] == request.user:
-                    found = True
-                    newVector.users[index]['op'] = request.vector.get(request.user)
-            if not found:
-                newVector.users.append({'id':request.user,'op':request.vector.get(request.user)})
+            newVector = assocReq.vector.incr(request.user, request.vector.get(request.user) - assocReq.vector.get(request.user))
             request.vector = newVector
         translated = self.translate(request, self.vector)
         if isinstance(request, DoRequest) and isinstance(request.operation, Delete):
             #Since each request might have to be mirrored at some point, it
             #needs to be reversible. Delete requests are not reversible by
             #default, but we can make them reversible.
-            self.log.append(request.makeReversible(translated, self))
-        else:
-            self.log.append(request);
+            request = request.makeReversible(translated, self)
+        self.log.append(request)
+        self.userLog.setdefault(request.user, []).append(request)
+        self.pushUndo(request, assocReq)
         translated.execute(self)
+        if self.request_queue.entries:
+            self.request_queue.advance(request.user, self.vector)
     
         try:
             getattr(self, 'onexecute')  
@@ -1214,13 +2356,125 @@ class State(object):
         return translated
 
     
+    def iterBatch(self, requests):
+        '''Executes a burst of requests, yielding each request together with its
+        translated version as soon as it has been executed. Requests are
+        executed in causal order regardless of the order they are given in;
+        those that cannot be executed yet are queued. All translations in the
+        batch go through one cache, even if caching is disabled for this
+        state.
+        @param {Array} requests
+        '''
+        cache = self.cache
+        if cache == None:
+            self.cache = TranslationCache(None)
+        try:
+            batch = RequestQueue()
+            for request in requests:
+                batch.push(request, self.vector)
+            request = batch.pop(self)
+            while request != None:
+                yield (request, self.execute(request))
+                batch.advance(request.user, self.vector)
+                request = batch.pop(self)
+            for request in batch:
+                self.queue(request)
+        finally:
+            self.cache = cache
+
+
+    def executeBatch(self, requests):
+        '''Executes a burst of requests. See iterBatch.
+        @param {Array} requests
+        @returns The executed requests, translated to the state they were
+        applied at, in execution order.
+        @type Array
+        '''
+        return [translated for request, translated in self.iterBatch(requests)]
+
+
     def executeAll(self):
         '''Executes all queued requests that are ready for execution.'''  
         executed = self.execute()
         while executed:
             executed = self.execute()
+
+
+    def changesSince(self, since, until = None):
+        '''Returns the edits that take a document from one state to another,
+        so that a client can catch up without fetching the whole text. The
+        requests in the log that until includes and since does not are
+        translated in log order, each one to the state that the ones before
+        it lead to.
+        @param {Vector} since The state the document is at.
+        @param {Vector} [until] The state to go to, by default the current
+        state.
+        @returns The translated requests, to be executed one after another.
+        @type Array
+        '''
+        if until == None:
+            until = self.vector
+        if not since.causallyBefore(until):
+            raise Exception('State %s does not lead to %s' % (since.toString(), until.toString()))
+        if not self.base.causallyBefore(since):
+            raise Exception('State %s is before the collected part of the history' % since.toString())
+        for vector in (since, until):
+            if not self.reachable(vector):
+                raise Exception('State %s is not reachable' % vector.toString())
+        changes = []
+        current = since
+        for request in self.log:
+            #Log requests are numbered per user by their own vector component.
+            index = request.vector.get(request.user)
+            if since.get(request.user) <= index < until.get(request.user):
+                changes.append(self.translate(request, current))
+                current = current.incr(request.user)
+        return changes
             
     
+    def associatedRequest(self, request):
+        '''Finds the request an undo or redo request reverts: the DoRequest
+        or RedoRequest an undo undoes, or the UndoRequest a redo redoes. For
+        requests in the log this is the request they were paired with when
+        they were executed, for new requests it is the top of the issuing
+        user's undo or redo stack.
+        @param {Request} request
+        @type Request
+        '''
+        assocReq = self.pairs.get(request)
+        if assocReq != None:
+            return assocReq
+        if isinstance(request, UndoRequest):
+            stack = self.undoStack.get(request.user)
+        elif isinstance(request, RedoRequest):
+            stack = self.redoStack.get(request.user)
+        else:
+            return None
+        if stack:
+            return stack[-1]
+
+
+    def pushUndo(self, request, assocReq = None):
+        '''Updates the undo and redo stacks for a request that has been added
+        to the log.
+        @param {Request} request
+        @param {Request} [assocReq] The request an undo or redo request reverts.
+        '''
+        user = request.user
+        if isinstance(request, DoRequest):
+            self.undoStack.setdefault(user, []).append(request)
+            #A new edit discards everything its user could have redone.
+            self.redoStack.pop(user, None)
+        elif isinstance(request, UndoRequest):
+            self.undoStack[user].pop()
+            self.redoStack.setdefault(user, []).append(request)
+            self.pairs[request] = assocReq
+        else:
+            self.redoStack[user].pop()
+            self.undoStack.setdefault(user, []).append(request)
+            self.pairs[request] = assocReq
+
+
     def reachable(self, vector):
         '''Determines whether a given state is reachable by translation.
         @param {Vector} vector
@@ -1234,7 +2488,9 @@ class State(object):
     def reachableUser(self, vector, user):
         n = vector.get(user)    
         while True:
-            if n == 0:
+            if n <= self.base.get(user):
+                #Requests before the collected part of the history have been
+                #acknowledged by everyone, so their states are reachable.
                 return True        
             r = self.requestByUser(user, n - 1) 
             if r == None:
@@ -1244,7 +2500,7 @@ class State(object):
                 w = r.vector
                 return w.causallyBefore(vector)
             else:
-                assocReq = r.associatedRequest(self.log)
+                assocReq = self.associatedRequest(r)
                 n = assocReq.vector.get(user)
 
 
@@ -1253,13 +2509,103 @@ class State(object):
         @param {Number} user
         @param {Number} index The number of the request to be returned
         '''
-        userReqCount = 0
-        for reqIndex, request in enumerate(self.log):
-            if self.log[reqIndex].user == user:
-                if(userReqCount == getIndex):
-                    return self.log[reqIndex]
-                else: 
-                    userReqCount += 1
+        if self.metrics != None:
+            self.metrics.incr('requestByUser')
+        requests = self.userLog.get(user)
+        getIndex -= self.base.get(user)
+        if requests != None and 0 <= getIndex < len(requests):
+            return requests[getIndex]
+
+
+    def collectGarbage(self, undoDepth = None):
+        '''Removes requests from the log that can no longer be concurrent with
+        any future request. A request can be removed once every connected user
+        has acknowledged it, as long as no request that remains in the log
+        (including the last undoDepth requests of each user, which are kept
+        undoable) has to be translated across it. Removed requests are folded
+        into the base vector of the state.
+        @param {Number} [undoDepth] Overrides the undo depth of this state.
+        @returns The number of removed log entries and an estimate of the
+        memory they occupied.
+        @type dict
+        '''
+        if undoDepth == None:
+            undoDepth = self.undoDepth
+        reclaimed = {'entries': 0, 'bytes': 0}
+        if undoDepth == None or not self.acknowledged:
+            return reclaimed
+        horizon = Vector.leastCommonPredecessor(self.minimalVector(), self.vector)
+        pending = []
+        for requests in self.userLog.values():
+            if undoDepth > 0:
+                pending.extend(requests[-undoDepth:])
+        #Every request that stays in the log may have to be translated, which
+        #requires all requests it was concurrent with. Lower the horizon until
+        #it covers them.
+        kept = {}
+        while True:
+            while pending:
+                request = pending.pop()
+                horizon = Vector.leastCommonPredecessor(horizon, request.vector)
+                if isinstance(request, UndoRequest) or isinstance(request, RedoRequest):
+                    assocReq = self.associatedRequest(request)
+                    if assocReq != None:
+                        pending.append(assocReq)
+            for user, requests in self.userLog.items():
+                start = max(horizon.get(user) - self.base.get(user), 0)
+                pending.extend(requests[start:kept.get(user, len(requests))])
+                kept[user] = start
+            if not pending:
+                break
+        dropped = set()
+        for user, requests in self.userLog.items():
+            count = kept[user]
+            if count > 0:
+                dropped.update(requests[:count])
+                self.userLog[user] = requests[count:]
+                self.base = self.base.incr(user, count)
+        if not dropped:
+            return reclaimed
+        self.log = [request for request in self.log if request not in dropped]
+        for stacks in (self.undoStack, self.redoStack):
+            for user, stack in stacks.items():
+                stacks[user] = [request for request in stack if request not in dropped]
+        for request in dropped:
+            self.pairs.pop(request, None)
+        if self.cache != None:
+            self.cache.discard(dropped)
+        reclaimed['entries'] = len(dropped)
+        seen = set()
+        for request in dropped:
+            reclaimed['bytes'] += self.sizeOf(request, seen)
+        return reclaimed
+
+
+    @classmethod
+    def sizeOf(self, value, seen = None):
+        '''Estimates the memory occupied by a request, including its vector,
+        operation and buffers.
+        @param value
+        @param {set} [seen] Identities of objects that have already been counted.
+        @type Number
+        '''
+        if seen == None:
+            seen = set()
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+        if isinstance(value, (list, tuple, set)):
+            for item in value:
+                size += self.sizeOf(item, seen)
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                size += self.sizeOf(key, seen) + self.sizeOf(item, seen)
+        elif isinstance(value, Vector):
+            size += self.sizeOf(value._values, seen)
+        elif hasattr(value, '__dict__'):
+            size += self.sizeOf(value.__dict__, seen)
+        return size
 
 
 class Segment(object):
@@ -1278,8 +2624,16 @@ class Segment(object):
 
 
     def toHTML(self):
-        text = self.text.replace("<", "&lt;").replace(">", "&gt;").replace("&", "&amp;")
-        return '<span class="segment user-' + str(self.user) + '">' + text + '</span>'
+        return '<span class="segment user-' + str(self.user) + '">' + self.escape(self.text) + '</span>'
+
+
+    @staticmethod
+    def escape(text):
+        '''Escapes the characters of a text that are special in HTML. The
+        ampersand goes first, so the entities of the others stay intact.
+        @type String
+        '''
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 
     def copy(self):
@@ -1295,13 +2649,60 @@ class Buffer(object):
     segments.
     @param {Array} [segments] The segments that this buffer should be
     pre-filled with.
-    @class Holds multiple Segments and provides methods for modifying them at a character level.
+    @class Holds the text of a document together with the users who wrote it
+    and provides methods for modifying them at a character level. The text is
+    kept in one string, and who wrote it as runs of (length, user) pairs in
+    which adjacent runs always have different users. Neither is ever changed
+    in place: splice builds a new run list, so copies share the text and runs
+    of their original until one of them is modified, and copy() takes
+    constant time.
     '''
+    #Receives the number of runs each splice walks, see State.setMetrics.
+    metrics = None
+    #The rendered HTML of every run once the buffer has been rendered. Like
+    #the runs it is replaced rather than changed, and splice re-renders only
+    #the runs it touches.
+    html = None
+    #The number of characters written by each user once they have been
+    #asked for. Splice replaces it with an updated copy.
+    authors = None
+    #The RunIndex of the runs once the attribution has been looked up.
+    #Splice replaces it with an updated index that shares the unchanged runs.
+    attribution = None
+
     def __init__(self, segments = None):
-        self.segments = []    
+        self.text = ''
+        self.runs = []
         if segments != None:
+            runs = []
             for segment in segments:
-                self.segments.append(segment.copy())
+                self.appendRun(runs, len(segment.text), segment.user)
+            self.text = ''.join([segment.text for segment in segments])
+            self.runs = runs
+
+
+    @classmethod
+    def fromRuns(self, text, runs):
+        '''Creates a buffer that shares the given text and runs, which must
+        not be modified afterwards.
+        @type Buffer
+        '''
+        result = Buffer.__new__(Buffer)
+        result.text = text
+        result.runs = runs
+        return result
+
+
+    @staticmethod
+    def appendRun(runs, length, user):
+        #Appends a run to a run list that is being built, merging it with the
+        #last run if that has the same user.
+        if length == 0:
+            return
+        if runs and runs[-1][1] == user:
+            runs[-1] = (runs[-1][0] + length, user)
+        else:
+            runs.append((length, user))
 
 
     def __repr__(self):
@@ -1309,44 +2710,76 @@ class Buffer(object):
         
 
     def toString(self):
-        output = ''
-        for segment in self.segments:
-            output +=segment.toString()
-        return output
+        return self.text
 
 
     def toHTML(self):
-        result = '<span class="buffer">'
-        #for index ++ loop
-        for index in enumerate(self.segments):
-            result += self.segments[index].toHTML()
-        result += '</span>'
+        return ''.join(self.iterHTML())
+
+
+    def iterHTML(self, chunkSize = 65536):
+        '''Renders this buffer as HTML with a span per run, for streaming
+        large documents. Runs that have not been rendered before are rendered
+        as they are reached and cached, unless the buffer changes meanwhile.
+        @param {Number} [chunkSize] The size in characters from which on a
+        chunk is yielded. A single run is never cut into several chunks.
+        @returns A generator of chunks, which joined together are the HTML.
+        '''
+        text = self.text
+        runs = self.runs
+        html = self.html
+        rendered = []
+        chunk = ['<span class="buffer">']
+        size = 0
+        offset = 0
+        for index, (length, user) in enumerate(runs):
+            if html != None:
+                piece = html[index]
+            else:
+                piece = Segment(user, text[offset:offset + length]).toHTML()
+                rendered.append(piece)
+            offset += length
+            chunk.append(piece)
+            size += len(piece)
+            if size >= chunkSize:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if html == None and self.runs is runs:
+            self.html = rendered
+        chunk.append('</span>')
+        yield ''.join(chunk)
+
+
+    @property
+    def segments(self):
+        '''The segments of this buffer, one per run. The segments are new
+        objects; changing them does not change the buffer.
+        @type Array
+        '''
+        result = []
+        offset = 0
+        for length, user in self.runs:
+            result.append(Segment(user, self.text[offset:offset + length]))
+            offset += length
         return result
 
 
     def copy(self):
-        '''Creates a deep copy of this buffer.
+        '''Creates a copy of this buffer. The copy shares the text and runs of
+        this buffer, which are replaced rather than modified by splice.
         @type Buffer
         '''
-        return self.slice(0)
+        result = Buffer.fromRuns(self.text, self.runs)
+        result.html = self.html
+        result.authors = self.authors
+        result.attribution = self.attribution
+        return result
 
 
     def compact(self):
-        '''Cleans up the buffer by removing empty segments and combining adjacent
-        segments by the same user.
-        '''
-        segmentIndex = 0;
-        while segmentIndex < len(self.segments):
-            if len(self.segments[segmentIndex].text) == 0:
-                #This segment is empty, remove it.
-                self.segments.splice(segmentIndex, 1)
-                continue
-            elif segmentIndex < len(self.segments) - 1 and self.segments[segmentIndex].user == self.segments[segmentIndex+1].user:
-                #Two consecutive segments are from the same user; merge them into one.            
-                self.segments[segmentIndex].text += self.segments[segmentIndex+1].text
-                self.segments.pop(segmentIndex+1)
-                continue            
-            segmentIndex += 1;
+        '''Does nothing; runs by the same user are combined on each splice.'''
+        pass
 
 
     def getLength(self):
@@ -1354,15 +2787,37 @@ class Buffer(object):
         @returns Total character count in this buffer
         @type Number
         '''
-        length = 0;
-        # for index++ loop
-        for segment in self.segments:
-            length += len(segment.text)    
-        return length
+        return len(self.text)
+
+
+    def locate(self, index):
+        '''Finds the run holding the character at index, walking from the
+        nearer end of the buffer.
+        @returns The index of the run and the offset at which it starts. For
+        the end of the buffer, this is the number of runs and the length.
+        @type tuple
+        '''
+        runs = self.runs
+        length = len(self.text)
+        if index >= length:
+            return (len(runs), length)
+        if index < length // 2:
+            run = 0
+            offset = 0
+            while offset + runs[run][0] <= index:
+                offset += runs[run][0]
+                run += 1
+            return (run, offset)
+        run = len(runs) - 1
+        offset = length - runs[run][0]
+        while offset > index:
+            run -= 1
+            offset -= runs[run][0]
+        return (run, offset)
 
 
     def slice(self, begin, end = None):
-        '''Extracts a deep copy of a range of characters in this buffer and returns
+        '''Extracts a copy of a range of characters in this buffer and returns
         it as a new Buffer object.
         @param {Number} begin Index of first character to return
         @param {Number} [end] Index of last character (exclusive). If not
@@ -1370,27 +2825,740 @@ class Buffer(object):
         @returns New buffer containing the specified character range.
         @type Buffer
         '''
-        result = Buffer()    
-        segmentIndex = 0
-        segmentOffset = 0
-        sliceBegin = begin
-        sliceEnd = end    
-        if sliceEnd == None:
-            sliceEnd = sys.maxint 
-        while segmentIndex < len(self.segments) and sliceEnd >= segmentOffset:
-            segment = self.segments[segmentIndex]
-            if sliceBegin - segmentOffset < len(segment.text) and sliceEnd - segmentOffset > 0:
-                #segment.text.slice => self.slice
-                newText = segment.text[sliceBegin - segmentOffset:sliceEnd - segmentOffset]
-                newSegment = Segment(segment.user, newText)
-                result.segments.append(newSegment)                
-                sliceBegin += len(newText)
-            segmentOffset += len(segment.text)
-            segmentIndex += 1
-        result.compact()
+        length = len(self.text)
+        if end == None or end > length:
+            end = length
+        if begin <= 0 and end == length:
+            return self.copy()
+        if begin >= end:
+            return Buffer()
+        first, offset = self.locate(begin)
+        runs = []
+        run = first
+        while offset < end:
+            runLength, user = self.runs[run]
+            runs.append((min(offset + runLength, end) - max(offset, begin), user))
+            offset += runLength
+            run += 1
+        return Buffer.fromRuns(self.text[begin:end], runs)
+
+
+    def splice(self, index, remove, insert = None):
+        '''Like the Array "splice" method, this method allows for removing and
+        inserting text in a buffer at a character level.
+        @param {Number} index    The offset at which to begin inserting/removing
+        @param {Number} [remove] Number of characters to remove
+        @param {Buffer} [insert] Buffer to insert
+        '''
+        length = len(self.text)
+        if index > length:
+            raise BufferSpliceError('Buffer splice operation out of bounds')
+        end = min(index + remove, length)
+        first, firstOffset = self.locate(index)
+        last, lastOffset = self.locate(end)
+        runs = self.runs[:first]
+        if index > firstOffset:
+            runs.append((index - firstOffset, self.runs[first][1]))
+        text = self.text[:index]
+        if isinstance(insert, Buffer):
+            if isinstance(insert, TreeBuffer):
+                insert = Buffer(insert.segments)
+            if insert.runs:
+                self.appendRun(runs, insert.runs[0][0], insert.runs[0][1])
+                runs.extend(insert.runs[1:])
+            text += insert.text
+        if last < len(self.runs):
+            self.appendRun(runs, lastOffset + self.runs[last][0] - end, self.runs[last][1])
+            runs.extend(self.runs[last + 1:])
+        self.text = text + self.text[end:]
+        if self.html != None:
+            self.html = self.rerender(runs, first, firstOffset, last)
+        if self.authors != None:
+            self.authors = self.recount(first, firstOffset, index, end, insert)
+        if self.attribution != None:
+            self.attribution = self.reindex(runs, first, firstOffset, last)
+        self.runs = runs
+        if self.metrics != None:
+            self.metrics.observe('buffer.splice.segments', min(first, len(self.runs) - last) + 1)
+
+
+    def changedRuns(self, runs, first, firstOffset, last):
+        #For a splice that has replaced the runs from first to last (inclusive)
+        #of the old run list, which is still self.runs, by the new run list
+        #runs, returns the number of unchanged runs at the start, the offset of
+        #the first changed run, and the number of unchanged runs at the end.
+        suffix = 0
+        if last < len(self.runs):
+            suffix = len(self.runs) - last - 1
+        keep = first
+        offset = firstOffset
+        if first > 0 and runs[first - 1] != self.runs[first - 1]:
+            #The run before the splice has been merged with the new text.
+            keep -= 1
+            offset -= self.runs[first - 1][0]
+        return (keep, offset, suffix)
+
+
+    def rerender(self, runs, first, firstOffset, last):
+        #Updates the rendered runs for a splice, see changedRuns.
+        keep, offset, suffix = self.changedRuns(runs, first, firstOffset, last)
+        middle = []
+        for length, user in runs[keep:len(runs) - suffix]:
+            middle.append(Segment(user, self.text[offset:offset + length]).toHTML())
+            offset += length
+        return self.html[:keep] + middle + self.html[len(self.html) - suffix:]
+
+
+    def reindex(self, runs, first, firstOffset, last):
+        #Updates the attribution index for a splice, see changedRuns.
+        keep, _offset, suffix = self.changedRuns(runs, first, firstOffset, last)
+        return self.attribution.replace(keep, len(self.runs) - suffix, runs[keep:len(runs) - suffix])
+
+
+    def recount(self, run, offset, begin, end, insert):
+        #Updates the character counts of the users for a splice that has
+        #replaced the characters from begin to end, the first of which is in
+        #the run starting at offset, by the buffer insert.
+        authors = dict(self.authors)
+        while offset < end:
+            length, user = self.runs[run]
+            self.countAuthor(authors, user, max(offset, begin) - min(offset + length, end))
+            offset += length
+            run += 1
+        if isinstance(insert, Buffer):
+            for segment in insert.segments:
+                self.countAuthor(authors, segment.user, len(segment.text))
+        return authors
+
+
+    @staticmethod
+    def countAuthor(authors, user, length):
+        #Adds length characters to the count of a user, dropping users
+        #without characters.
+        count = authors.get(user, 0) + length
+        if count:
+            authors[user] = count
+        else:
+            authors.pop(user, None)
+
+
+    def getAuthors(self):
+        '''Counts the characters written by each user. The counts are kept
+        up to date by splice once they have been asked for.
+        @returns A dict of character counts by user.
+        @type dict
+        '''
+        if self.authors == None:
+            authors = {}
+            for length, user in self.runs:
+                self.countAuthor(authors, user, length)
+            self.authors = authors
+        return dict(self.authors)
+
+
+    def getIndex(self):
+        '''Returns the attribution index of this buffer. It is built when it
+        is first asked for and kept up to date by splice from then on.
+        @type RunIndex
+        '''
+        if self.attribution == None:
+            self.attribution = RunIndex(self.runs)
+        return self.attribution
+
+
+    def authorAt(self, offset):
+        '''Returns the user who wrote the character at offset.
+        @param {Number} offset
+        '''
+        if offset < 0 or offset >= self.getLength():
+            raise BufferSpliceError('Buffer offset out of bounds')
+        return self.getIndex().authorAt(offset)
+
+
+    def getUserRuns(self, user):
+        '''Returns the ranges written by a user.
+        @returns An array of (offset, length) pairs in document order.
+        @type Array
+        '''
+        return [(offset, length) for offset, length, author in self.getIndex().walk(0, self.getLength(), user)]
+
+
+    def getAttribution(self, begin = 0, end = None):
+        '''Returns who wrote each part of a range of characters, e.g. for a
+        blame view of the visible part of a document, or of the whole
+        document for analytics.
+        @param {Number} [begin] Index of first character
+        @param {Number} [end] Index of last character (exclusive). If not
+        provided, defaults to the total length of the buffer.
+        @returns An array of (offset, length, user) tuples in document order.
+        @type Array
+        '''
+        if end == None or end > self.getLength():
+            end = self.getLength()
+        result = []
+        for offset, length, user in self.getIndex().walk(begin, end):
+            start = max(offset, begin)
+            stop = min(offset + length, end)
+            if stop > start:
+                result.append((start, stop - start, user))
         return result
 
 
+class RunNode(object):
+    '''Creates a new node holding a run of a buffer.
+    @class A node of a RunIndex. Each node caches the number of runs, the
+    number of characters and the number of characters by each user in its
+    subtree. Nodes are never changed once they have been created.
+    '''
+    __slots__ = ('run', 'priority', 'left', 'right', 'count', 'length', 'authors')
+
+    def __init__(self, run, priority, left = None, right = None):
+        self.run = run
+        self.priority = priority
+        self.left = left
+        self.right = right
+        length, user = run
+        count = 1
+        authors = {user: length}
+        for child in (left, right):
+            if child != None:
+                length += child.length
+                count += child.count
+                for author, chars in child.authors.items():
+                    authors[author] = authors.get(author, 0) + chars
+        self.count = count
+        self.length = length
+        self.authors = authors
+
+
+class RunIndex(object):
+    '''Creates an index of an array of (length, user) runs.
+    @param {Array} [runs]
+    @class An order-statistics tree (a treap) over the runs of a Buffer, which
+    finds the run at an offset in logarithmic time and the runs of a user in
+    logarithmic time per run. Indices are never changed: replace returns a new
+    index that shares the nodes outside the replaced runs with the old one, so
+    copies of a buffer can keep sharing theirs.
+    '''
+    def __init__(self, runs = None, root = None):
+        if runs != None:
+            root = self.build(runs, 0, len(runs))[0]
+        self.root = root
+
+
+    @classmethod
+    def build(self, runs, begin, end):
+        #Builds a balanced tree of runs[begin:end] and returns it with its
+        #height. The priority of a node is its height plus a random fraction,
+        #which puts it above the priorities of its children.
+        if begin >= end:
+            return (None, 0)
+        middle = (begin + end) // 2
+        left, leftHeight = self.build(runs, begin, middle)
+        right, rightHeight = self.build(runs, middle + 1, end)
+        height = max(leftHeight, rightHeight) + 1
+        return (RunNode(runs[middle], height + random.random(), left, right), height)
+
+
+    @classmethod
+    def merge(self, left, right):
+        '''Concatenates two trees into a new one.
+        @type RunNode
+        '''
+        if left == None:
+            return right
+        if right == None:
+            return left
+        if left.priority > right.priority:
+            return RunNode(left.run, left.priority, left.left, self.merge(left.right, right))
+        return RunNode(right.run, right.priority, self.merge(left, right.left), right.right)
+
+
+    @classmethod
+    def split(self, node, count):
+        '''Splits a tree into two new ones, the first one holding the first
+        count runs.
+        @type Array
+        '''
+        if node == None:
+            return (None, None)
+        leftCount = 0
+        if node.left != None:
+            leftCount = node.left.count
+        if count <= leftCount:
+            left, right = self.split(node.left, count)
+            return (left, RunNode(node.run, node.priority, right, node.right))
+        left, right = self.split(node.right, count - leftCount - 1)
+        return (RunNode(node.run, node.priority, node.left, left), right)
+
+
+    def replace(self, begin, end, runs):
+        '''Returns a new index in which the runs from begin to end (exclusive)
+        have been replaced by the given runs.
+        @type RunIndex
+        '''
+        left, rest = self.split(self.root, begin)
+        removed, right = self.split(rest, end - begin)
+        middle = self.build(runs, 0, len(runs))[0]
+        return RunIndex(root = self.merge(self.merge(left, middle), right))
+
+
+    def authorAt(self, offset):
+        '''Returns the user of the run holding the character at offset.
+        @param {Number} offset
+        '''
+        node = self.root
+        while True:
+            if node.left != None:
+                if offset < node.left.length:
+                    node = node.left
+                    continue
+                offset -= node.left.length
+            if offset < node.run[0]:
+                return node.run[1]
+            offset -= node.run[0]
+            node = node.right
+
+
+    def walk(self, begin, end, user = None):
+        '''Iterates over the runs that overlap the range from begin to end
+        (exclusive) in document order, skipping the subtrees outside of it.
+        @param {Number} [user] Only yield the runs of this user, skipping the
+        subtrees without text by the user as well.
+        @returns A generator of (offset, length, user) tuples.
+        '''
+        stack = []
+        node = self.root
+        offset = 0
+        while stack or node != None:
+            while node != None and begin < offset + node.length and end > offset and (user == None or user in node.authors):
+                stack.append((node, offset))
+                node = node.left
+            if not stack:
+                break
+            node, offset = stack.pop()
+            if node.left != None:
+                offset += node.left.length
+            length, author = node.run
+            if begin < offset + length and end > offset and (user == None or author == user):
+                yield (offset, length, author)
+            offset += length
+            node = node.right
+
+
+class TreeNode(object):
+    '''Creates a new tree node holding a chunk of text written by a user.
+    @class A node of the treap used by TreeBuffer. Each node caches the
+    total length of the text in its subtree, the number of characters by each
+    user in it once they have been counted, and its text escaped for HTML
+    once the buffer has been rendered.
+    '''
+    __slots__ = ('user', 'text', 'priority', 'left', 'right', 'length', 'authors', 'html')
+
+    def __init__(self, user, text, priority = None):
+        self.user = user
+        self.text = text
+        if priority == None:
+            priority = random.random()
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.html = None
+        self.update()
+
+
+    def update(self):
+        '''Recalculates the cached subtree length of this node and drops its
+        counts, which are recounted when they are next asked for.'''
+        length = len(self.text)
+        if self.left != None:
+            length += self.left.length
+        if self.right != None:
+            length += self.right.length
+        self.length = length
+        self.authors = None
+
+
+    def getAuthors(self):
+        '''Returns the number of characters by each user in the subtree of
+        this node. Only the nodes changed since the counts were last asked
+        for are recounted, which after a splice are the nodes on its path.
+        @type dict
+        '''
+        if self.authors == None:
+            authors = {}
+            if self.text:
+                authors[self.user] = len(self.text)
+            for child in (self.left, self.right):
+                if child != None:
+                    for user, count in child.getAuthors().items():
+                        authors[user] = authors.get(user, 0) + count
+            self.authors = authors
+        return self.authors
+
+
+class TreeBuffer(Buffer):
+    '''
+    Creates a new TreeBuffer instance from the given array of
+    segments.
+    @param {Array} [segments] The segments that this buffer should be
+    pre-filled with.
+    @class A Buffer that keeps its text in a balanced tree (a treap) of
+    chunks, each written by a single user. Subtree lengths and character
+    counts by user are cached in the nodes, so splice, slice, getLength and
+    the attribution methods take logarithmic time in the number of chunks
+    instead of walking every segment. Chunks hold at most
+    chunkSize characters, which keeps splitting a chunk cheap even for large
+    single-author texts.
+    '''
+    chunkSize = 512
+    #The text of the buffer once toString has been called, until the next
+    #splice. Splices drop it rather than patching it, which would copy the
+    #whole document on every edit.
+    textCache = None
+
+    def __init__(self, segments = None):
+        self.root = None
+        if segments != None:
+            nodes = []
+            for segment in segments:
+                nodes.extend(self.chunks(segment.user, segment.text))
+            self.root = self.build(self.coalesce(nodes))
+
+
+    def chunks(self, user, text):
+        '''Cuts a text into new nodes of at most chunkSize characters.
+        @type Array
+        '''
+        return [TreeNode(user, text[i:i + self.chunkSize]) for i in range(0, len(text), self.chunkSize)]
+
+
+    def coalesce(self, nodes):
+        '''Combines adjacent detached nodes by the same user as long as the
+        result does not exceed the chunk size.
+        @param {Array} nodes
+        @type Array
+        '''
+        result = []
+        for node in nodes:
+            if len(node.text) == 0:
+                continue
+            if result and result[-1].user == node.user and len(result[-1].text) + len(node.text) <= self.chunkSize:
+                result[-1].text += node.text
+                result[-1].html = None
+                result[-1].update()
+            else:
+                result.append(node)
+        return result
+
+
+    @classmethod
+    def build(self, nodes):
+        '''Builds a tree from an array of detached nodes.
+        @type TreeNode
+        '''
+        root = None
+        for node in nodes:
+            root = self.merge(root, node)
+        return root
+
+
+    @classmethod
+    def merge(self, left, right):
+        '''Concatenates two trees.
+        @type TreeNode
+        '''
+        if left == None:
+            return right
+        if right == None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            left.update()
+            return left
+        right.left = self.merge(left, right.left)
+        right.update()
+        return right
+
+
+    @classmethod
+    def split(self, node, index):
+        '''Splits a tree into two trees, the first one holding exactly the first
+        index characters. A chunk that straddles the split offset is cut in two.
+        @type Array
+        '''
+        if node == None:
+            return (None, None)
+        leftLength = 0
+        if node.left != None:
+            leftLength = node.left.length
+        if index <= leftLength:
+            left, node.left = self.split(node.left, index)
+            node.update()
+            return (left, node)
+        index -= leftLength
+        if index >= len(node.text):
+            node.right, right = self.split(node.right, index - len(node.text))
+            node.update()
+            return (node, right)
+        #The offset lies inside this chunk. The second half inherits the
+        #priority so that it can take over the right subtree.
+        second = TreeNode(node.user, node.text[index:], node.priority)
+        second.right = node.right
+        second.update()
+        node.text = node.text[:index]
+        node.html = None
+        node.right = None
+        node.update()
+        return (node, second)
+
+
+    @classmethod
+    def popFirst(self, node):
+        '''Detaches the first node of a tree.
+        @returns The remaining tree and the detached node.
+        @type Array
+        '''
+        if node == None:
+            return (None, None)
+        if node.left == None:
+            rest = node.right
+            node.right = None
+            node.update()
+            return (rest, node)
+        node.left, first = self.popFirst(node.left)
+        node.update()
+        return (node, first)
+
+
+    @classmethod
+    def popLast(self, node):
+        '''Detaches the last node of a tree.
+        @returns The remaining tree and the detached node.
+        @type Array
+        '''
+        if node == None:
+            return (None, None)
+        if node.right == None:
+            rest = node.left
+            node.left = None
+            node.update()
+            return (rest, node)
+        node.right, last = self.popLast(node.right)
+        node.update()
+        return (node, last)
+
+
+    def nodes(self):
+        '''Iterates over all nodes in document order.'''
+        return self.walk(self.root)
+
+
+    @staticmethod
+    def walk(node):
+        '''Iterates over the nodes of a tree in document order.'''
+        stack = []
+        while stack or node != None:
+            while node != None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+
+    def getIndex(self):
+        '''Returns the attribution index of this buffer like Buffer.getIndex,
+        with adjacent chunks by the same user combined into one run. Splices
+        drop it rather than keeping it up to date; the attribution methods of
+        TreeBuffer use the counts in the tree instead.
+        @type RunIndex
+        '''
+        if self.attribution == None:
+            self.attribution = RunIndex([(len(segment.text), segment.user) for segment in self.segments])
+        return self.attribution
+
+
+    def getAuthors(self):
+        '''Counts the characters written by each user, from the counts cached
+        at the root of the tree.
+        @type dict
+        '''
+        if self.root == None:
+            return {}
+        return dict(self.root.getAuthors())
+
+
+    def getUserRuns(self, user):
+        '''Returns the ranges written by a user like Buffer.getUserRuns,
+        skipping the subtrees without text by the user.
+        @type Array
+        '''
+        result = []
+        stack = []
+        node = self.root
+        offset = 0
+        while stack or node != None:
+            while node != None and user in node.getAuthors():
+                stack.append((node, offset))
+                node = node.left
+            if not stack:
+                break
+            node, offset = stack.pop()
+            if node.left != None:
+                offset += node.left.length
+            if node.user == user:
+                if result and sum(result[-1]) == offset:
+                    result[-1] = (result[-1][0], result[-1][1] + len(node.text))
+                else:
+                    result.append((offset, len(node.text)))
+            offset += len(node.text)
+            node = node.right
+        return result
+
+
+    def authorAt(self, offset):
+        '''Returns the user who wrote the character at offset, descending the
+        tree rather than building the attribution index.
+        @param {Number} offset
+        '''
+        if offset < 0 or offset >= self.getLength():
+            raise BufferSpliceError('Buffer offset out of bounds')
+        node = self.root
+        while True:
+            if node.left != None:
+                if offset < node.left.length:
+                    node = node.left
+                    continue
+                offset -= node.left.length
+            if offset < len(node.text):
+                return node.user
+            offset -= len(node.text)
+            node = node.right
+
+
+    def getAttribution(self, begin = 0, end = None):
+        '''Returns who wrote each part of a range of characters like
+        Buffer.getAttribution, walking only the chunks in the range rather
+        than building the attribution index.
+        @type Array
+        '''
+        begin = max(begin, 0)
+        result = []
+        for length, user in self.slice(begin, end).runs:
+            result.append((begin, length, user))
+            begin += length
+        return result
+
+
+    @property
+    def segments(self):
+        '''The segments of this buffer, with adjacent chunks by the same user
+        combined.
+        @type Array
+        '''
+        result = []
+        for node in self.nodes():
+            if result and result[-1].user == node.user:
+                result[-1].text += node.text
+            else:
+                result.append(Segment(node.user, node.text))
+        return result
+
+
+    def toString(self):
+        if self.textCache == None:
+            self.textCache = ''.join([node.text for node in self.nodes()])
+        return self.textCache
+
+
+    def iterHTML(self, chunkSize = 65536):
+        '''Renders this buffer as HTML like Buffer.iterHTML. The escaped text
+        of every chunk is cached in its node, so only the chunks that splices
+        have changed are escaped again. The buffer must not be changed while
+        the chunks are consumed.
+        @param {Number} [chunkSize]
+        @returns A generator of chunks.
+        '''
+        chunk = ['<span class="buffer">']
+        size = 0
+        user = None
+        for node in self.nodes():
+            if node.html == None:
+                node.html = Segment.escape(node.text)
+            if user != node.user:
+                #Adjacent chunks by the same user share a span.
+                if user != None:
+                    chunk.append('</span>')
+                user = node.user
+                chunk.append('<span class="segment user-' + str(user) + '">')
+            chunk.append(node.html)
+            size += len(node.html)
+            if size >= chunkSize:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if user != None:
+            chunk.append('</span>')
+        chunk.append('</span>')
+        yield ''.join(chunk)
+
+
+    def copy(self):
+        '''Creates a deep copy of this buffer.
+        @type TreeBuffer
+        '''
+        return TreeBuffer(self.segments)
+
+
+    def compact(self):
+        '''Does nothing; TreeBuffer combines chunks locally on each splice.'''
+        pass
+
+
+    def getLength(self):
+        '''Returns the total number of characters contained in this buffer.
+        @type Number
+        '''
+        if self.root == None:
+            return 0
+        return self.root.length
+
+
+    def slice(self, begin, end = None):
+        '''Extracts a deep copy of a range of characters in this buffer and returns
+        it as a new Buffer object.
+        @param {Number} begin Index of first character to return
+        @param {Number} [end] Index of last character (exclusive). If not
+        provided, defaults to the total length of the buffer.
+        @returns New buffer containing the specified character range.
+        @type Buffer
+        '''
+        if end == None:
+            end = self.getLength()
+        segments = []
+        #Walk the tree in order, skipping subtrees outside of [begin, end).
+        stack = []
+        node = self.root
+        offset = 0
+        while stack or node != None:
+            while node != None and begin < offset + node.length and end > offset:
+                stack.append((node, offset))
+                node = node.left
+            if not stack:
+                break
+            node, offset = stack.pop()
+            start = offset
+            if node.left != None:
+                start += node.left.length
+            stop = start + len(node.text)
+            if begin < stop and end > start:
+                segments.append(Segment(node.user, node.text[max(begin - start, 0):end - start]))
+            node = node.right
+            offset = stop
+        return Buffer(segments)
+
+
     def splice(self, index, remove, insert = None):
         '''Like the Array "splice" method, this method allows for removing and
         inserting text in a buffer at a character level.
@@ -1400,81 +3568,22 @@ class Buffer(object):
         '''
         if index > self.getLength():
             raise BufferSpliceError('Buffer splice operation out of bounds')
-    
-        segmentIndex = 0
-        segmentOffset = 0
-        spliceIndex = index
-        spliceCount = remove
-        spliceInsertOffset = None
-        #segments.length => len(self.segments)
-        while segmentIndex < len(self.segments):
-            segment = self.segments[segmentIndex]            
-            if spliceIndex >= 0 and spliceIndex < len(segment.text):
-                #This segment is part of the region to splice.                
-                #Store the text that this splice operation removes to adjust the
-                #splice offset correctly later on.
-                #[:]SLICE
-                removedText = segment.text[spliceIndex:(spliceIndex + spliceCount)]
-                if spliceIndex == 0:
-                    #abcdefg
-                    #  ^        We're splicing at the beginning of a segment                    
-                    if spliceIndex + spliceCount < len(segment.text):
-                        #abcdefg
-                        #^---^    Remove a part at the beginning                        
-                        if spliceInsertOffset == None:
-                            spliceInsertOffset = segmentIndex
-                        #[:]SLICE 
-                        segment.text = segment.text[(spliceIndex + spliceCount):]
-                    else:
-                        #abcdefg
-                        #^-----^  Remove the entire segment                        
-                        if spliceInsertOffset == None:
-                            spliceInsertOffset = segmentIndex                        
-                        segment.text = ""
-                        # splice => pop
-                        self.segments.pop(segmentIndex)
-                        segmentIndex -= 1
-                else:
-                    #abcdefg
-                    #  ^      We're splicing inside a segment                
-                    if spliceInsertOffset == None:
-                        spliceInsertOffset = segmentIndex + 1
-                    
-                    if spliceIndex + spliceCount < len(segment.text):
-                        # abcdefg
-                        #   ^--^   Remove a part in between
-                        
-                        # Note that if spliceCount == 0, this function only
-                        # splits the segment in two. This is necessary in case we
-                        # want to insert new segments later.      
-                        #slice [:]
-                        splicePost = Segment(segment.user, segment.text[(spliceIndex + spliceCount):])
-                        #slice [:]
-                        segment.text = segment.text[0:spliceIndex]
-                        #splice (segmentIndex + 1, 0, splicePost) => list.insert(segmentIndex + 1, 0, splicePost)
-                        self.segments.insert(segmentIndex + 1, splicePost)
-                    else:
-                        # abcdefg
-                        #   ^---^  Remove a part at the end   
-                        #slice [:]
-                        segment.text = segment.text[0:spliceIndex]
-                spliceCount -= len(removedText)
-            
-            if spliceIndex < len(segment.text) and spliceCount == 0:
-                #We have removed the specified amount of characters. No need to
-                #continue this loop since nothing remains to be done.                
-                if spliceInsertOffset == None:
-                    spliceInsertOffset = spliceIndex                
-                break            
-            spliceIndex -= len(segment.text)
-            segmentIndex += 1
+        left, rest = self.split(self.root, index)
+        removed, right = self.split(rest, remove)
+        nodes = []
         if isinstance(insert, Buffer):
-            #If a buffer has been given, we insert copies of its segments at the specified position.            
-            if spliceInsertOffset == None:
-                spliceInsertOffset = len(self.segments)
-            #for insertIndex++ loop
-            for insertIndex, segment in enumerate(insert.segments):
-                #splice (spliceInsertOffset + insertIndex, 0, insert.segments[insertIndex].copy()) => insert
-                self.segments.insert(spliceInsertOffset + insertIndex, insert.segments[insertIndex].copy())        
-        #Clean up since the splice operation might have fragmented some segments.
-        self.compact()
+            for segment in insert.segments:
+                nodes.extend(self.chunks(segment.user, segment.text))
+        #Only the chunks around the splice offset can have become fragmented,
+        #so we combine those and leave the rest of the tree untouched.
+        left, last = self.popLast(left)
+        right, first = self.popFirst(right)
+        if last != None:
+            nodes.insert(0, last)
+        if first != None:
+            nodes.append(first)
+        if self.metrics != None:
+            self.metrics.observe('buffer.splice.segments', len(nodes))
+        self.attribution = None
+        self.root = self.merge(self.merge(left, self.build(self.coalesce(nodes))), right)
+        self.textCache = None
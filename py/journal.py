@@ -0,0 +1,176 @@
+'''
+Operation journals for InfinoteEditor.
+
+A journal stores the ["i", params], ["d", params] and ["u", params] entries
+that InfinoteEditor executes, in execution order. MemoryJournal keeps them in
+a list, FileJournal appends them to a file:
+
+    length   uint32, little-endian
+    payload  the entry as UTF-8 encoded JSON
+
+Writes are fsynced in batches. The file offset of every record is indexed
+when the journal is opened, so the tail of the journal can be read without
+loading the rest of it.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import os
+import json
+import struct
+
+RECORD = struct.Struct('<I')
+
+
+class JournalError(Exception):
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+class MemoryJournal(list):
+    '''@class A journal that keeps its entries in memory.'''
+
+    def tail(self, limit):
+        '''Returns the last limit entries.
+        @type Array
+        '''
+        if limit <= 0:
+            return []
+        return self[-limit:]
+
+
+    def read(self, start = 0):
+        '''Iterates over the entries from the given index onwards.'''
+        for index in range(start, len(self)):
+            yield self[index]
+
+
+    def sync(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class FileJournal(object):
+    '''Opens or creates a journal file.
+    @class A journal that appends length-prefixed entries to a file.
+    @param {String} path
+    @param {Number} [syncEvery] Number of appended entries after which the
+    file is fsynced. Entries appended since the last sync can be lost on a
+    crash; sync() forces them to disk.
+    '''
+    def __init__(self, path, syncEvery = 64):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.pending = 0
+        self.offsets = []
+        self.handle = open(path, 'a+b')
+        self.scan()
+
+
+    def scan(self):
+        '''Indexes the records in the file. A record that was only partially
+        written when the process died is cut off.
+        '''
+        handle = self.handle
+        handle.seek(0, os.SEEK_END)
+        size = handle.tell()
+        offset = 0
+        while offset + RECORD.size <= size:
+            handle.seek(offset)
+            length = RECORD.unpack(handle.read(RECORD.size))[0]
+            if offset + RECORD.size + length > size:
+                break
+            self.offsets.append(offset)
+            offset += RECORD.size + length
+        if offset < size:
+            handle.truncate(offset)
+            handle.flush()
+        self.end = offset
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __iter__(self):
+        return self.read(0)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get(i) for i in range(*index.indices(len(self.offsets)))]
+        if index < 0:
+            index += len(self.offsets)
+        if index < 0 or index >= len(self.offsets):
+            raise IndexError('journal index out of range')
+        return self.get(index)
+
+
+    def encode(self, entry):
+        payload = json.dumps(entry, separators = (',', ':'))
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        return RECORD.pack(len(payload)) + payload
+
+
+    def decode(self, payload):
+        try:
+            kind, params = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            raise JournalError('Corrupt journal record in %s' % self.path)
+        return [kind, tuple(params)]
+
+
+    def get(self, index):
+        '''Reads a single entry from the file.'''
+        self.handle.seek(self.offsets[index])
+        length = RECORD.unpack(self.handle.read(RECORD.size))[0]
+        return self.decode(self.handle.read(length))
+
+
+    def append(self, entry):
+        '''Appends an entry. The file is fsynced every syncEvery entries.'''
+        record = self.encode(entry)
+        #In append mode every write goes to the end of the file, but the
+        #position still has to be reset after reads.
+        self.handle.seek(0, os.SEEK_END)
+        self.handle.write(record)
+        self.offsets.append(self.end)
+        self.end += len(record)
+        self.pending += 1
+        if self.pending >= self.syncEvery:
+            self.sync()
+
+
+    def tail(self, limit):
+        '''Returns the last limit entries, read from disk.
+        @type Array
+        '''
+        if limit <= 0:
+            return []
+        return self[-limit:]
+
+
+    def read(self, start = 0):
+        '''Iterates over the entries from the given index onwards.'''
+        index = start
+        while index < len(self.offsets):
+            yield self.get(index)
+            index += 1
+
+
+    def sync(self):
+        '''Forces all appended entries to disk.'''
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.pending = 0
+
+
+    def close(self):
+        if not self.handle.closed:
+            self.sync()
+            self.handle.close()
@@ -0,0 +1,227 @@
+'''
+Instrumentation of py-infinote states.
+
+A State created with a Metrics object (or given one through setMetrics)
+reports what its hot paths do:
+
+    translate                  timing of every State.translate call
+    translate.calls            translate calls
+    translate.depth            the deepest translation stack of a call
+    translate.cache.hit/miss   translation cache lookups
+    translate.mirror           undo/redo requests translated by mirroring
+    translate.fold             translations that folded over a do/undo pair
+    translate.transform        transformations against a concurrent request
+    translate.lcs              CIDs looked up at the least common successor
+    translate.userid           CIDs decided by comparing user IDs
+    requestByUser              log lookups by user and request number
+    buffer.splice.segments     segments walked by each Buffer.splice
+
+Metrics tags everything with a document name and hands it to a sink: a
+CallbackSink, a HistogramSink that aggregates in memory, or a StatsdSink
+that writes statsd lines to a local socket. Without metrics the engine only
+pays for checking that State.metrics is None.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import math
+import socket
+
+COUNT = 'count'
+TIMING = 'timing'
+VALUE = 'value'
+
+
+class Metrics(object):
+    '''Instantiates a new metrics collector.
+    @class Reports the counters, timings and values of one document to a sink.
+    @param sink An object with an emit(document, kind, name, value) method.
+    @param [document] The name the metrics are reported under.
+    '''
+    def __init__(self, sink, document = None):
+        self.sink = sink
+        self.document = document
+
+
+    def incr(self, name, value = 1):
+        self.sink.emit(self.document, COUNT, name, value)
+
+
+    def timing(self, name, seconds):
+        self.sink.emit(self.document, TIMING, name, seconds)
+
+
+    def observe(self, name, value):
+        self.sink.emit(self.document, VALUE, name, value)
+
+
+class CallbackSink(object):
+    '''@class Calls a function with the document, kind, name and value of
+    every metric.
+    @param {function} callback
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+
+
+    def emit(self, document, kind, name, value):
+        self.callback(document, kind, name, value)
+
+
+class Histogram(object):
+    '''@class Aggregates values into logarithmic buckets, four per power of
+    two, so percentiles are accurate to within 19%.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+        if value > 0:
+            bucket = int(math.floor(math.log(value, 2) * 4))
+        else:
+            bucket = None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the given fraction of
+        the values, clamped to the largest value.
+        '''
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        #Values <= 0 sort before all others.
+        for bucket in sorted(self.buckets, key = lambda bucket: (bucket != None, bucket)):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket == None:
+                    return min(self.max, 0)
+                return min(self.max, 2 ** ((bucket + 1) / 4.0))
+        return self.max
+
+
+    def summary(self):
+        result = {'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+                  'mean': None}
+        if self.count:
+            result['mean'] = self.total / float(self.count)
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            result[name] = self.percentile(fraction)
+        return result
+
+
+class HistogramSink(object):
+    '''@class Keeps counters and histograms of timings and values in memory,
+    per document.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+    def emit(self, document, kind, name, value):
+        key = (document, name)
+        if kind == COUNT:
+            self.counters[key] = self.counters.get(key, 0) + value
+            return
+        histogram = self.histograms.get(key)
+        if histogram == None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(value)
+
+
+    def getStats(self, document = None):
+        '''Returns the counters and histogram summaries of a document by name.
+        Timings are in seconds.
+        @type dict
+        '''
+        stats = {}
+        for (owner, name), value in self.counters.items():
+            if owner == document:
+                stats[name] = value
+        for (owner, name), histogram in self.histograms.items():
+            if owner == document:
+                stats[name] = histogram.summary()
+        return stats
+
+
+    def documents(self):
+        '''Returns the documents that have reported metrics.'''
+        return set([key[0] for key in list(self.counters) + list(self.histograms)])
+
+
+    def clear(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+
+class StatsdSink(object):
+    '''Opens a datagram socket to a statsd daemon.
+    @class Writes metrics in the statsd line protocol, e.g.
+    "infinote.doc.translate:0.25|ms". Lines are sent in packets of up to
+    packetSize bytes, so call flush() to send the rest.
+    @param [address] A (host, port) tuple for UDP, or the path of a Unix
+    datagram socket.
+    @param {String} [prefix]
+    @param {Number} [packetSize]
+    '''
+    def __init__(self, address = ('127.0.0.1', 8125), prefix = 'infinote', packetSize = 512):
+        if isinstance(address, tuple):
+            family = socket.AF_INET
+        else:
+            family = socket.AF_UNIX
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.address = address
+        self.prefix = prefix
+        self.packetSize = packetSize
+        self.lines = []
+        self.size = 0
+
+
+    def format(self, document, kind, name, value):
+        parts = [part for part in (self.prefix, document, name) if part != None]
+        name = '.'.join([('%s' % part).replace(':', '_').replace('|', '_') for part in parts])
+        if kind == COUNT:
+            return '%s:%s|c' % (name, value)
+        if kind == TIMING:
+            return '%s:%.3f|ms' % (name, value * 1000)
+        return '%s:%s|h' % (name, value)
+
+
+    def emit(self, document, kind, name, value):
+        line = self.format(document, kind, name, value)
+        if self.lines and self.size + len(line) + 1 > self.packetSize:
+            self.flush()
+        self.lines.append(line)
+        self.size += len(line) + 1
+
+
+    def flush(self):
+        '''Sends the buffered lines. Delivery is best effort, as usual with
+        statsd: errors are ignored.
+        '''
+        if not self.lines:
+            return
+        packet = '\n'.join(self.lines).encode('utf-8')
+        self.lines = []
+        self.size = 0
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+
+    def close(self):
+        self.flush()
+        self.socket.close()
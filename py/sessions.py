@@ -0,0 +1,323 @@
+'''
+Hosting many py-infinote documents in one process.
+
+A SessionManager keeps a registry of documents, each with its own
+InfinoteEditor. Requests for a document are queued in the document's mailbox
+and executed by a shared pool of worker threads. A document is only ever
+handled by one worker at a time, so requests for the same document are
+executed in order, while different documents are edited in parallel.
+
+Documents that have not been used for a while can be evicted: their editor is
+written to a snapshot and dropped from memory, and rebuilt from the snapshot
+and its journal the next time the document is accessed.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import os
+import time
+import binascii
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from infinote import InfinoteEditor
+from journal import FileJournal
+
+
+class SessionError(Exception):
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+class Task(object):
+    '''@class The result of a request submitted to a SessionManager.'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+    def set(self, value, error = None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+
+    def done(self):
+        return self.event.is_set()
+
+
+    def result(self, timeout = None):
+        '''Waits for the request to be executed and returns the value returned
+        by it, or raises the exception it raised.
+        @param {Number} [timeout] Seconds to wait.
+        '''
+        if not self.event.wait(timeout):
+            raise SessionError('Timed out waiting for the request')
+        if self.error != None:
+            raise self.error
+        return self.value
+
+
+class Document(object):
+    '''@class A document in a SessionManager. The editor is None while the
+    document is evicted.
+    @param documentId
+    '''
+    def __init__(self, documentId):
+        self.id = documentId
+        self.editor = None
+        #Held while the editor is used, loaded or evicted.
+        self.lock = threading.RLock()
+        #Submitted requests that have not been executed yet, guarded by the
+        #lock of the manager.
+        self.mailbox = deque()
+        self.scheduled = False
+        self.lastUsed = time.time()
+
+
+class WorkerPool(object):
+    '''Starts a pool of worker threads.
+    @class Runs callables on a fixed number of daemon threads.
+    @param {Number} size
+    '''
+    def __init__(self, size):
+        self.tasks = queue.Queue()
+        self.threads = []
+        for index in range(size):
+            thread = threading.Thread(target = self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def work(self):
+        while True:
+            func = self.tasks.get()
+            if func == None:
+                return
+            func()
+
+
+    def submit(self, func):
+        self.tasks.put(func)
+
+
+    def close(self):
+        '''Stops the workers once the callables submitted so far have run.'''
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class SessionManager(object):
+    '''Instantiates a new session manager.
+    @class Hosts documents by id and executes their requests on a worker pool.
+    @param {String} [storage] Directory for the journals and snapshots of the
+    documents. Without storage, documents are kept in memory and never evicted.
+    @param {Number} [workers] Number of worker threads.
+    @param {Number} [idleTimeout] Seconds after which an unused document is
+    evicted to storage. A background thread checks for idle documents every
+    idleTimeout / 2 seconds.
+    @param {function} [factory] Creates the editor of a document, called with
+    a journal keyword argument. Defaults to InfinoteEditor.
+    @param {Number} [batchSize] Maximum number of requests a worker executes
+    for one document before giving other documents a turn.
+    '''
+    def __init__(self, storage = None, workers = 4, idleTimeout = None, factory = None, batchSize = 64):
+        if factory == None:
+            factory = InfinoteEditor
+        self.storage = storage
+        self.idleTimeout = idleTimeout
+        self.factory = factory
+        self.batchSize = batchSize
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.pool = WorkerPool(workers)
+        self.closed = threading.Event()
+        self.reaper = None
+        if storage != None and idleTimeout != None:
+            self.reaper = threading.Thread(target = self.reap)
+            self.reaper.daemon = True
+            self.reaper.start()
+
+
+    def __len__(self):
+        return len(self.documents)
+
+
+    def paths(self, documentId):
+        '''Returns the journal and snapshot paths of a document. Ids are hex
+        encoded, so any id can be used as a file name.
+        @type tuple
+        '''
+        name = binascii.hexlify(('%s' % documentId).encode('utf-8')).decode('ascii')
+        base = os.path.join(self.storage, name)
+        return (base + '.journal', base + '.snapshot')
+
+
+    def document(self, documentId):
+        '''Returns the registry entry of a document, creating it if needed.
+        @type Document
+        '''
+        with self.lock:
+            document = self.documents.get(documentId)
+            if document == None:
+                document = self.documents[documentId] = Document(documentId)
+            return document
+
+
+    def load(self, document):
+        #Must be called with the lock of the document held.
+        if document.editor == None:
+            if self.storage == None:
+                document.editor = self.factory()
+            else:
+                journalPath, snapshotPath = self.paths(document.id)
+                editor = self.factory(journal = FileJournal(journalPath))
+                editor.recover(snapshotPath)
+                document.editor = editor
+        document.lastUsed = time.time()
+        return document.editor
+
+
+    @contextmanager
+    def editing(self, documentId):
+        '''Gives exclusive access to the editor of a document, loading it if it
+        has been evicted:
+
+            with manager.editing(documentId) as editor:
+                editor.get_state()
+        '''
+        document = self.document(documentId)
+        with document.lock:
+            yield self.load(document)
+            document.lastUsed = time.time()
+
+
+    def submit(self, documentId, func, *args):
+        '''Queues a request for a document. func is called with the editor of
+        the document and args on a worker thread, after all requests submitted
+        for the document before.
+        @returns The task that receives the return value of func.
+        @type Task
+        '''
+        if self.closed.is_set():
+            raise SessionError('Session manager is closed')
+        task = Task()
+        document = self.document(documentId)
+        with self.lock:
+            document.mailbox.append((func, args, task))
+            if document.scheduled:
+                return task
+            document.scheduled = True
+        self.pool.submit(lambda: self.drain(document))
+        return task
+
+
+    def drain(self, document):
+        #Executes queued requests of a document on a worker thread.
+        for index in range(self.batchSize):
+            with self.lock:
+                if not document.mailbox:
+                    document.scheduled = False
+                    return
+                func, args, task = document.mailbox.popleft()
+            value = None
+            error = None
+            with document.lock:
+                try:
+                    value = func(self.load(document), *args)
+                except Exception as exception:
+                    error = exception
+            #The task is completed outside the lock, so the document is
+            #free again by the time the submitter sees the result.
+            task.set(value, error)
+        #Give other documents a turn before continuing with this one.
+        self.pool.submit(lambda: self.drain(document))
+
+
+    def unload(self, document):
+        #Must be called with the lock of the document held.
+        editor = document.editor
+        if editor == None:
+            return
+        editor.flush()
+        editor.save_snapshot(self.paths(document.id)[1])
+        editor.log.close()
+        document.editor = None
+
+
+    def evictIdle(self, now = None):
+        '''Writes documents that have been idle for idleTimeout seconds to
+        storage and drops their editors. Documents that are in use or have
+        queued requests are left alone.
+        @param {Number} [now] The current time.
+        @returns The number of evicted documents.
+        '''
+        if self.storage == None or self.idleTimeout == None:
+            return 0
+        if now == None:
+            now = time.time()
+        with self.lock:
+            candidates = [document for document in self.documents.values()
+                          if document.editor != None and not document.mailbox
+                          and now - document.lastUsed >= self.idleTimeout]
+        evicted = 0
+        for document in candidates:
+            if not document.lock.acquire(False):
+                continue
+            try:
+                if not document.mailbox and now - document.lastUsed >= self.idleTimeout:
+                    self.unload(document)
+                    evicted += 1
+            finally:
+                document.lock.release()
+        return evicted
+
+
+    def reap(self):
+        while not self.closed.wait(self.idleTimeout / 2.0):
+            self.evictIdle()
+
+
+    def getStats(self):
+        '''Returns the number of documents, loaded documents and queued requests.
+        @type dict
+        '''
+        with self.lock:
+            documents = list(self.documents.values())
+        return {'documents': len(documents),
+                'loaded': len([document for document in documents if document.editor != None]),
+                'queued': sum([len(document.mailbox) for document in documents])}
+
+
+    def close(self):
+        '''Executes the requests submitted so far, stops the workers and writes
+        all loaded documents to storage.
+        '''
+        self.closed.set()
+        if self.reaper != None:
+            self.reaper.join()
+        #Workers re-submit documents with long mailboxes, so wait for those
+        #before stopping the pool.
+        while True:
+            with self.lock:
+                busy = [document for document in self.documents.values() if document.scheduled]
+            if not busy:
+                break
+            time.sleep(0.01)
+        self.pool.close()
+        if self.storage != None:
+            for document in list(self.documents.values()):
+                with document.lock:
+                    self.unload(document)
@@ -0,0 +1,279 @@
+'''
+Binary snapshots of py-infinote State objects.
+
+A snapshot holds everything needed to continue working with a document
+without replaying its history: the buffer segments, the state vector, the
+collected base, the acknowledged vectors, the remaining log with its per-user
+indexes and undo/redo stacks, and the request queue.
+
+Layout (all integers little-endian):
+
+    magic        4 bytes   "INFS"
+    version      uint16
+    meta length  uint32
+    meta         see below
+    text         the UTF-8 encoded segment texts, back to back
+
+The metadata is written with the varint helpers of codec.py, in this order:
+the name of the buffer class, the user, encoded size and text flag of each
+segment, the vector, the base, the acknowledged vectors by user, the undo
+depth and cache size, the log as codec requests, the log positions of the
+requests in the per-user log and undo and redo stacks, the undo/redo pairs as
+log positions, the request queue, and the info as JSON text.
+
+Segment texts are kept out of the metadata, so that loading a large document
+only decodes the text straight from the (memory mapped) file.
+
+See LICENSE and CONTRIBUTORS for copyright information.
+'''
+import os
+import sys
+import mmap
+import json
+import struct
+
+from infinote import *
+from codec import CodecError, writeVarint, readVarint, readCount, writeText, readText, writeVector, readVector, \
+    writeRequest, readRequest
+
+MAGIC = b'INFS'
+VERSION = 2
+HEADER = struct.Struct('<4sHI')
+#Files of at least this size are memory mapped instead of read.
+MMAP_THRESHOLD = 1 << 20
+
+if sys.version_info[0] >= 3:
+    text_type = str
+    xrange = range
+else:
+    text_type = unicode
+
+
+class SnapshotError(Exception):
+    def __init__(self, message, Errors = None):
+
+        Exception.__init__(self, message)
+        self.Errors = Errors
+
+
+def writeOptional(out, value):
+    #None is stored as 0, numbers as one more than their value.
+    if value == None:
+        writeVarint(out, 0)
+    else:
+        writeVarint(out, value + 1)
+
+
+def readOptional(view, offset):
+    value, offset = readVarint(view, offset)
+    if value == 0:
+        return (None, offset)
+    return (value - 1, offset)
+
+
+def writePositions(out, users):
+    #Writes lists of log positions by user.
+    writeVarint(out, len(users))
+    for user, positions in sorted(users.items()):
+        writeVarint(out, user)
+        writeVarint(out, len(positions))
+        for position in positions:
+            writeVarint(out, position)
+
+
+def readPositions(view, offset):
+    count, offset = readCount(view, offset)
+    users = {}
+    for index in xrange(count):
+        user, offset = readVarint(view, offset)
+        size, offset = readCount(view, offset)
+        positions = []
+        for position in xrange(size):
+            position, offset = readVarint(view, offset)
+            positions.append(position)
+        users[user] = positions
+    return (users, offset)
+
+
+def dump(state, info = None):
+    '''Serializes a state into a snapshot.
+    @param {State} state
+    @param {dict} [info] Additional JSON serializable data to store with the
+    snapshot, returned by read().
+    @type bytes
+    '''
+    meta = bytearray()
+    writeText(meta, state.buffer.__class__.__name__)
+    texts = []
+    segments = state.buffer.segments
+    writeVarint(meta, len(segments))
+    for segment in segments:
+        text = segment.text
+        isText = isinstance(text, text_type)
+        if isText:
+            text = text.encode('utf-8')
+        writeVarint(meta, segment.user)
+        writeVarint(meta, len(text))
+        meta.append(int(isText))
+        texts.append(text)
+    writeVector(meta, state.vector)
+    writeVector(meta, state.base)
+    writeVarint(meta, len(state.acknowledged))
+    for user, vector in sorted(state.acknowledged.items()):
+        writeVarint(meta, user)
+        writeVector(meta, vector)
+    writeOptional(meta, state.undoDepth)
+    if state.cache == None:
+        writeOptional(meta, 0)
+    else:
+        writeOptional(meta, state.cache.maxSize)
+    positions = dict([(id(request), index) for index, request in enumerate(state.log)])
+    writeVarint(meta, len(state.log))
+    for request in state.log:
+        writeRequest(meta, request)
+    for users in (state.userLog, state.undoStack, state.redoStack):
+        writePositions(meta, dict([(user, [positions[id(request)] for request in requests])
+                                   for user, requests in users.items()]))
+    writeVarint(meta, len(state.pairs))
+    for request, assocReq in state.pairs.items():
+        writeVarint(meta, positions[id(request)])
+        writeVarint(meta, positions[id(assocReq)])
+    queued = list(state.request_queue)
+    writeVarint(meta, len(queued))
+    for request in queued:
+        writeRequest(meta, request)
+    writeText(meta, json.dumps(info, sort_keys = True))
+    return HEADER.pack(MAGIC, VERSION, len(meta)) + bytes(meta) + b''.join(texts)
+
+
+def restore(data):
+    '''Restores a state from a snapshot.
+    @param data The snapshot, as bytes or a memory map.
+    @returns The state and the info stored with it.
+    @type tuple
+    '''
+    if len(data) < HEADER.size:
+        raise SnapshotError('Snapshot is truncated')
+    magic, version, length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise SnapshotError('Not a snapshot')
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version %s' % version)
+    start = HEADER.size + length
+    if start > len(data):
+        raise SnapshotError('Snapshot is truncated')
+    try:
+        return readMeta(memoryview(data[HEADER.size:start]), data, start)
+    except CodecError as error:
+        raise SnapshotError('Snapshot is corrupt: %s' % error)
+
+
+def readMeta(view, data, offset):
+    #Reads the metadata from view, and the segment texts from data starting
+    #at offset.
+    name, position = readText(view, 0)
+    bufferClass = Buffer
+    if name == 'TreeBuffer':
+        bufferClass = TreeBuffer
+    count, position = readCount(view, position)
+    runs = []
+    for index in xrange(count):
+        user, position = readVarint(view, position)
+        size, position = readVarint(view, position)
+        isText, position = readVarint(view, position)
+        runs.append((user, size, isText))
+    vector, position = readVector(view, position)
+    base, position = readVector(view, position)
+    count, position = readCount(view, position)
+    acknowledged = {}
+    for index in xrange(count):
+        user, position = readVarint(view, position)
+        acknowledged[user], position = readVector(view, position)
+    undoDepth, position = readOptional(view, position)
+    cacheSize, position = readOptional(view, position)
+    state = State(vector = vector, cacheSize = cacheSize, bufferClass = bufferClass, undoDepth = undoDepth)
+    segments = []
+    for user, size, isText in runs:
+        if offset + size > len(data):
+            raise SnapshotError('Snapshot is truncated')
+        text = data[offset:offset + size]
+        if isText:
+            text = text.decode('utf-8')
+        segments.append(Segment(user, text))
+        offset += size
+    state.buffer = bufferClass(segments)
+    state.base = base
+    state.acknowledged.update(acknowledged)
+    count, position = readCount(view, position)
+    for index in xrange(count):
+        request, position = readRequest(view, position)
+        state.log.append(request)
+    try:
+        for users in (state.userLog, state.undoStack, state.redoStack):
+            positions, position = readPositions(view, position)
+            for user, indexes in positions.items():
+                users[user] = [state.log[index] for index in indexes]
+        count, position = readCount(view, position)
+        for index in xrange(count):
+            request, position = readVarint(view, position)
+            assocReq, position = readVarint(view, position)
+            state.pairs[state.log[request]] = state.log[assocReq]
+    except IndexError:
+        raise SnapshotError('Snapshot refers to a request that is not in the log')
+    count, position = readCount(view, position)
+    for index in xrange(count):
+        request, position = readRequest(view, position)
+        state.queue(request)
+    info, position = readText(view, position)
+    if position != len(view):
+        raise SnapshotError('Unexpected data after the snapshot metadata')
+    return (state, json.loads(info))
+
+
+def save(state, path, info = None):
+    '''Writes a snapshot of a state to a file. The file is replaced
+    atomically, so a crash while saving leaves the previous snapshot intact.
+    @param {State} state
+    @param {String} path
+    @param {dict} [info] Additional JSON serializable data to store with the
+    snapshot.
+    '''
+    temp = path + '.tmp'
+    handle = open(temp, 'wb')
+    try:
+        handle.write(dump(state, info))
+        handle.flush()
+        os.fsync(handle.fileno())
+    finally:
+        handle.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp, path)
+
+
+def read(path):
+    '''Loads a state from a snapshot file. Large files are memory mapped, so
+    the document text is decoded straight from the page cache.
+    @param {String} path
+    @returns The state and the info stored with it.
+    @type tuple
+    '''
+    handle = open(path, 'rb')
+    try:
+        if os.fstat(handle.fileno()).st_size >= MMAP_THRESHOLD:
+            data = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                return restore(data)
+            finally:
+                data.close()
+        return restore(handle.read())
+    finally:
+        handle.close()
+
+
+def load(path):
+    '''Loads a state from a snapshot file.
+    @param {String} path
+    @type State
+    '''
+    return read(path)[0]
@@ -3,6 +3,18 @@ import os, sys
 WEBUI_ROOT = os.path.dirname(os.path.realpath(__file__))[:-5]
 sys.path.append(WEBUI_ROOT)
 from infinote import *
+import tempfile
+import time
+import codec
+import snapshot
+import sessions
+import fanout
+import bench
+import metrics
+import fuzz
+import random
+import socket
+from journal import FileJournal
     
            
 def test_1():
@@ -94,5 +106,646 @@ def test_2():
         
 
     print ' Result 6: %s\n' % state2.buffer #this should output "dit is een test"
+
+
+def test_cache():
+    state = State(Buffer([Segment(0, "abc")]), cacheSize = 2)
+    state.execute(DoRequest(1, Vector(), Insert(1, Buffer([Segment(1, "x")]))))
+    state.execute(DoRequest(2, Vector(), Insert(2, Buffer([Segment(2, "y")]))))
+    state.execute(DoRequest(3, Vector(), Delete(0, 1)))
+    stats = state.getCacheStats()
+    print ' Cache: %s' % stats
+    assert stats['size'] <= 2
+    assert stats['evictions'] + stats['invalidations'] > 0
+    print ' Result: %s\n' % state.buffer #this should output "xbyc"
+    assert state.buffer.toString() == "xbyc"
+
+
+def test_vector():
+    v1 = Vector('1:2;3:4')
+    v2 = v1.incr(5).incr(1, -2)
+    print ' Vector: %s -> %s' % (v1, v2) #this should output 1:2;3:4 -> 3:4;5:1
+    assert v2.toString() == '3:4;5:1' and v1.toString() == '1:2;3:4'
+    assert v1 == Vector('3:4;1:2') and hash(v1) == hash(Vector({1: 2, 3: 4}))
+    assert Vector('3:4').causallyBefore(v1) and not v1.causallyBefore(v2)
+    assert Vector.leastCommonSuccessor(v1, v2) == Vector('1:2;3:4;5:1')
+    assert Vector.leastCommonPredecessor(v1, v2) == Vector('3:4')
+
+
+def test_tree_buffer():
+    state = State(Buffer([Segment(0, "abcdefghi")]), bufferClass = TreeBuffer)
+    state.execute(DoRequest(2, Vector(), Insert(2, Buffer([Segment(2, "ac")]))))
+    state.execute(DoRequest(3, Vector(), Insert(3, Buffer([Segment(3, "bc")]))))
+    state.execute(DoRequest(4, Vector(), Delete(0, 5)))
+    print ' TreeBuffer: %s' % state.buffer #this should output "acbcfghi"
+    assert state.buffer.toString() == "acbcfghi"
+    state.execute(UndoRequest(4, state.vector))
+    assert state.buffer.toString() == "abaccbcdefghi"
+    assert [segment.user for segment in state.buffer.segments] == [0, 2, 0, 3, 0]
+    assert state.buffer.slice(2, 7).toString() == "accbc"
+    #Splices drop the text read before rather than copying it.
+    state.buffer.splice(0, 1)
+    assert state.buffer.textCache == None and state.buffer.toString() == "baccbcdefghi"
+
+
+def test_buffer_runs():
+    buffer = Buffer([Segment(1, "ab"), Segment(1, "c"), Segment(2, ""), Segment(3, "de")])
+    copy = buffer.copy()
+    buffer.splice(1, 3, Buffer([Segment(3, "x")]))
+    print ' Buffer runs: %s %s' % (buffer.runs, copy.runs) #this should output [(1, 1), (2, 3)] [(3, 1), (2, 3)]
+    assert buffer.runs == [(1, 1), (2, 3)] and buffer.toString() == "axe"
+    assert copy.toString() == "abcde" and [segment.user for segment in copy.segments] == [1, 3]
+    assert copy.slice(2, 4).runs == [(1, 1), (1, 3)] and copy.slice(4, 2).toString() == ""
+
+
+def test_html():
+    buffer = Buffer([Segment(1, "a<b&c"), Segment(2, "d")])
+    html = buffer.toHTML()
+    copy = buffer.copy()
+    buffer.splice(5, 1, Buffer([Segment(1, ">")]))
+    print ' HTML: %s' % buffer.toHTML() #this should output one segment "a&lt;b&amp;c&gt;"
+    assert buffer.toHTML() == '<span class="buffer"><span class="segment user-1">a&lt;b&amp;c&gt;</span></span>'
+    assert buffer.toHTML() == Buffer(buffer.segments).toHTML() and copy.toHTML() == html
+    assert ''.join(buffer.iterHTML(chunkSize = 1)) == buffer.toHTML()
+    tree = TreeBuffer(copy.segments)
+    assert tree.toHTML() == html
+    tree.splice(5, 1, Buffer([Segment(1, ">")]))
+    assert tree.toHTML() == buffer.toHTML()
+
+
+def test_attribution():
+    buffer = Buffer([Segment(1, "abc"), Segment(2, "de"), Segment(1, "f")])
+    assert buffer.getAuthors() == {1: 4, 2: 2}
+    buffer.splice(2, 3, Buffer([Segment(3, "x")]))
+    print ' Attribution: %s %s' % (buffer.getAuthors(), buffer.getAttribution()) #this should output {1: 3, 3: 1} [(0, 2, 1), (2, 1, 3), (3, 1, 1)]
+    assert buffer.getAuthors() == {1: 3, 3: 1} and buffer.authorAt(2) == 3
+    assert buffer.getUserRuns(1) == [(0, 2), (3, 1)] and buffer.getAttribution(1, 3) == [(1, 1, 1), (2, 1, 3)]
+    tree = TreeBuffer([Segment(1, "abc"), Segment(2, "de"), Segment(1, "f")])
+    tree.splice(2, 3, Buffer([Segment(3, "x")]))
+    assert tree.getAuthors() == buffer.getAuthors() and tree.getAttribution() == buffer.getAttribution()
+    assert [tree.authorAt(i) for i in range(4)] == [1, 1, 3, 1]
+    #Splices keep the index up to date between queries, and copies keep theirs.
+    rng = random.Random(3)
+    buffer = Buffer([Segment(1, "abcdef")])
+    tree = TreeBuffer(buffer.segments)
+    for step in range(300):
+        index = rng.randrange(buffer.getLength() + 1)
+        remove = rng.randrange(3)
+        insert = Buffer([Segment(rng.randrange(4), "xyz"[:rng.randrange(4)])])
+        copy = buffer.copy()
+        buffer.splice(index, remove, insert)
+        tree.splice(index, remove, insert)
+        fresh = Buffer(buffer.segments)
+        length = buffer.getLength()
+        offsets = [rng.randrange(length) for i in range(3) if length]
+        assert list(buffer.getIndex().walk(0, length)) == list(fresh.getIndex().walk(0, length))
+        assert list(copy.getIndex().walk(0, copy.getLength())) == list(Buffer(copy.segments).getIndex().walk(0, copy.getLength()))
+        assert tree.getAuthors() == buffer.getAuthors()
+        assert [buffer.authorAt(i) for i in offsets] == [tree.authorAt(i) for i in offsets] == [fresh.authorAt(i) for i in offsets]
+        begin, end = sorted([rng.randrange(length + 1), rng.randrange(length + 1)])
+        assert buffer.getAttribution(begin, end) == tree.getAttribution(begin, end) == fresh.getAttribution(begin, end)
+        assert buffer.getUserRuns(step % 4) == tree.getUserRuns(step % 4) == fresh.getUserRuns(step % 4)
+    editor = InfinoteEditor()
+    editor.try_insert([1, '', 0, 'hello'])
+    editor.try_insert([2, '1:1', 5, '!'])
+    assert editor.get_attribution() == ('1:1;2:1', {1: 5, 2: 1}, [[0, 5, 1], [5, 1, 2]])
+
+
+def test_gc():
+    state = State(undoDepth = 1)
+    for i, text in enumerate(["a", "b", "c", "d"]):
+        state.execute(DoRequest(1, state.vector, Insert(i, Buffer([Segment(1, text)]))))
+        state.acknowledge(2, state.vector)
+    reclaimed = state.collectGarbage()
+    print ' GC: %s, %s entries left' % (reclaimed, len(state.log)) #this should reclaim 3 entries
+    assert reclaimed['entries'] == 3 and len(state.log) == 1
+    v = state.vector
+    state.execute(DoRequest(2, v, Insert(0, Buffer([Segment(2, "x")]))))
+    state.execute(DoRequest(1, v, Insert(4, Buffer([Segment(1, "e")]))))
+    state.execute(UndoRequest(1, state.vector))
+    print ' Result: %s\n' % state.buffer #this should output "xabcd"
+    assert state.buffer.toString() == "xabcd"
+
+
+def test_batch():
+    editor = InfinoteEditor()
+    logs = [['i', [1, '1:2', 2, 'c']], ['i', [2, '', 0, 'x']], ['i', [1, '', 0, 'a']], ['i', [1, '1:1', 1, 'b']], ['d', [2, '1:3;2:1', 1, 2]], ['u', [2]]]
+    executed = editor.apply_batch(logs)
+    print ' Batch: %s executed, state %s' % (len(executed), editor.get_state()) #this should output 6 executed, "xabc"
+    assert len(executed) == 6 and editor.get_state()[1] == 'xabc'
+    assert [log[0] for log in editor.log] == ['i', 'i', 'i', 'i', 'd', 'u']
+    #A request that arrives before the ones it depends on waits for them, and
+    #is journaled once it has been executed.
+    editor = InfinoteEditor()
+    assert editor.apply_batch([['i', [1, '1:1', 1, 'b']], ['i', [2, '1:2', 2, 'c']]]) == []
+    executed = editor.apply_batch([['i', [1, '', 0, 'a']]])
+    assert len(executed) == 3 and editor.get_state() == ('1:2;2:1', 'abc')
+    assert [log[1][3] for log in editor.log] == ['a', 'b', 'c']
+    editor.try_insert([3, '1:2;2:1', 3, 'd'])
+    recovered = InfinoteEditor(journal = editor.log)
+    recovered.sync()
+    assert recovered.get_state() == editor.get_state() == ('1:2;2:1;3:1', 'abcd')
+    editor = InfinoteEditor()
+    editor.apply_batch([['d', [2, '1:1', 0, 1]]])
+    editor.try_insert([1, '', 0, 'xy'])
+    assert editor.get_state() == ('1:1;2:1', 'y') and len(editor.log) == 2
+
+
+def test_coalesce():
+    editor = InfinoteEditor(coalesce_window = 4)
+    for index, char in enumerate('abcdef'):
+        editor.try_insert([1, '1:%s' % index, index, char])
+    editor.try_delete([1, '1:6', 5, 1])
+    editor.try_delete([1, '1:7', 4, 1])
+    print ' Coalesced: %s' % editor.get_log()[1] #this should output 3 entries
+    assert [log[0] for log in editor.log] == ['i', 'i', 'd']
+    #Vectors are reported in the numbering of the clients, which count every
+    #edit, so user 2 counts all eight edits of user 1. One undo reverts a run.
+    assert editor.get_state() == ('1:8', 'abcd')
+    editor.try_insert([2, '1:8', 0, 'x'])
+    editor.try_undo([1])
+    assert editor.get_state() == ('1:9;2:1', 'xabcdef')
+    #A second user edits from a vector returned by get_state, concurrently
+    #with the next run of the first.
+    editor = InfinoteEditor(coalesce_window = 4)
+    for index, char in enumerate('abcd'):
+        editor.try_insert([1, '1:%s' % index, index, char])
+    vector, text = editor.get_state()
+    assert (vector, text) == ('1:4', 'abcd')
+    editor.try_insert([2, vector, 4, 'X'])
+    editor.try_insert([1, '1:4', 4, 'e'])
+    editor.try_insert([1, '1:5', 5, 'f'])
+    assert editor.get_state() == ('1:6;2:1', 'abcdXef')
+    assert editor.get_changes(vector) == ('1:6;2:1', [['i', 4, 'X'], ['i', 5, 'ef']])
+    assert [log[1][3] for log in editor.log] == ['abcd', 'X', 'ef']
+    editor.try_insert([2, '1:6;2:1', 0, '>'])
+    assert editor.get_state() == ('1:6;2:2', '>abcdXef')
+    recovered = InfinoteEditor(journal = editor.log)
+    recovered.sync()
+    assert recovered.get_state() == editor.get_state()
+
+
+def test_deep_translation():
+    #A client reconnecting after many edits must not exhaust the Python stack.
+    state = State()
+    for index in range(sys.getrecursionlimit() * 2):
+        state.execute(DoRequest(1, state.vector, Insert(index, Buffer([Segment(1, "a")]))))
+    request = DoRequest(2, Vector(), Insert(0, Buffer([Segment(2, "x")])))
+    translated = state.translate(request, state.vector)
+    print ' Deep: %s' % translated
+    assert translated.toString() == DoRequest(2, state.vector, Insert(0, Buffer([Segment(2, "x")]))).toString()
+    #The iterative evaluation agrees with the independent recursive one of
+    #fuzz.ReferenceState on a history with concurrent edits and undos.
+    state = State()
+    reference = fuzz.ReferenceState()
+    for request in (DoRequest(1, Vector(), Insert(0, Buffer([Segment(1, "abc")]))),
+                    DoRequest(2, Vector(), Insert(0, Buffer([Segment(2, "xy")]))),
+                    DoRequest(1, Vector('1:1'), Delete(1, 2)), DoRequest(3, Vector('1:1'), Insert(2, Buffer([Segment(3, "z")]))),
+                    UndoRequest(1, Vector('1:2;2:1')), DoRequest(2, Vector('1:1;2:1'), Delete(0, 3))):
+        state.execute(request)
+        reference.execute(request)
+    assert state.buffer.toString() == reference.buffer.toString()
+    request = DoRequest(3, Vector('1:1;3:1'), Insert(3, Buffer([Segment(3, "w")])))
+    assert state.translate(request, state.vector).toString() == reference.translate(request, reference.vector).toString()
+
+
+def test_snapshot():
+    state = State(Buffer([Segment(0, "abc")]))
+    state.execute(DoRequest(1, Vector(), Insert(1, Buffer([Segment(1, "x")]))))
+    state.execute(DoRequest(2, Vector(), Delete(0, 2)))
+    path = os.path.join(tempfile.mkdtemp(), 'document.snapshot')
+    snapshot.save(state, path)
+    restored = snapshot.load(path)
+    print ' Snapshot: %s %s' % (restored.vector, restored.buffer) #this should output 1:1;2:1 xc
+    assert restored.vector == state.vector and restored.buffer.toString() == "xc"
+    restored.execute(UndoRequest(2, restored.vector))
+    assert restored.buffer.toString() == "axbc"
+    os.remove(path)
+    data = snapshot.dump(state, {'journal': 2, 'coalesced': [[1, [[3, 0, 2]]]]})
+    assert snapshot.restore(data)[1] == {'journal': 2, 'coalesced': [[1, [[3, 0, 2]]]]}
+    for corrupt in (data[:4] + b'\x01\x00' + data[6:], data[:20]):
+        try:
+            snapshot.restore(corrupt)
+            assert False
+        except snapshot.SnapshotError:
+            pass
+
+
+def test_journal():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'document.journal')
+    snapshot_path = os.path.join(directory, 'document.snapshot')
+    editor = InfinoteEditor(journal = FileJournal(path, syncEvery = 2))
+    editor.try_insert([1, '', 0, 'abc'])
+    editor.try_insert([2, '', 0, 'x'])
+    editor.save_snapshot(snapshot_path)
+    editor.try_delete([1, '1:1;2:1', 1, 2])
+    editor.try_undo([2])
+    editor.log.close()
+    #A record cut off by a crash is dropped when the journal is reopened.
+    handle = open(path, 'ab')
+    handle.write(b'\x10\x00')
+    handle.close()
+    recovered = InfinoteEditor(journal = FileJournal(path))
+    replayed = recovered.recover(snapshot_path)
+    print ' Journal: %s replayed, state %s' % (replayed, recovered.get_state()) #this should output 2 replayed, "c"
+    assert replayed == 2 and recovered.get_state() == editor.get_state()
+    assert recovered.get_log(2)[1] == [['d', (1, '1:1;2:1', 1, 2)], ['u', (2,)]]
+    recovered.try_insert([1, '1:2;2:2', 0, 'y'])
+    assert len(recovered.log) == 5 and recovered.get_state()[1] == "yc"
+    recovered.log.close()
+    #A request that a batch left queued survives the snapshot, and is
+    #executed and journaled once the request it waits for arrives.
+    editor = InfinoteEditor()
+    assert editor.apply_batch([['i', [1, '1:1', 1, 'b']]]) == []
+    editor.save_snapshot(snapshot_path)
+    recovered = InfinoteEditor(journal = editor.log)
+    recovered.recover(snapshot_path)
+    recovered.try_insert([1, '', 0, 'a'])
+    assert recovered.get_state() == ('1:2', 'ab')
+    assert recovered.get_log()[1] == [['i', (1, '', 0, 'a')], ['i', (1, '1:1', 1, 'b')]]
+
+
+def test_undo_redo():
+    state = State(undoDepth = 2)
+    state.execute(DoRequest(1, Vector(), Insert(0, Buffer([Segment(1, "ab")]))))
+    state.execute(DoRequest(2, Vector(), Insert(0, Buffer([Segment(2, "x")]))))
+    state.execute(DoRequest(1, Vector('1:1'), Insert(2, Buffer([Segment(1, "cd")]))))
+    state.execute(UndoRequest(1, state.vector))
+    state.execute(UndoRequest(1, state.vector))
+    assert state.buffer.toString() == "x"
+    state.execute(RedoRequest(1, state.vector))
+    print ' Redo: %s' % state.buffer #this should output "xab"
+    assert state.buffer.toString() == "xab"
+    assert state.associatedRequest(UndoRequest(1, state.vector)) is state.log[-1]
+    #A new edit discards the remaining redo.
+    state.execute(DoRequest(1, state.vector, Insert(0, Buffer([Segment(1, "y")]))))
+    assert not state.canExecute(RedoRequest(1, state.vector))
+    state.acknowledge(2, state.vector)
+    state.collectGarbage()
+    restored = snapshot.restore(snapshot.dump(state))[0]
+    for current in (state, restored):
+        current.execute(UndoRequest(1, current.vector))
+        current.execute(UndoRequest(1, current.vector))
+        assert current.buffer.toString() == "x"
+
+
+def test_undo_cid():
+    #Undoing inserts ends up transforming an insert against a Split, for
+    #which there is no CID, so the user IDs decide.
+    state = State()
+    for user, position in [(1, 0), (2, 2), (1, 4), (2, 5), (1, 8), (2, 0)]:
+        state.execute(DoRequest(user, state.vector, Insert(position, Buffer([Segment(user, "ab")]))))
+    for i in range(3):
+        state.execute(UndoRequest(1, state.vector))
+    print ' Undo CID: %s' % state.buffer #this should output "ababab"
+    assert state.buffer.toString() == "ababab" and state.buffer.getLength() == 6
+    split = Split(Insert(0, Buffer([Segment(2, "b")])), Delete(1, 1))
+    assert Insert(0, Buffer([Segment(1, "a")])).cid(split) == None
+
+
+def test_undo_order():
+    #An undo that arrives before an earlier request of its user waits for it.
+    #Executed right away, it undid the wrong request and the sites diverged.
+    requests = [DoRequest(2, Vector(), Insert(0, Buffer([Segment(2, "ccc")]))),
+                DoRequest(2, Vector('2:1'), Insert(0, Buffer([Segment(2, "e")]))),
+                UndoRequest(2, Vector('2:2'))]
+    texts = []
+    for order in ([0, 1, 2], [0, 2, 1]):
+        state = State()
+        for index in order:
+            state.execute(requests[index])
+        state.executeAll()
+        texts.append(state.buffer.toString())
+    assert texts == ["ccc", "ccc"]
+
+
+def test_split_mirror():
+    #A mirrored Split(Delete, Delete) becomes two inserts at the same position;
+    #the second one is shifted behind the first rather than having no result.
+    buffer = Buffer()
+    Split(Delete(0, Buffer([Segment(1, "a")])), Delete(1, Buffer([Segment(1, "b")]))).mirror().apply(buffer)
+    assert buffer.toString() == "ab"
+
+
+def test_recon_order():
+    #Text lost to two concurrent deletes is restored most recent first, since
+    #each recon segment is relative to the text left when it was lost.
+    state = State()
+    for request in (DoRequest(3, Vector(), Insert(0, Buffer([Segment(3, "caaeiiea")]))),
+                    DoRequest(3, Vector('3:1'), Delete(7, 1)), DoRequest(3, Vector('3:2'), Delete(0, 3)),
+                    DoRequest(3, Vector('3:3'), Delete(1, 3)), DoRequest(1, Vector('3:1'), Delete(6, 2))):
+        state.execute(request)
+    assert state.log[-1].operation.what.toString() == "ea"
+
+
+def test_queue():
+    #A reconnecting client delivers its requests in reverse order.
+    state = State()
+    for index in reversed(range(1, 50)):
+        state.execute(DoRequest(1, Vector({1: index}), Insert(index, Buffer([Segment(1, "a")]))))
+    state.queue(UndoRequest(1, Vector({1: 50})))
+    assert len(state.request_queue) == 50 and state.request_queue.getStats()['ready'] == 0
+    state.execute(DoRequest(1, Vector(), Insert(0, Buffer([Segment(1, "a")]))))
+    state.executeAll()
+    stats = state.getQueueStats()
+    print ' Queue: %s %s' % (state.vector, stats) #this should output 1:51 and an empty queue
+    assert state.vector.toString() == '1:51' and state.buffer.getLength() == 49
+    assert stats['depth'] == 0 and stats['dequeued'] == 50 and stats['maxDepth'] == 50
+
+
+def test_codec():
+    recon = Recon()
+    recon.segments.append(ReconSegment(1, Buffer([Segment(2, u"\xe9")])))
+    requests = [DoRequest(1, Vector('1:3;2:300'), Insert(4, Buffer([Segment(1, u"a\u20acb"), Segment(2, "c")]))),
+                DoRequest(2, Vector(), Delete(2, Buffer([Segment(1, "xy")]), recon)),
+                DoRequest(3, Vector('3:1'), Split(Delete(0, 5), Insert(7, Buffer([Segment(3, "z")])))),
+                DoRequest(3, Vector('3:2'), MultiDelete([Delete(0, 2), Delete(4, Buffer([Segment(1, "xy")]), recon)])),
+                UndoRequest(1, Vector('1:4')), RedoRequest(2, Vector('2:1'))]
+    frame = codec.encode(requests)
+    decoded = codec.decode(frame)
+    print ' Codec: %s requests in %s bytes' % (len(decoded), len(frame)) #this should output 6 requests
+    assert [request.toString() for request in decoded] == [request.toString() for request in requests]
+    assert decoded[1].operation.recon.segments[0].buffer.toString() == u"\xe9"
+    assert isinstance(codec.decode(codec.encode([DoRequest(1, Vector(), NoOp())]))[0].operation, NoOp)
+    #Frames arriving in arbitrary chunks are reassembled.
+    reader = codec.FrameReader()
+    stream = frame + codec.encode(requests[4:])
+    received = []
+    for index in range(0, len(stream), 7):
+        received.extend(reader.feed(stream[index:index + 7]))
+    assert len(received) == 8 and len(reader) == 0
+    try:
+        codec.decode(frame[:-1])
+        assert False
+    except codec.CodecError:
+        pass
+    #Hostile input is rejected with a CodecError.
+    def frameOf(body):
+        out = bytearray()
+        codec.writeVarint(out, len(body))
+        out.extend(body)
+        return bytes(out)
+    huge = bytearray([codec.VERSION])
+    codec.writeVarint(huge, 1 << 60)
+    nested = bytearray([codec.VERSION, 1, codec.DO, 1, 0] + [codec.SPLIT] * 100000)
+    for body in (huge, nested):
+        try:
+            codec.decode(frameOf(body))
+            assert False
+        except codec.CodecError:
+            pass
+    try:
+        codec.FrameReader(maxFrameSize = 16).feed(frameOf(bytearray(17)))
+        assert False
+    except codec.CodecError:
+        pass
+    assert len(codec.FrameReader(maxFrameSize = len(frame)).feed(frame)) == 6
+
+
+def test_sessions():
+    manager = sessions.SessionManager(tempfile.mkdtemp(), workers = 3, idleTimeout = 3600)
+    tasks = []
+    for document in ('a', 'b', 'c'):
+        for index, char in enumerate('xyz'):
+            tasks.append(manager.submit(document, InfinoteEditor.try_insert, [1, '1:%s' % index, index, char]))
+    tasks.append(manager.submit('b', InfinoteEditor.get_state))
+    print ' Sessions: %s' % ([task.result(5) for task in tasks][-1],) #this should output ('1:3', 'xyz')
+    assert tasks[-1].result() == ('1:3', 'xyz')
+    assert manager.evictIdle(time.time() + 3600) == 3 and manager.getStats()['loaded'] == 0
+    with manager.editing('a') as editor:
+        assert editor.get_state() == ('1:3', 'xyz')
+        editor.try_delete([1, '1:3', 0, 1])
+    assert manager.submit('a', InfinoteEditor.get_state).result(5) == ('1:4', 'yz')
+    try:
+        manager.submit('c', InfinoteEditor.try_insert, None).result(5)
+        assert False
+    except TypeError:
+        pass
+    manager.close()
+    reopened = sessions.SessionManager(manager.storage)
+    with reopened.editing('a') as editor:
+        assert editor.get_state() == ('1:4', 'yz')
+    reopened.close()
+
+
+def test_fanout():
+    state = State()
+    broadcast = fanout.Fanout(state)
+    for clientId, user in (('a', 1), ('b', 2), ('c', 3), ('d', 3), ('e', 3)):
+        broadcast.join(clientId, user)
+    broadcast.execute(DoRequest(1, Vector(), Insert(0, Buffer([Segment(1, "ab")]))))
+    broadcast.execute(DoRequest(2, Vector(), Insert(0, Buffer([Segment(2, "xy")]))))
+    broadcast.execute(DoRequest(3, Vector('1:1;2:1'), Delete(1, 2)))
+    updates = dict(broadcast.flush())
+    print ' Fanout: %s' % broadcast.getStats() #this should output 1 group and no translations
+    assert broadcast.getStats()['groups'] == 1 and broadcast.getStats()['translations'] == 0
+    assert [len(updates[frozenset(clients)]) for clients in ('a', 'b', 'cde')] == [2, 2, 2]
+    #Clients that applied their own requests end up with the state of the server.
+    buffer = Buffer()
+    Insert(0, Buffer([Segment(1, "ab")])).apply(buffer)
+    for translated in updates[frozenset('a')]:
+        translated.operation.apply(buffer)
+    assert buffer.toString() == state.buffer.toString()
+    buffer = Buffer()
+    for translated in updates[frozenset('cde')]:
+        translated.operation.apply(buffer)
+    Delete(1, 2).apply(buffer)
+    assert buffer.toString() == state.buffer.toString()
+    #A client that lags behind gets its own translation.
+    broadcast.leave('a')
+    broadcast.join('f', 4, Vector('1:1;2:1'))
+    broadcast.execute(DoRequest(1, Vector('1:1'), Insert(0, Buffer([Segment(1, "z")]))))
+    updates = dict(broadcast.flush())
+    assert broadcast.getStats()['translations'] == 1 and broadcast.vectorOf('f') == Vector('1:2;2:1')
+    assert updates[frozenset('f')][0].toString() == state.translate(state.log[-1], Vector('1:1;2:1')).toString()
+    assert updates[frozenset('bcde')][0].vector == Vector('1:1;2:1;3:1')
+
+def test_multi_delete():
+    #A delete split by inserts into it stays one flat operation.
+    operation = Delete(0, Buffer([Segment(1, "abcdef")]))
+    for position in (2, 5, 1):
+        operation = operation.transform(Insert(position, Buffer([Segment(2, "X")])))
+    print ' MultiDelete: %s' % operation #this should output MultiDelete(Delete(0, a), Delete(2, b), Delete(4, cd), Delete(7, ef))
+    assert [(part.position, part.what.toString()) for part in operation.parts] == [(0, "a"), (2, "b"), (4, "cd"), (7, "ef")]
+    buffer = Buffer([Segment(1, "aXbXcdXef")])
+    operation.apply(buffer)
+    assert buffer.toString() == "XXX"
+    operation.mirror().apply(buffer)
+    assert buffer.toString() == "aXbXcdXef"
+    transformed = operation.transform(Delete(1, Buffer([Segment(2, "X"), Segment(1, "b"), Segment(2, "X")])))
+    assert transformed.toString() == "MultiDelete(Delete(0, a), Delete(1, ), Delete(1, cd), Delete(4, ef))"
+    assert Delete.getAffectedString(transformed, Buffer([Segment(1, "acdXef")])).toString() == "abcdef"
+    assert Insert(4, Buffer([Segment(3, "y")])).transform(operation).position == 2
+    #Split trees of deletes are flattened.
+    split = Split(Delete(0, 1), Split(Delete(2, 1), Delete(4, 2)))
+    assert MultiDelete.normalize(split).toString() == "MultiDelete(Delete(0, 1), Delete(2, 1), Delete(4, 2))"
+    assert MultiDelete.normalize(Split(Delete(0, 3), Delete(2, 1))).__class__ == Split
+
+
+def test_changes():
+    editor = InfinoteEditor()
+    editor.try_insert([1, '', 0, 'hello'])
+    since, text = editor.get_state()
+    editor.try_insert([2, '', 0, 'say '])
+    editor.try_delete([1, '1:1', 1, 3])
+    editor.try_insert([1, '1:2;2:1', 6, ' world'])
+    editor.try_undo([2])
+    vector, edits = editor.get_changes(since)
+    for edit in edits:
+        if edit[0] == 'i':
+            text = text[:edit[1]] + edit[2] + text[edit[1]:]
+        else:
+            text = text[:edit[1]] + text[edit[1] + edit[2]:]
+    print ' Changes: %s -> %s' % (edits, text) #this should output "ho world"
+    assert (vector, text) == editor.get_state() == ('1:3;2:2', 'ho world')
+    assert editor.get_changes(vector) == (vector, [])
+    state = State(Buffer([Segment(1, "abc")]), bufferClass = TreeBuffer)
+    assert state.buffer.toString() == "abc"
+    state.execute(DoRequest(1, Vector(), Insert(1, Buffer([Segment(1, "x")]))))
+    assert state.buffer.toString() == "axbc" == ''.join([node.text for node in state.buffer.nodes()])
+
+
+def test_transform_sequence():
+    #The requests a client missed: user 2 inserts "XY", then user 3 deletes "bcX".
+    run = [DoRequest(2, Vector(), Insert(3, Buffer([Segment(2, "XY")])))]
+    run.append(DoRequest(3, Vector('2:1'), Delete(1, Buffer([Segment(0, "bc"), Segment(2, "X")]))))
+    sequence = TransformSequence(run)
+    delete = sequence.transform(DoRequest(1, Vector(), Delete(2, 4)))
+    insert = sequence.transform(DoRequest(1, Vector(), Insert(3, Buffer([Segment(1, "Q")]))))
+    print ' Sequence: %s %s' % (delete, insert) #this should output Delete(2, 3) at 2:1;3:1, Insert(2, Q)
+    assert delete.vector == Vector('2:1;3:1') and insert.operation.position == 2
+    state = State(Buffer([Segment(0, "abcdefgh")]))
+    for request in run + [DoRequest(1, Vector(), Delete(2, 4))]:
+        state.execute(request)
+    buffer = Buffer([Segment(0, "aYdefgh")])
+    assert Delete.getAffectedString(delete.operation, buffer).toString() == "cdef"
+    delete.operation.apply(buffer)
+    assert buffer.toString() == state.buffer.toString() == "aYgh"
+    #The same as transforming against each operation in turn.
+    operation = Delete(0, Buffer([Segment(0, "abcdefgh")]))
+    for request in run:
+        operation = operation.transform(request.operation)
+    buffer = Buffer([Segment(0, "aYdefgh")])
+    expected = buffer.copy()
+    sequence.transform(Delete(0, Buffer([Segment(0, "abcdefgh")]))).apply(buffer)
+    operation.apply(expected)
+    assert buffer.toString() == expected.toString() == "Y"
+
+
+def test_bench():
+    current = bench.run(0.01, ['typing', 'undo'], memory = False)
+    result = current['results']['execute.typing']
+    print ' Bench: %s ops, p50 %.1fus' % (result['ops'], result['p50']) #this should output 50 ops
+    assert sorted(current['results']) == ['execute.typing', 'undo.storm'] and result['ops'] == 50
+    assert result['p50'] <= result['p90'] <= result['p99'] <= result['max']
+    baseline = {'results': {'execute.typing': dict(result, opsPerSec = result['opsPerSec'] * 2)}}
+    assert bench.compare(baseline, current) == [('execute.typing', result['opsPerSec'] * 2, result['opsPerSec'], -0.5, True)]
+
+
+def test_metrics():
+    sink = metrics.HistogramSink()
+    state = State(Buffer([Segment(0, "abc")]), metrics = metrics.Metrics(sink, 'doc'))
+    state.execute(DoRequest(1, Vector(), Insert(1, Buffer([Segment(1, "x")]))))
+    state.execute(DoRequest(2, Vector(), Insert(1, Buffer([Segment(2, "y")]))))
+    state.execute(UndoRequest(1, state.vector))
+    stats = sink.getStats('doc')
+    print ' Metrics: %s' % sorted(stats) #this should output the translate and buffer metrics
+    assert stats['translate.calls'] == 3 and stats['translate']['count'] == 3
+    assert stats['translate.userid'] >= 1 and stats['translate.mirror'] == 1
+    assert stats['buffer.splice.segments']['count'] == 3 and sink.documents() == set(['doc'])
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    statsd = metrics.StatsdSink(receiver.getsockname(), packetSize = 64)
+    state.setMetrics(metrics.Metrics(statsd, 'doc'))
+    state.execute(DoRequest(1, state.vector, Delete(0, 1)))
+    statsd.close()
+    lines = receiver.recv(4096).decode('utf-8').split('\n')
+    receiver.close()
+    assert 'infinote.doc.translate.calls:1|c' in lines
+    state.setMetrics(None)
+    assert state.buffer.metrics == None
+
+
+def test_fuzz():
+    stats = {'executed': 0}
+    for topology in (fuzz.STAR, fuzz.MESH):
+        for seed in range(5):
+            simulation = fuzz.Simulation(2, topology = topology)
+            simulation.run(fuzz.generate(random.Random(seed), 2, 80))
+            stats['executed'] += simulation.getStats()['executed']
+    #With four sites the texts can diverge (see fuzz.py), and a request can
+    #then fail to execute. Until then, translations must match the reference.
+    for seed in range(3):
+        error = fuzz.failure(fuzz.generate(random.Random(seed), 4, 80), sites = 4, converge = False,
+                             factory = lambda: State(bufferClass = TreeBuffer))
+        assert error == None or isinstance(error, fuzz.ExecutionError)
+    #A shrunk four-site script where the texts diverge and an insert then lands
+    #beyond the end of site 1's text. The independent reference fails the same
+    #way, so this is the TP2 limitation of the engine.
+    script = [('insert', 3, 0.37, 0.53), ('insert', 1, 0.17, 0.53), ('insert', 2, 0.59, 0.63),
+              ('insert', 0, 0.75, 0.15), ('delete', 0, 0.45, 0.28), ('deliver', 2, 0.69, 0.01),
+              ('deliver', 3, 0.21, 0.66), ('insert', 0, 0.6, 0.35), ('deliver', 0, 0.99, 0.78),
+              ('deliver', 1, 0.85, 0.42), ('deliver', 0, 0.07, 0.15), ('delete', 2, 0.51, 0.3),
+              ('insert', 0, 0.35, 0.56), ('insert', 2, 0.91, 0.88), ('deliver', 1, 0.65, 0.87),
+              ('deliver', 3, 0.19, 0.85), ('deliver', 0, 0.2, 0.67), ('delete', 0, 0.79, 1.0),
+              ('deliver', 3, 0.82, 0.76), ('deliver', 1, 0.62, 0.3), ('deliver', 1, 0.4, 0.41),
+              ('deliver', 3, 0.25, 0.59), ('deliver', 1, 0.02, 0.88), ('delete', 1, 0.73, 0.35),
+              ('deliver', 3, 0.27, 0.1), ('delete', 3, 0.07, 0.44), ('insert', 3, 0.2, 0.93)]
+    for factory in (State, fuzz.ReferenceState):
+        error = fuzz.failure(script, sites = 4, converge = False, reference = False, factory = factory)
+        assert isinstance(error, fuzz.ExecutionError) and isinstance(error.Errors, BufferSpliceError)
+    assert str(fuzz.failure(script, sites = 4, converge = False)).startswith('Site 1 failed')
+    #An exception raised by the engine is a failure that is shrunk and reported.
+    class FailingState(State):
+        def execute(self, request = None):
+            if self.buffer.getLength() > 3:
+                raise BufferSpliceError('Buffer splice operation out of bounds')
+            return State.execute(self, request)
+    script = fuzz.generate(random.Random(0), 2, 40)
+    assert isinstance(fuzz.failure(script, factory = FailingState), fuzz.ExecutionError)
+    shrunk = fuzz.shrink(script, factory = FailingState)
+    out = tempfile.TemporaryFile('w+')
+    fuzz.report(shrunk, out, factory = FailingState)
+    out.seek(0)
+    assert len(shrunk) < len(script) and 'error: ExecutionError: Site ' in out.read()
+    print ' Fuzz: %s requests' % stats['executed'] #this should output the number of requests executed
+    #Three sites can diverge when inserts meet at deleted text (no TP2): user 1
+    #inserts c before b, user 3 ddd after it, user 2 replaces b with d.
+    script = [(fuzz.INSERT, 0, 0.1, 0.2), (fuzz.DELIVER, 1, 0.8, 0.0), (fuzz.INSERT, 0, 0.2, 0.2),
+              (fuzz.DELIVER, 2, 0.6, 0.0), (fuzz.INSERT, 2, 0.3, 0.8), (fuzz.DELETE, 1, 0.0, 0.7),
+              (fuzz.INSERT, 1, 0.3, 0.1)]
+    assert isinstance(fuzz.failure(script, sites = 3), fuzz.ConvergenceError)
+    assert fuzz.failure(script, sites = 3, converge = False) == None
+    assert fuzz.shrink(script, sites = 3, reference = False) == script
+
+
 test_1()
 test_2()
+test_cache()
+test_vector()
+test_tree_buffer()
+test_buffer_runs()
+test_html()
+test_attribution()
+test_gc()
+test_batch()
+test_coalesce()
+test_deep_translation()
+test_snapshot()
+test_undo_redo()
+test_undo_cid()
+test_undo_order()
+test_split_mirror()
+test_recon_order()
+test_queue()
+test_codec()
+test_sessions()
+test_fanout()
+test_multi_delete()
+test_changes()
+test_transform_sequence()
+test_bench()
+test_metrics()
+test_journal()
+test_fuzz()